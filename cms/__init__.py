@@ -31,6 +31,7 @@ import datetime
 import imp
 import pkgutil
 import codecs
+import threading
 import netifaces
 from argparse import ArgumentParser
 
@@ -82,6 +83,7 @@ class Config:
         # ContestWebServer.
         self.contest_listen_address = [""]
         self.contest_listen_port = [8888]
+        self.contest_workers = 1
         self.cookie_duration = 1800
         self.submit_local_copy = True
         self.submit_local_copy_path = "%s/submissions/"
@@ -94,6 +96,7 @@ class Config:
         self.max_input_length = 5000000
         self.stl_path = "/usr/share/doc/stl-manual/html/"
         self.allow_questions = True
+        self.notifications_push = False
         # Prefix of 'iso-codes'[1] installation. It can be found out
         # using `pkg-config --variable=prefix iso-codes`, but it's
         # almost universally the same (i.e. '/usr') so it's hardly
@@ -115,6 +118,7 @@ class Config:
         self.rankings_address = [["http", "localhost", 8890]]
         self.rankings_username = ["usern4me"]
         self.rankings_password = ["passw0rd"]
+        self.rankings_dispatch_window = 0.1
         self.https_certfile = None
 
         # ResourceService.
@@ -401,6 +405,10 @@ class Logger(object):
                                           ServiceCoord("LogService", 0))
         self.operation = ""
         self._my_coord = None
+        # Messages can come from many threads (e.g., the workers
+        # storing files); they are written and sent one at a time.
+        # Reentrant, as sending a message may log.
+        self._lock = threading.RLock()
 
     def redirect_stdout_stderr(self):
         """If stdout is not currently heading somewhere useful, then redirect
@@ -422,10 +430,13 @@ class Logger(object):
             # Don't duplicate messages.
             self.TO_DISPLAY = []
 
-    def initialize(self, service):
+    def initialize(self, service, process=None):
         """To be set by the service we are currently running.
 
         service (ServiceCoord): the service that we are running
+        process (int): if the service runs in many processes, the
+                       number of this one, which gets its own log
+                       directory.
 
         """
         self._my_coord = service
@@ -437,6 +448,8 @@ class Logger(object):
 
         log_dir = os.path.join(config.log_dir,
                                "%s-%d" % (service.name, service.shard))
+        if process is not None:
+            log_dir += "-%d" % process
         mkdir(config.log_dir)
         mkdir(log_dir)
         log_filename = "%d.log" % int(time.time())
@@ -450,11 +463,15 @@ class Logger(object):
             pass
         os.symlink(log_filename,
                    os.path.join(log_dir, "last.log"))
-        self.info("%s %d up and running!" % service)
+        if process is None:
+            self.info("%s %d up and running!" % service)
+        else:
+            self.info("%s %d (process %d) up and running!" %
+                      (service.name, service.shard, process))
 
     def log(self, msg, operation=None, severity=None, timestamp=None):
         """Record locally a log message and tries to send it to the
-        log service.
+        log service. It is safe to call it from any thread.
 
         msg (string): the message to log
         operation (string): a high-level description of the long-term
@@ -473,19 +490,20 @@ class Logger(object):
         if self._my_coord is not None:
             coord = repr(self._my_coord)
 
-        if severity in self.TO_DISPLAY:
-            print format_log(msg, coord, operation, severity, timestamp,
-                             colors=config.color_shell_log)
-        if self._my_coord is not None:
-            if severity in self.TO_STORE:
-                print >> self._log_file, format_log(
-                    msg, coord, operation,
-                    severity, timestamp,
-                    colors=config.color_file_log)
-            if severity in self.TO_SEND:
-                self._log_service.Log(
-                    msg=msg, coord=coord, operation=operation,
-                    severity=severity, timestamp=timestamp)
+        with self._lock:
+            if severity in self.TO_DISPLAY:
+                print format_log(msg, coord, operation, severity, timestamp,
+                                 colors=config.color_shell_log)
+            if self._my_coord is not None:
+                if severity in self.TO_STORE:
+                    print >> self._log_file, format_log(
+                        msg, coord, operation,
+                        severity, timestamp,
+                        colors=config.color_file_log)
+                if severity in self.TO_SEND:
+                    self._log_service.Log(
+                        msg=msg, coord=coord, operation=operation,
+                        severity=severity, timestamp=timestamp)
 
     def __getattr__(self, method):
         """Syntactic sugar to allow, e.g., logger.debug(...).
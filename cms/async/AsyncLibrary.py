@@ -162,7 +162,7 @@ class Service:
     need only one of the two behaviours.
 
     """
-    def __init__(self, shard=0, custom_logger=None):
+    def __init__(self, shard=0, custom_logger=None, rpc_server=True):
         signal.signal(signal.SIGINT, lambda unused_x, unused_y: self.exit())
 
         global logger
@@ -193,12 +193,13 @@ class Service:
         self._my_coord = ServiceCoord(self.__class__.__name__, self.shard)
 
         # We setup the listening address for services which want to
-        # connect with us.
+        # connect with us (unless another process of the same service
+        # does it for us).
         try:
             address = get_service_address(self._my_coord)
         except KeyError:
             address = None
-        if address is not None:
+        if address is not None and rpc_server:
             self.server = ListeningSocket(self, address)
 
     def connect_to(self, service, on_connect=None):
@@ -147,8 +147,17 @@ class WebService(Service):
     """
 
     def __init__(self, listen_port, handlers, parameters, shard=0,
-                 custom_logger=None, listen_address=""):
-        Service.__init__(self, shard, custom_logger)
+                 custom_logger=None, listen_address="", sockets=None,
+                 rpc_server=True):
+        """Start the service and the web server.
+
+        sockets ([socket]): if given, the (already bound) sockets to
+                            serve, instead of listen_address and
+                            listen_port.
+        rpc_server (bool): whether to accept RPCs (see Service).
+
+        """
+        Service.__init__(self, shard, custom_logger, rpc_server)
 
         global logger
         from cms.async.AsyncLibrary import logger as _logger
@@ -160,7 +169,7 @@ class WebService(Service):
         # the server reloads.
 
         try:
-            if parameters["debug"]:
+            if parameters["debug"] and rpc_server:
                 fcntl.fcntl(self.server.socket,
                             fcntl.F_SETFD, fcntl.FD_CLOEXEC)
         except KeyError:
@@ -188,7 +197,10 @@ class WebService(Service):
         self.application.service = self
         http_server = tornado.httpserver.HTTPServer(
             self.application, xheaders=parameters.get("is_proxy_used", True))
-        http_server.listen(listen_port, address=listen_address)
+        if sockets is None:
+            http_server.listen(listen_port, address=listen_address)
+        else:
+            http_server.add_sockets(sockets)
         self.instance = tornado.ioloop.IOLoop.instance()
 
     def exit(self):
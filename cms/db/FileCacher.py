@@ -28,6 +28,8 @@ import os
 import tempfile
 import shutil
 import hashlib
+import threading
+from contextlib import contextmanager
 
 from sqlalchemy.exc import IntegrityError
 
@@ -59,6 +61,21 @@ class FileCacherBackend:
         """
         raise NotImplementedError("Please subclass this class.")
 
+    def open_file(self, digest):
+        """Open a file of the storage, to read it without copying it
+        elsewhere first. This is a context manager, so it should be
+        used with the `with' clause this way:
+
+          with backend.open_file(digest) as fobj:
+
+        If the requested digest isn't available in the storage, raise
+        an exception.
+
+        digest (string): the digest of the file to open.
+
+        """
+        raise NotImplementedError("Please subclass this class.")
+
     def put_file(self, digest, origin, description=""):
         """Put a file to the storage.
 
@@ -72,6 +89,16 @@ class FileCacherBackend:
         """
         raise NotImplementedError("Please subclass this class.")
 
+    def exists(self, digest):
+        """Return whether the storage has a file.
+
+        digest (string): the digest of the file.
+
+        returns (bool): True if the storage contains the file.
+
+        """
+        raise NotImplementedError("Please subclass this class.")
+
     def describe(self, digest):
         """Return the description of a file given its digest.
 
@@ -146,6 +173,14 @@ class FSBackend(FileCacherBackend):
         """
         shutil.copyfile(os.path.join(self.path, digest), dest)
 
+    @contextmanager
+    def open_file(self, digest):
+        """See FileCacherBackend.open_file().
+
+        """
+        with open(os.path.join(self.path, digest), 'rb') as fobj:
+            yield fobj
+
     def put_file(self, digest, origin, description=""):
         """See FileCacherBackend.put_file().
 
@@ -153,6 +188,12 @@ class FSBackend(FileCacherBackend):
         if not os.path.exists(os.path.join(self.path, digest)):
             shutil.copyfile(origin, os.path.join(self.path, digest))
 
+    def exists(self, digest):
+        """See FileCacherBackend.exists().
+
+        """
+        return os.path.exists(os.path.join(self.path, digest))
+
     def describe(self, digest):
         """See FileCacherBackend.describe(). This method returns
         nothing, because FSBackend doesn't store the description.
@@ -209,6 +250,18 @@ class DBBackend(FileCacherBackend):
                             self.service._step()
                         buf = lobject.read(self.CHUNK_SIZE)
 
+    @contextmanager
+    def open_file(self, digest):
+        """See FileCacherBackend.open_file().
+
+        """
+        with SessionGen() as session:
+            fso = FSObject.get_from_digest(digest, session)
+            if fso is None:
+                raise KeyError("File %s not found." % digest)
+            with fso.get_lobject(session, mode='rb') as lobject:
+                yield lobject
+
     def put_file(self, digest, origin, description=""):
         """See FileCacherBackend.put_file().
 
@@ -247,6 +300,13 @@ class DBBackend(FileCacherBackend):
             logger.warning("File %s caused an IntegrityError, ignoring..."
                            % digest)
 
+    def exists(self, digest):
+        """See FileCacherBackend.exists().
+
+        """
+        with SessionGen() as session:
+            return FSObject.get_from_digest(digest, session) is not None
+
     def describe(self, digest):
         """See FileCacherBackend.describe().
 
@@ -314,9 +374,15 @@ class NullBackend(FileCacherBackend):
     def get_file(self, digest, dest):
         raise Exception("No files in a NullBackend")
 
+    def open_file(self, digest):
+        raise Exception("No files in a NullBackend")
+
     def put_file(self, digest, origin, description=""):
         pass
 
+    def exists(self, digest):
+        return False
+
     def describe(self, digest):
         return None
 
@@ -376,6 +442,41 @@ class FileCacher:
                 not mkdir(self.obj_dir):
             logger.error("Cannot create necessary directories.")
 
+    def get_cache_path(self, digest):
+        """Return the path of the file in the local cache, first
+        downloading it from the storage if needed.
+
+        The file is shared by everybody using the cache, hence it has
+        to be treated as read-only; it can also be removed from the
+        cache at any time, but an already open file stays readable.
+
+        digest (string): the sha1 sum of the file.
+
+        return (string): the path of the file in the cache.
+
+        """
+        cache_path = os.path.join(self.obj_dir, digest)
+        cache_exists = os.path.exists(cache_path)
+
+        logger.debug("Getting file %s." % (digest))
+
+        if not cache_exists:
+            logger.debug("File %s not in cache, downloading "
+                         "from database." % digest)
+
+            # Receives the file from the database
+            temp_file, temp_filename = tempfile.mkstemp(dir=self.tmp_dir)
+            temp_file = os.fdopen(temp_file, "wb")
+            self.backend.get_file(digest, temp_filename)
+
+            # And move it in the cache. Warning: this is not atomic if
+            # the temp and the cache dir are on different filesystems.
+            shutil.move(temp_filename, cache_path)
+
+            logger.debug("File %s downloaded." % digest)
+
+        return cache_path
+
     def get_file(self, digest, path=None, file_obj=None,
                  string=False, temp_path=False, temp_file_obj=False):
         """Get a file from the storage, possibly using the cache if
@@ -401,25 +502,7 @@ class FileCacher:
             raise ValueError("Ask for at most one amongst content, "
                              "temp path and temp file obj.")
 
-        cache_path = os.path.join(self.obj_dir, digest)
-        cache_exists = os.path.exists(cache_path)
-
-        logger.debug("Getting file %s." % (digest))
-
-        if not cache_exists:
-            logger.debug("File %s not in cache, downloading "
-                         "from database." % digest)
-
-            # Receives the file from the database
-            temp_file, temp_filename = tempfile.mkstemp(dir=self.tmp_dir)
-            temp_file = os.fdopen(temp_file, "wb")
-            self.backend.get_file(digest, temp_filename)
-
-            # And move it in the cache. Warning: this is not atomic if
-            # the temp and the cache dir are on different filesystems.
-            shutil.move(temp_filename, cache_path)
-
-            logger.debug("File %s downloaded." % digest)
+        cache_path = self.get_cache_path(digest)
 
         # Saving to path
         if path is not None:
@@ -472,6 +555,18 @@ class FileCacher:
             logger.error(error_string)
             raise ValueError(error_string)
 
+        # If we are given a path, we can compute the digest without
+        # copying the file, and avoid copying and sending it at all
+        # if the storage already has it. The local cache doesn't
+        # count: it may outlive the storage (e.g., a database created
+        # again).
+        if path is not None:
+            digest = self._hash_file(path)
+            if self.backend.exists(digest):
+                logger.debug("File %s already in the storage." % digest)
+                os.unlink(temp_path)
+                return digest
+
         logger.debug("Reading input file to store on the database.")
 
         # Copy the file content, whatever forms it arrives, into the
@@ -488,15 +583,8 @@ class FileCacher:
             with open(temp_path, 'wb') as temp_file:
                 shutil.copyfileobj(file_obj, temp_file)
 
-        hasher = hashlib.sha1()
-
         # Calculate the file SHA1 digest
-        with open(temp_path, 'rb') as temp_file:
-            buf = temp_file.read(self.CHUNK_SIZE)
-            while buf != '':
-                hasher.update(buf)
-                buf = temp_file.read(self.CHUNK_SIZE)
-        digest = hasher.hexdigest()
+        digest = self._hash_file(temp_path)
 
         logger.debug("File has digest %s." % digest)
 
@@ -508,6 +596,74 @@ class FileCacher:
 
         return digest
 
+    def put_files(self, files, jobs=4):
+        """Put many files in the storage, as put_file(path=...) would
+        do, using jobs threads to copy, hash and send them.
+
+        files ([(string, string)]): pairs (path, description) of the
+                                    files to send.
+        jobs (int): the number of files to send concurrently.
+
+        return ([string]): the digests of the files, in the same
+                           order.
+
+        raise: the first exception raised by put_file, if any.
+
+        """
+        files = list(files)
+        digests = [None] * len(files)
+        errors = []
+        lock = threading.Lock()
+        indices = iter(xrange(len(files)))
+
+        def worker():
+            """Send files until there are none or some send failed.
+
+            """
+            while True:
+                with lock:
+                    if errors:
+                        return
+                    try:
+                        i = next(indices)
+                    except StopIteration:
+                        return
+                path, description = files[i]
+                try:
+                    digests[i] = self.put_file(path=path,
+                                               description=description)
+                except Exception as error:
+                    with lock:
+                        errors.append(error)
+                    return
+
+        threads = [threading.Thread(target=worker)
+                   for unused_i in xrange(max(1, min(jobs, len(files))))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+        return digests
+
+    def _hash_file(self, path):
+        """Return the SHA1 digest of a file.
+
+        path (string): the file to hash.
+
+        return (string): the hex digest.
+
+        """
+        hasher = hashlib.sha1()
+        with open(path, 'rb') as file_:
+            buf = file_.read(self.CHUNK_SIZE)
+            while buf != '':
+                hasher.update(buf)
+                buf = file_.read(self.CHUNK_SIZE)
+        return hasher.hexdigest()
+
     def describe(self, digest):
         """Return the description of a file given its digest.
 
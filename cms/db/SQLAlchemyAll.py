@@ -28,7 +28,7 @@ db objects must be imported from this module.
 
 import sys
 
-from cms.db.SQLAlchemyUtils import Base, metadata, Session, \
+from cms.db.SQLAlchemyUtils import db, Base, metadata, Session, \
     ScopedSession, SessionGen, drop_everything
 from cms.db.Contest import Contest, Announcement
 from cms.db.User import User, Message, Question
@@ -27,7 +27,7 @@ used directly (import  from SQLAlchemyAll).
 """
 
 from sqlalchemy.schema import Column, ForeignKey, ForeignKeyConstraint, \
-    UniqueConstraint
+    UniqueConstraint, Index
 from sqlalchemy.types import Integer, Float, String, DateTime
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.ext.orderinglist import ordering_list
@@ -119,6 +119,14 @@ class Submission(Base):
         return self.token is not None
 
 
+# The lists of submissions in AWS show those of a task or of a user,
+# the newest first, a page at a time.
+Index("ix_submissions_task_id_timestamp",
+      Submission.task_id, Submission.timestamp)
+Index("ix_submissions_user_id_timestamp",
+      Submission.user_id, Submission.timestamp)
+
+
 class SubmissionResult(Base):
     """Class to store the evaluation results of a submission. Not to
     be used directly (import it from SQLAlchemyAll).
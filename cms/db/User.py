@@ -164,7 +164,8 @@ class Message(Base):
     # Time the message was sent.
     timestamp = Column(
         DateTime,
-        nullable=False)
+        nullable=False,
+        index=True)
 
     # Subject and body of the message.
     subject = Column(
@@ -205,7 +206,8 @@ class Question(Base):
     # Time the question was made.
     question_timestamp = Column(
         DateTime,
-        nullable=False)
+        nullable=False,
+        index=True)
 
     # Subject and body of the question.
     subject = Column(
@@ -218,7 +220,8 @@ class Question(Base):
     # Time the reply was sent.
     reply_timestamp = Column(
         DateTime,
-        nullable=True)
+        nullable=True,
+        index=True)
 
     # Has this message been ignored by the admins?
     ignored = Column(
@@ -147,25 +147,28 @@ class Sandbox:
        command number N.
 
     """
-    def __init__(self, file_cacher=None, temp_dir=None):
+    def __init__(self, file_cacher=None, temp_dir=None, box_id=None):
         """Initialization.
 
         file_cacher (FileCacher): an instance of the FileCacher class
                                   (to interact with FS).
         temp_dir (string): the directory where to put the sandbox
                            (which is itself a directory).
+        box_id (int): the isolate box to use, or None to choose it
+                      from the shard of the service.
 
         """
         self.file_cacher = file_cacher
 
         # Get our shard number, to use as a unique identifier for the sandbox
         # on this machine.
-        if file_cacher is not None and file_cacher.service is not None:
-            # We add 1 to avoid conflicting with console users of the
-            # sandbox who use the default box id of 0.
-            box_id = file_cacher.service._my_coord.shard + 1
-        else:
-            box_id = 0
+        if box_id is None:
+            if file_cacher is not None and file_cacher.service is not None:
+                # We add 1 to avoid conflicting with console users of
+                # the sandbox who use the default box id of 0.
+                box_id = file_cacher.service._my_coord.shard + 1
+            else:
+                box_id = 0
 
         # We create a directory "tmp" inside the outer temporary directory,
         # because the sandbox will bind-mount the inner one. The sandbox also
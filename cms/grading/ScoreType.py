@@ -30,12 +30,49 @@ task.
 """
 
 import simplejson as json
+from collections import OrderedDict
 
 from cms import logger
 
 from tornado.template import Template
 
 
+class LRUCache:
+    """A dictionary with a bounded size, that evicts the least
+    recently used entries when full.
+
+    """
+    def __init__(self, size):
+        """Initializer.
+
+        size (int): the maximum number of entries.
+
+        """
+        self.size = size
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        """Return the value of key, marking it as recently used, or
+        default if not present.
+
+        """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
 class ScoreType:
     """Base class for all score types, that must implement all methods
     defined here.
@@ -43,6 +80,15 @@ class ScoreType:
     """
     TEMPLATE = ""
 
+    # How many rendered score details we keep for each class.
+    HTML_DETAILS_CACHE_SIZE = 1000
+
+    # Compiled TEMPLATE and cache of rendered details of each class
+    # (score types are instantiated on every request by the web
+    # servers, so these cannot live in the instances).
+    _templates = {}
+    _html_details = {}
+
     def __init__(self, parameters, public_testcases):
         """Initializer.
 
@@ -92,6 +138,8 @@ class ScoreType:
                             dictionary {'outcome': xxx, 'text': yyy}.
         tokened (bool): if the user played a token on submission.
 
+        return (set): see update_scores.
+
         """
         self.pool[submission_id] = {
             "timestamp": timestamp,
@@ -130,13 +178,18 @@ class ScoreType:
                 self.submissions[username][i - 1]
             i -= 1
 
-        self.update_scores(submission_id)
+        return self.update_scores(submission_id)
 
     def add_token(self, submission_id):
         """To call when a token is played, so that the scores updates.
 
         submission_id (int): id of the tokened submission.
 
+        return (set): see update_scores; it also contains
+                      submission_id if its own score changed (e.g.,
+                      with Relative, if its outcomes contribute again
+                      to the best ones).
+
         """
         try:
             self.pool[submission_id]["tokened"] = True
@@ -144,7 +197,11 @@ class ScoreType:
             logger.error("Submission %d not found in ScoreType's pool." %
                          submission_id)
 
-        self.update_scores(submission_id)
+        old_score = self.pool[submission_id]["score"]
+        changed_submissions = self.update_scores(submission_id)
+        if self.pool[submission_id]["score"] != old_score:
+            changed_submissions.add(submission_id)
+        return changed_submissions
 
     def update_scores(self, new_submission_id):
         """Update the scores of the users assuming that only this
@@ -154,11 +211,29 @@ class ScoreType:
 
         new_submission_id (int): id of the newly added submission.
 
+        return (set): ids of the submissions, other than
+                      new_submission_id, whose score changed as a
+                      consequence (they need to be saved and sent to
+                      the rankings again).
+
         """
         logger.error("Unimplemented method update_scores.")
         raise NotImplementedError
 
-    def get_html_details(self, score_details, translator=None):
+    @classmethod
+    def get_template(cls):
+        """Return the compiled TEMPLATE of the class, compiling it
+        only the first time.
+
+        return (Template): the compiled template.
+
+        """
+        if cls not in ScoreType._templates:
+            ScoreType._templates[cls] = Template(cls.TEMPLATE)
+        return ScoreType._templates[cls]
+
+    def get_html_details(self, score_details, translator=None,
+                         locale=None):
         """Return an HTML string representing the score details of a
         submission.
 
@@ -166,21 +241,38 @@ class ScoreType:
                               in the database; can be public or
                               private.
         translator (function): the function to localize strings.
+        locale (string): an identifier of the language translator
+                         translates to; if given (or if translator is
+                         not) the result is cached.
         return (string): an HTML string representing score_details.
 
         """
+        cacheable = translator is None or locale is not None
+        if cacheable:
+            cache = ScoreType._html_details.get(self.__class__)
+            if cache is None:
+                cache = LRUCache(self.HTML_DETAILS_CACHE_SIZE)
+                ScoreType._html_details[self.__class__] = cache
+            key = (score_details, locale)
+            html = cache.get(key)
+            if html is not None:
+                return html
+
         if translator is None:
             translator = lambda string: string
         try:
-            score_details = json.loads(score_details)
+            details = json.loads(score_details)
         except (json.decoder.JSONDecodeError, TypeError):
             # TypeError raised if score_details is None
             logger.error("Found a null or non-JSON score details string. "
                          "Try invalidating scores.")
             return translator("Score details temporarily unavailable.")
-        else:
-            return Template(self.TEMPLATE).generate(details=score_details,
-                                                    _=translator)
+
+        html = self.get_template().generate(details=details,
+                                            _=translator)
+        if cacheable:
+            cache[key] = html
+        return html
 
     def max_scores(self):
         """Returns the maximum score that one could aim to in this
@@ -224,6 +316,8 @@ class ScoreTypeAlone(ScoreType):
 
         new_submission_id (int): id of the newly added submission.
 
+        return (set): empty, as no other submission is affected.
+
         """
         username = self.pool[new_submission_id]["username"]
         submission_ids = self.submissions[username]
@@ -240,6 +334,8 @@ class ScoreTypeAlone(ScoreType):
         # Finally we update the score table.
         self.scores[username] = score
 
+        return set()
+
 
 class ScoreTypeGroup(ScoreTypeAlone):
     """Intermediate class to manage tasks whose testcases are
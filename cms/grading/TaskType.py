@@ -52,7 +52,7 @@ def create_sandbox(task_type):
 
     """
     try:
-        sandbox = Sandbox(task_type.file_cacher)
+        sandbox = Sandbox(task_type.file_cacher, box_id=task_type.box_id)
     except (OSError, IOError):
         err_msg = "Couldn't create sandbox."
         logger.error("%s\n%s" % (err_msg, traceback.format_exc()))
@@ -136,6 +136,10 @@ class TaskType:
         self.file_cacher = file_cacher
         self.result = {}
 
+        # The isolate box for the sandboxes, None to let Sandbox
+        # choose; set it to run many task types at the same time.
+        self.box_id = None
+
         self.worker_shard = None
         self.sandbox_paths = ""
 
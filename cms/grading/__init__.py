@@ -25,7 +25,10 @@ import codecs
 from collections import namedtuple
 
 from cms import logger
-from cms.db.SQLAlchemyAll import SessionGen, Submission, SubmissionResult
+from sqlalchemy import and_
+
+from cms.db.SQLAlchemyAll import SessionGen, Submission, SubmissionResult, \
+    Task, Token
 from cms.grading.Sandbox import Sandbox
 
 
@@ -679,3 +682,83 @@ def task_score(user, task):
                     partial = True
 
     return max(last_score, max_tokened_score), partial
+
+
+def compute_ranking(contest, session):
+    """Return the ranking of a contest, with the scores task_score
+    would give, but loading the data of all the submissions with a
+    single query.
+
+    contest (Contest): the contest.
+    session (Session): the session to use.
+
+    return ([tuple]): for each user not hidden, sorted by username, a
+                      tuple (user, task_scores, score, partial), where
+                      task_scores is the list of the pairs (score,
+                      partial) on the tasks (in the order of
+                      contest.tasks), and score and partial are the
+                      global ones. Scores are rounded to the precision
+                      of the task or of the contest.
+
+    """
+    # For each (user id, task id): the data of the last submission
+    # (as (scored, score, waits for score)), the maximum score amongst
+    # the tokened ones and whether a tokened one waits for a score.
+    last = {}
+    max_tokened_score = {}
+    tokened_partial = {}
+
+    rows = session.query(Submission.user_id,
+                         Submission.task_id,
+                         Token.id,
+                         SubmissionResult.submission_id,
+                         SubmissionResult.compilation_outcome,
+                         SubmissionResult.score)\
+        .join(Task, Submission.task_id == Task.id)\
+        .outerjoin(Token, Token.submission_id == Submission.id)\
+        .outerjoin(SubmissionResult, and_(
+            SubmissionResult.submission_id == Submission.id,
+            SubmissionResult.dataset_id == Task.active_dataset_id))\
+        .filter(Task.contest_id == contest.id)\
+        .order_by(Submission.timestamp, Submission.id).all()
+
+    for user_id, task_id, token_id, result_id, outcome, score in rows:
+        key = (user_id, task_id)
+        # The same as waits_for_score in task_score.
+        waits = result_id is None or \
+            outcome != "fail" and score is None
+        last[key] = (score is not None, score, waits)
+        if token_id is not None:
+            if score is not None:
+                max_tokened_score[key] = max(
+                    max_tokened_score.get(key, 0.0), score)
+            elif waits:
+                tokened_partial[key] = True
+
+    ranking = []
+    for user in sorted(contest.users, key=lambda u: u.username):
+        if user.hidden:
+            continue
+        task_scores = []
+        score = 0.0
+        partial = False
+        for task in contest.tasks:
+            key = (user.id, task.id)
+            t_score = 0.0
+            t_partial = False
+            if key in last:
+                scored, last_score, waits = last[key]
+                if scored:
+                    t_score = last_score
+                elif waits:
+                    t_partial = True
+                t_score = max(t_score, max_tokened_score.get(key, 0.0))
+                t_partial = t_partial or tokened_partial.get(key, False)
+            t_score = round(t_score, task.score_precision)
+            task_scores.append((t_score, t_partial))
+            score += t_score
+            partial = partial or t_partial
+        ranking.append((user, task_scores,
+                        round(score, contest.score_precision), partial))
+
+    return ranking
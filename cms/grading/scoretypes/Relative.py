@@ -19,10 +19,55 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-# IMPORTANT: this score type is not up to date with the rest of CMS
-# because it turned out to be an implementation nightmare.
+import heapq
+
+import simplejson as json
 
 from cms.grading.ScoreType import ScoreType
+from cms.grading.scoretypes.Sum import Sum
+
+
+class OutcomeMultiset:
+    """A multiset of floats that can return its maximum quickly.
+
+    It is a max-heap with lazy deletion: removed values are only
+    discarded from the heap when they reach its top. Insertion,
+    removal and (amortized) maximum are all O(log n).
+
+    """
+    def __init__(self):
+        self._heap = []
+        self._count = {}
+
+    def add(self, value):
+        """Add one occurrence of value.
+
+        value (float): the value to add.
+
+        """
+        if self._count.get(value, 0) == 0:
+            heapq.heappush(self._heap, -value)
+        self._count[value] = self._count.get(value, 0) + 1
+
+    def remove(self, value):
+        """Remove one occurrence of value, that must be present.
+
+        value (float): the value to remove.
+
+        """
+        self._count[value] -= 1
+
+    def max(self):
+        """Return the maximum value, or None if the multiset is empty.
+
+        return (float): the maximum.
+
+        """
+        while self._heap and self._count.get(-self._heap[0], 0) == 0:
+            self._count.pop(-heapq.heappop(self._heap), None)
+        if not self._heap:
+            return None
+        return -self._heap[0]
 
 
 class Relative(ScoreType):
@@ -35,7 +80,16 @@ class Relative(ScoreType):
     compared with a 'basic' outcome given as a parameter. Finally, the
     score is multiplied by a multiplier given as parameter.
 
+    The best outcome of each testcase is kept in an OutcomeMultiset
+    holding the outcomes of the contributing submissions, so that a
+    new submission costs O(testcases * log(submissions)), plus the
+    rescoring of the submissions that have a positive outcome on a
+    testcase whose best outcome changed.
+
     """
+    # Details have the same format as the ones of Sum.
+    TEMPLATE = Sum.TEMPLATE
+
     def initialize(self):
         """Init.
 
@@ -46,69 +100,143 @@ class Relative(ScoreType):
                              outcome.
 
         """
-        # We keep the best outcome that is gonna stay (i.e., not
-        # amongst the last submissions, but only tokened and basic
-        # outcomes. Elements may be None.
-        self.best_tokenized_outcomes = []
-        for par in self.parameters[1]:
-            self.best_tokenized_outcomes.append(par)
+        self.indices = sorted(self.public_testcases.keys())
 
-        # Temporary store the best outcomes for every evaluation as
-        # computed in compute_score, to use them in update_scores.
-        self.best_outcomes = None
+        # For every testcase, the outcomes of the contributing
+        # submissions and the basic outcome, if any.
+        self.outcomes = dict((idx, OutcomeMultiset())
+                             for idx in self.indices)
+        for idx, basic in zip(self.indices, self.parameters[1]):
+            if basic is not None:
+                self.outcomes[idx].add(float(basic))
 
-    def compute_best_outcomes(self):
-        """Merge best_tokenized_outcomes with the last submissions of
-        every user to return the current best outcome for every
-        evaluation.
+        # Current best outcome for every testcase (None if there are
+        # no outcomes at all).
+        self.best_outcomes = dict((idx, self.outcomes[idx].max())
+                                  for idx in self.indices)
 
-        returns (list): a list of one float for every evaluation, the
-                        best outcome.
+        # For every testcase, the ids of the submissions with a
+        # positive outcome on it, i.e., the ones whose score depends
+        # on the best outcome of that testcase.
+        self.dependent = dict((idx, set()) for idx in self.indices)
+
+        # The ids of the submissions whose outcomes are in
+        # self.outcomes, and for every username the id of the
+        # submission counted as its last one.
+        self.contributing = set()
+        self.last = {}
+
+    def _get_outcomes(self, submission_id):
+        """Return the outcomes of a submission, as floats.
+
+        submission_id (int): the submission.
+        return (dict): testcase num to outcome; empty if the
+                       submission did not compile.
 
         """
-        best_outcomes = self.best_tokenized_outcomes[:]
-        for username in self.submissions:
-            submissions = self.submissions[username]
-            if submissions == []:
-                continue
-            for i, outcome in \
-                enumerate(self.pool[submissions[-1]]["evaluations"]):
-                best_outcomes[i] = max(best_outcomes[i], outcome)
+        submission = self.pool[submission_id]
+        if not submission["evaluated"]:
+            return {}
+        return dict((idx, float(submission["evaluations"][idx]["outcome"]))
+                    for idx in self.indices)
 
-        return best_outcomes
+    def _set_contributing(self, submission_id, contributing):
+        """Add or remove the outcomes of a submission from the ones
+        that determine the best outcomes.
+
+        submission_id (int): the submission.
+        contributing (bool): whether it has to contribute.
+
+        """
+        if contributing == (submission_id in self.contributing):
+            return
+        for idx, outcome in self._get_outcomes(submission_id).iteritems():
+            if contributing:
+                self.outcomes[idx].add(outcome)
+            else:
+                self.outcomes[idx].remove(outcome)
+        if contributing:
+            self.contributing.add(submission_id)
+        else:
+            self.contributing.remove(submission_id)
+
+    def _update_user_score(self, username):
+        """Recompute the score of a user from the scores of its
+        submissions.
+
+        username (string): the user.
+        return (bool): whether the score changed.
+
+        """
+        submission_ids = self.submissions.get(username, [])
+        score = 0.0
+        for submission_id in submission_ids:
+            if self.pool[submission_id]["tokened"]:
+                score = max(score, self.pool[submission_id]["score"])
+        if submission_ids != []:
+            score = max(score, self.pool[submission_ids[-1]]["score"])
+
+        changed = self.scores.get(username) != score
+        self.scores[username] = score
+        return changed
 
     def update_scores(self, new_submission_id):
         """Update the scores of the contest assuming that only this
-        submission appeared.
+        submission appeared or was tokened.
 
-        new_submission_id (int): id of the newly added submission.
-
-        best_outcomes (list):
+        See the same method in ScoreType for details.
 
         """
-        # If we just computed best_outcomes in compute_score, we don't
-        # compute it again.
-        if self.best_outcomes is None:
-            best_outcomes = self.compute_best_outcomes()
-        else:
-            best_outcomes = self.best_outcomes
-            self.best_outcomes = None
-
-        # Then, we update the score for each submission, and we update
-        # the users' scores.
-        for username in self.submissions:
-            submissions = self.submissions[username]
-            score = 0.0
-            for submission_id in submissions:
-                self.pool[submission_id]["score"] = \
-                    sum([float(x) / y for x, y
-                         in zip(self.pool[submission_id]["evaluations"],
-                                best_outcomes)]) * self.parameters[0]
-                if self.pool[submission_id]["tokened"] is not None:
-                    score = max(score, self.pool[submission_id]["score"])
-            if submissions != []:
-                score = max(score, self.pool[submissions[-1]]["score"])
-            self.scores[username] = score
+        username = self.pool[new_submission_id]["username"]
+
+        # The first time we see the submission we index it.
+        for idx, outcome in \
+                self._get_outcomes(new_submission_id).iteritems():
+            if outcome > 0.0:
+                self.dependent[idx].add(new_submission_id)
+
+        # Update the set of contributing submissions: the new one if
+        # it is tokened, and the last one of the user (which may not
+        # be the new one if it arrived out of order).
+        old_last = self.last.get(username)
+        new_last = self.submissions[username][-1]
+        self.last[username] = new_last
+        for submission_id in set([old_last, new_last, new_submission_id]):
+            if submission_id is not None:
+                self._set_contributing(
+                    submission_id,
+                    self.pool[submission_id]["tokened"] or
+                    submission_id == new_last)
+
+        # Find the testcases whose best outcome changed, and the
+        # submissions whose score depends on them.
+        to_rescore = set([new_submission_id])
+        for idx in self.indices:
+            best = self.outcomes[idx].max()
+            if best != self.best_outcomes[idx]:
+                self.best_outcomes[idx] = best
+                to_rescore |= self.dependent[idx]
+
+        changed_submissions = set()
+        users_to_update = set([username])
+        for submission_id in to_rescore:
+            submission = self.pool[submission_id]
+            old_score = submission["score"]
+            submission["score"], \
+                submission["details"], \
+                submission["public_score"], \
+                submission["public_details"], \
+                submission["ranking_details"] = \
+                self.compute_score(submission_id)
+            if submission_id != new_submission_id and \
+                    submission["score"] != old_score:
+                changed_submissions.add(submission_id)
+                users_to_update.add(submission["username"])
+
+        for user in users_to_update:
+            self._update_user_score(user)
+
+        return changed_submissions
 
     def max_scores(self):
         """Compute the maximum score of a submission. FIXME: this
@@ -119,28 +247,64 @@ class Relative(ScoreType):
         """
         public_score = 0.0
         score = 0.0
-        for public in self.public_testcases:
+        for public in self.public_testcases.itervalues():
             score += self.parameters[0]
             if public:
                 public_score += self.parameters[0]
-        return round(score, 2), round(public_score, 2)
+        return score, public_score
 
     def compute_score(self, submission_id):
-        """Compute the score of a submission.
+        """Compute the score of a submission with respect to the
+        current best outcomes.
 
-        submission_id (int): the submission to evaluate.
-        returns (float): the score
+        See the same method in ScoreType for details.
 
         """
-        self.best_outcomes = self.compute_best_outcomes()
+        if not self.pool[submission_id]["evaluated"]:
+            return 0.0, "[]", 0.0, "[]", []
+
+        evaluations = self.pool[submission_id]["evaluations"]
+        outcomes = self._get_outcomes(submission_id)
+        testcases = []
+        public_testcases = []
         score = 0.0
         public_score = 0.0
-        for public, evaluation, best in zip(
-            self.public_testcases,
-            self.pool[submission_id]["evaluations"],
-            self.best_outcomes):
-            to_add = float(evaluation) / best * self.parameters[0]
-            score += to_add
-            if public:
-                public_score += to_add
-        return round(score, 2), None, round(public_score, 2), None
+
+        for idx in self.indices:
+            best = self.best_outcomes[idx]
+            if best is None or best <= 0.0:
+                this_score = 0.0
+            else:
+                this_score = outcomes[idx] / best * self.parameters[0]
+            score += this_score
+            testcases.append({
+                "idx": idx,
+                "outcome": self.get_public_outcome(this_score),
+                "text": evaluations[idx]["text"],
+                "time": evaluations[idx]["time"],
+                "memory": evaluations[idx]["memory"],
+                })
+            if self.public_testcases[idx]:
+                public_score += this_score
+                public_testcases.append(testcases[-1])
+            else:
+                public_testcases.append({"idx": idx})
+
+        return score, json.dumps(testcases), \
+               public_score, json.dumps(public_testcases), \
+               []
+
+    def get_public_outcome(self, outcome):
+        """Return a public outcome from an outcome.
+
+        outcome (float): the score of the submission in a testcase.
+
+        return (float): the public output.
+
+        """
+        if outcome <= 0.0:
+            return "Not correct"
+        elif outcome >= self.parameters[0]:
+            return "Correct"
+        else:
+            return "Partially correct"
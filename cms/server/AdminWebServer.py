@@ -30,8 +30,10 @@ import traceback
 
 import base64
 import re
+import urllib
 import simplejson as json
-from sqlalchemy.orm import joinedload
+from sqlalchemy import and_, or_, func
+from sqlalchemy.orm import joinedload, subqueryload, contains_eager
 from sqlalchemy.exc import IntegrityError
 import tornado.web
 import tornado.locale
@@ -44,13 +46,17 @@ from cms.db.SQLAlchemyAll import Session, \
     Contest, User, Announcement, Question, Message, Submission, \
     SubmissionResult, Evaluation, Executable, File, Task, Dataset, \
     Attachment, Manager, Testcase, SubmissionFormatElement, Statement
-from cms.grading import compute_changes_for_dataset
+from cms.grading import compute_changes_for_dataset, compute_ranking
 from cms.grading.tasktypes import get_task_type
 from cms.server import file_handler_gen, get_url_root, \
     CommonRequestHandler
 from cmscommon.DateTime import make_datetime, make_timestamp
 
 
+# How many submissions the lists show in a page.
+SUBMISSIONS_PER_PAGE = 50
+
+
 def try_commit(session, handler):
     """Try to commit the session, if not successful display a warning
     in the webpage.
@@ -72,6 +78,7 @@ def try_commit(session, handler):
         handler.application.service.add_notification(
             make_datetime(),
             "Operation successful.", "")
+        handler.application.service.invalidate_contest_caches()
         return True
 
 
@@ -232,6 +239,149 @@ class BaseHandler(CommonRequestHandler):
                 self.write("A critical error has occurred :-(")
                 self.finish()
 
+    def get_submission_page(self, criterion, dataset_id):
+        """Return a page of the submissions matching criterion, the
+        newest first, as chosen by the arguments of the request:
+        before or after (the id of the submission the page starts
+        from, going backward or forward in time), status, username,
+        min_score and max_score.
+
+        The page is found with a condition on (timestamp, id), so that
+        indexes on the columns used in criterion and the timestamp
+        make it cheap wherever the page is.
+
+        criterion (ClauseElement): which submissions to consider (e.g.,
+                                   Submission.task_id == 1).
+        dataset_id (int/ColumnElement): the dataset whose results
+                                        we show (e.g.,
+                                        Task.active_dataset_id).
+
+        return (dict): "submissions" is the list of (Submission,
+                       SubmissionResult or None), "total" the number
+                       of submissions matching criterion, "filters"
+                       the active filters, "newer_url" and "older_url"
+                       the query strings of the adjacent pages (or
+                       None).
+
+        """
+        query = self.sql_session.query(Submission, SubmissionResult)\
+            .join(Submission.task)\
+            .join(Submission.user)\
+            .outerjoin(SubmissionResult, and_(
+                SubmissionResult.submission_id == Submission.id,
+                SubmissionResult.dataset_id == dataset_id))\
+            .filter(criterion)\
+            .options(contains_eager(Submission.task))\
+            .options(contains_eager(Submission.user))\
+            .options(joinedload(Submission.token))\
+            .options(subqueryload(Submission.files))
+        total = self.sql_session.query(func.count(Submission.id))\
+            .filter(criterion).scalar()
+
+        filters = dict()
+        status = self.get_argument("status", "")
+        if status == "compiling":
+            query = query.filter(or_(
+                SubmissionResult.submission_id == None,
+                SubmissionResult.compilation_outcome == None))
+        elif status == "failed":
+            query = query.filter(
+                SubmissionResult.compilation_outcome == "fail")
+        elif status == "evaluating":
+            query = query\
+                .filter(SubmissionResult.compilation_outcome == "ok")\
+                .filter(SubmissionResult.evaluation_outcome == None)
+        elif status == "scoring":
+            query = query\
+                .filter(SubmissionResult.evaluation_outcome != None)\
+                .filter(SubmissionResult.score == None)
+        elif status == "scored":
+            query = query.filter(SubmissionResult.score != None)
+        else:
+            status = ""
+        if status != "":
+            filters["status"] = status
+
+        username = self.get_argument("username", "")
+        if username != "":
+            query = query.filter(User.username == username)
+            filters["username"] = username
+
+        try:
+            min_score = float(self.get_argument("min_score", ""))
+        except ValueError:
+            pass
+        else:
+            query = query.filter(SubmissionResult.score >= min_score)
+            filters["min_score"] = self.get_argument("min_score")
+        try:
+            max_score = float(self.get_argument("max_score", ""))
+        except ValueError:
+            pass
+        else:
+            query = query.filter(SubmissionResult.score <= max_score)
+            filters["max_score"] = self.get_argument("max_score")
+
+        # Keep what we show ordered by (timestamp, id), descending.
+        older = True
+        cursor = None
+        for name in ["before", "after"]:
+            try:
+                cursor_id = int(self.get_argument(name, ""))
+            except ValueError:
+                continue
+            timestamp = self.sql_session.query(Submission.timestamp)\
+                .filter(Submission.id == cursor_id).scalar()
+            if timestamp is not None:
+                older = name == "before"
+                cursor = (timestamp, cursor_id)
+                break
+
+        if cursor is not None:
+            timestamp, cursor_id = cursor
+            if older:
+                query = query.filter(or_(
+                    Submission.timestamp < timestamp,
+                    and_(Submission.timestamp == timestamp,
+                         Submission.id < cursor_id)))
+            else:
+                query = query.filter(or_(
+                    Submission.timestamp > timestamp,
+                    and_(Submission.timestamp == timestamp,
+                         Submission.id > cursor_id)))
+        if older:
+            query = query.order_by(Submission.timestamp.desc(),
+                                   Submission.id.desc())
+        else:
+            query = query.order_by(Submission.timestamp.asc(),
+                                   Submission.id.asc())
+
+        # One more, to know whether there is another page.
+        rows = query.limit(SUBMISSIONS_PER_PAGE + 1).all()
+        more = len(rows) > SUBMISSIONS_PER_PAGE
+        rows = rows[:SUBMISSIONS_PER_PAGE]
+        if not older:
+            rows.reverse()
+
+        def page_url(name, submission):
+            params = dict(filters)
+            params[name] = submission.id
+            return "?" + urllib.urlencode(sorted(params.items()))
+
+        newer_url = None
+        older_url = None
+        if len(rows) > 0:
+            if (older and cursor is not None) or (not older and more):
+                newer_url = page_url("after", rows[0][0])
+            if (older and more) or not older:
+                older_url = page_url("before", rows[-1][0])
+
+        return {"submissions": rows,
+                "total": total,
+                "filters": filters,
+                "newer_url": newer_url,
+                "older_url": older_url}
+
     def get_non_negative_int(self, argument_name, default, allow_empty=True):
         """ Get a non-negative integer from the arguments.
 
@@ -305,6 +455,10 @@ class AdminWebServer(WebService):
             self.resource_services.append(self.connect_to(
                 ServiceCoord("ResourceService", i)))
         self.logservice = self.connect_to(ServiceCoord("LogService", 0))
+        self.contest_web_servers = []
+        for i in xrange(get_service_shards("ContestWebServer")):
+            self.contest_web_servers.append(self.connect_to(
+                ServiceCoord("ContestWebServer", i)))
 
     @staticmethod
     def authorized_rpc(service, method, arguments):
@@ -348,6 +502,24 @@ class AdminWebServer(WebService):
         """
         self.notifications.append((timestamp, subject, text))
 
+    def invalidate_contest_caches(self):
+        """Tell the ContestWebServers that some data changed, so that
+        they drop the copies they keep in memory.
+
+        """
+        for contest_web_server in self.contest_web_servers:
+            contest_web_server.invalidate_cache()
+
+    def notifications_changed(self, username=None):
+        """Tell the ContestWebServers that there is something new for
+        a user, or for all users, so that they can push it at once.
+
+        username (string): the user, or None for all of them.
+
+        """
+        for contest_web_server in self.contest_web_servers:
+            contest_web_server.notifications_changed(username=username)
+
 
 class MainHandler(BaseHandler):
     """Home page handler, with queue and workers statuses.
@@ -1415,10 +1587,9 @@ class TaskHandler(BaseHandler):
 
         self.r_params = self.render_params()
         self.r_params["task"] = task
-        self.r_params["submissions"] = \
-            self.sql_session.query(Submission)\
-                .join(Task).filter(Task.id == task_id)\
-                .order_by(Submission.timestamp.desc()).all()
+        self.r_params["submission_count"] = \
+            self.sql_session.query(func.count(Submission.id))\
+                .filter(Submission.task_id == task.id).scalar()
         self.render("task.html", **self.r_params)
 
     def post(self, task_id):
@@ -1566,10 +1737,8 @@ class DatasetSubmissionsHandler(BaseHandler):
             self.sql_session.query(Dataset)\
                             .filter(Dataset.task == task)\
                             .order_by(Dataset.description).all()
-        self.r_params["submissions"] = \
-            self.sql_session.query(Submission)\
-                            .filter(Submission.task == task)\
-                            .order_by(Submission.timestamp.desc()).all()
+        self.r_params["page"] = self.get_submission_page(
+            Submission.task_id == task.id, dataset.id)
         self.render("submissionlist.html", **self.r_params)
 
 
@@ -1581,6 +1750,8 @@ class RankingHandler(BaseHandler):
         self.contest = self.safe_get_item(Contest, contest_id)
 
         self.r_params = self.render_params()
+        self.r_params["ranking"] = compute_ranking(self.contest,
+                                                   self.sql_session)
         if format == "txt":
             self.set_header("Content-Type", "text/plain")
             self.set_header("Content-Disposition",
@@ -1608,7 +1779,8 @@ class AddAnnouncementHandler(BaseHandler):
             ann = Announcement(make_datetime(), subject, text,
                                contest=self.contest)
             self.sql_session.add(ann)
-            try_commit(self.sql_session, self)
+            if try_commit(self.sql_session, self):
+                self.application.service.notifications_changed()
         self.redirect("/announcements/%s" % contest_id)
 
 
@@ -1637,7 +1809,8 @@ class UserViewHandler(BaseHandler):
 
         self.r_params = self.render_params()
         self.r_params["selected_user"] = user
-        self.r_params["submissions"] = user.submissions
+        self.r_params["page"] = self.get_submission_page(
+            Submission.user_id == user.id, Task.active_dataset_id)
         self.render("user.html", **self.r_params)
 
     def post(self, user_id):
@@ -1885,6 +2058,8 @@ class QuestionReplyHandler(BaseHandler):
         if try_commit(self.sql_session, self):
             logger.info("Reply sent to user %s for question with id %s." %
                         (question.user.username, question_id))
+            self.application.service.notifications_changed(
+                question.user.username)
 
         self.redirect(ref)
 
@@ -1930,12 +2105,15 @@ class MessageHandler(BaseHandler):
         if try_commit(self.sql_session, self):
             logger.info("Message submitted to user %s."
                         % user.username)
+            self.application.service.notifications_changed(user.username)
 
         self.redirect("/user/%s" % user_id)
 
 
 class FileFromDigestHandler(FileHandler):
 
+    immutable = True
+
     @tornado.web.asynchronous
     def get(self, digest, filename):
         #TODO: Accept a MIME type
@@ -1956,6 +2134,7 @@ class NotificationsHandler(BaseHandler):
         questions = self.sql_session.query(Question)\
             .filter(Question.reply_timestamp == None)\
             .filter(Question.question_timestamp > last_notification)\
+            .options(joinedload(Question.user))\
             .all()
 
         for question in questions:
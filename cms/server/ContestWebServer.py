@@ -37,40 +37,321 @@
 
 import os
 import re
+import bisect
 import pickle
 import codecs
 
 import base64
 import simplejson as json
 import tempfile
+import time
 import traceback
+from collections import deque
 from datetime import timedelta
+from functools import partial
 from urllib import quote
 import gettext
 
 import tornado.web
+import tornado.netutil
+import tornado.process
 
 from sqlalchemy import func
+from sqlalchemy.orm import joinedload, subqueryload
 
-from cms import LANGUAGES_MAP, config, default_argument_parser, logger
+from cms import LANGUAGES_MAP, config, default_argument_parser, logger, \
+    mkdir
+from cms.async.AsyncLibrary import rpc_method
 from cms.async.WebAsyncLibrary import WebService
-from cms.async import ServiceCoord
+from cms.async import ServiceCoord, get_service_shards
 from cms.db import ask_for_contest
 from cms.db.FileCacher import FileCacher
-from cms.db.SQLAlchemyAll import Session, Contest, User, Task, \
-    Question, Submission, Token, File, UserTest, UserTestFile, \
+from cms.db.SQLAlchemyAll import db, Session, Contest, User, Task, \
+    Question, Message, Submission, Token, File, UserTest, UserTestFile, \
     UserTestManager
 from cms.grading.tasktypes import get_task_type
 from cms.grading.scoretypes import get_score_type
-from cms.server import file_handler_gen, extract_archive, \
+from cms.server import file_handler_gen, extract_archive, read_archive, \
     actual_phase_required, get_url_root, filter_ascii, \
-    CommonRequestHandler
+    CommonRequestHandler, WorkerPool
+from cms.server.SharedState import MemoryState, SQLiteState
 from cmscommon import ISOCodes
 from cmscommon.Cryptographics import encrypt_number
 from cmscommon.DateTime import make_datetime, make_timestamp, get_timezone
 from cmscommon.MimeTypes import get_type_for_file_name
 
 
+def get_token_status(obj):
+    """Return the status of the tokens for the given object.
+
+    obj (Contest or Task): an object that has the token_* attributes.
+    return (int): one of 0 (disabled), 1 (enabled/finite) and 2
+                  (enabled/infinite).
+
+    """
+    if obj.token_initial is None:
+        return 0
+    elif obj.token_gen_number and not obj.token_gen_time:
+        return 2
+    else:
+        return 1
+
+
+def get_token_summary(contest):
+    """Summarize the token configuration of a contest, for the
+    templates.
+
+    contest (Contest): the contest, with its tasks.
+    return (tuple): the values of tokens_contest and tokens_tasks
+                    (see BaseHandler.render_params).
+
+    """
+    tokens_contest = get_token_status(contest)
+    if tokens_contest == 2 and not contest.token_min_interval:
+        tokens_contest = 3  # infinite and no min_interval
+
+    t_tokens = sum(get_token_status(t) for t in contest.tasks)
+    if t_tokens == 0:
+        tokens_tasks = 0  # all disabled
+    elif t_tokens == 2 * len(contest.tasks):
+        tokens_tasks = 2  # all infinite
+    else:
+        tokens_tasks = 1  # all finite or mixed
+    if tokens_tasks == 2 and \
+        all(t.token_min_interval <= contest.token_min_interval
+            for t in contest.tasks):
+        tokens_tasks = 3  # all infinite and no min_intervals
+
+    return tokens_contest, tokens_tasks
+
+
+class ContestCache:
+    """Keep in memory the data of the contest that rarely changes (its
+    configuration, the tasks with their active datasets, statements,
+    attachments and submission formats, the announcements) and the
+    users, so that handlers don't have to load them for each request.
+
+    The objects are kept detached from any session and each request
+    gets its own copies with session.merge(load=False), which doesn't
+    hit the database. Everything else (e.g., submissions, questions,
+    messages) is loaded from the copies as usual. The announcements
+    are also kept, sorted by time, in the format sent to the clients,
+    so that NotificationsHandler doesn't need the database for them.
+
+    AWS calls ContestWebServer.invalidate_cache whenever an admin
+    changes something, and the cache is also reloaded every MAX_AGE
+    seconds, to pick up the changes made by other means (e.g., by the
+    command line tools). The version is increased at each
+    invalidation.
+
+    """
+
+    # Maximum time (in seconds) we keep the data without reloading it.
+    MAX_AGE = 60.0
+
+    def __init__(self, contest_id):
+        """Create an empty cache.
+
+        contest_id (int): the id of the contest to cache.
+
+        """
+        self.contest_id = contest_id
+        self.version = 0
+
+        self._contest = None
+        self._token_summary = None
+        self._announcements = []
+        self._announcement_times = []
+        self._users = {}
+        self._loaded_at = None
+
+    def invalidate(self, username=None):
+        """Drop the cached data.
+
+        username (string): if given, drop only the data of this user.
+
+        """
+        if username is not None:
+            self._users.pop(username, None)
+            return
+        self.version += 1
+        self._contest = None
+        self._token_summary = None
+        self._announcements = []
+        self._announcement_times = []
+        self._users = {}
+        self._loaded_at = None
+
+    def _load(self):
+        """Load the contest (and what comes with it) from the
+        database, if it isn't cached or it is too old.
+
+        """
+        if self._loaded_at is not None and \
+                time.time() - self._loaded_at <= ContestCache.MAX_AGE:
+            return
+
+        self.invalidate()
+        session = Session()
+        try:
+            self._contest = session.query(Contest)\
+                .filter(Contest.id == self.contest_id)\
+                .options(subqueryload("announcements"))\
+                .options(subqueryload("tasks"))\
+                .options(joinedload("tasks.active_dataset"))\
+                .options(subqueryload("tasks.statements"))\
+                .options(subqueryload("tasks.attachments"))\
+                .options(subqueryload("tasks.submission_format"))\
+                .one()
+            self._token_summary = get_token_summary(self._contest)
+            for announcement in self._contest.announcements:
+                self._announcement_times.append(announcement.timestamp)
+                self._announcements.append({
+                    "type": "announcement",
+                    "timestamp": make_timestamp(announcement.timestamp),
+                    "subject": announcement.subject,
+                    "text": announcement.text})
+            session.expunge_all()
+        finally:
+            session.close()
+        self._loaded_at = time.time()
+        logger.debug("Contest data loaded (version %d)." % self.version)
+
+    def get_contest(self, session):
+        """Return the contest, attached to the given session.
+
+        session (Session): the session of the request.
+        return (Contest): the contest.
+
+        """
+        self._load()
+        return session.merge(self._contest, load=False)
+
+    def get_token_summary(self):
+        """Return the token configuration of the contest.
+
+        return (tuple): see get_token_summary.
+
+        """
+        self._load()
+        return self._token_summary
+
+    def get_announcements(self, after, before):
+        """Return the announcements made in the given interval.
+
+        after (datetime): the (excluded) beginning of the interval.
+        before (datetime): the (excluded) end of the interval.
+        return ([dict]): the announcements, as sent to the clients.
+
+        """
+        self._load()
+        begin = bisect.bisect_right(self._announcement_times, after)
+        end = bisect.bisect_left(self._announcement_times, before)
+        return self._announcements[begin:end]
+
+    def get_user(self, session, username):
+        """Return a user of the contest, attached to the given session.
+        Has to be called after get_contest for the same session.
+
+        session (Session): the session of the request.
+        username (string): the username of the user.
+        return (User): the user, or None if not found.
+
+        """
+        self._load()
+        if username not in self._users:
+            user_session = Session()
+            try:
+                user = user_session.query(User)\
+                    .filter(User.contest_id == self.contest_id)\
+                    .filter(User.username == username).first()
+                user_session.expunge_all()
+            finally:
+                user_session.close()
+            if user is None:
+                # We don't cache misses, as there could be many.
+                return None
+            self._users[username] = user
+        return session.merge(self._users[username], load=False)
+
+
+class SubmissionCounters:
+    """Keep, for each user, the number of submissions on each task and
+    the time of the last one, to enforce the limits on submissions
+    without querying the database each time.
+
+    The data of a user is loaded at their first submission and then
+    kept, in the shared state of the shard (so that all its processes
+    see the same counters), up to date by SubmitHandler, that is the
+    only one creating submissions. Each shard has its own counters,
+    hence a user should always be served by the same one (e.g., using
+    ip_hash in nginx).
+
+    """
+    def __init__(self, shared_state):
+        """Create the counters.
+
+        shared_state (MemoryState|SQLiteState): where to keep them.
+
+        """
+        self._state = shared_state
+
+    def get(self, user_id):
+        """Return the counters of a user.
+
+        user_id (int): the id of the user.
+        return (dict): pairs [number of submissions, time of the last
+                       one] indexed by task id.
+
+        """
+        counters = self._state.get_counters(user_id)
+        while counters is None:
+            session = Session()
+            try:
+                rows = session.query(Submission.task_id,
+                                     func.count(Submission.id),
+                                     func.max(Submission.timestamp))\
+                    .filter(Submission.user_id == user_id)\
+                    .group_by(Submission.task_id).all()
+            finally:
+                session.close()
+            self._state.load_counters(user_id, dict(
+                (task_id, [count, last]) for task_id, count, last in rows))
+            counters = self._state.get_counters(user_id)
+        return counters
+
+    def add(self, user_id, task_id, timestamp, check):
+        """Count a new submission, if the limits allow it.
+
+        user_id (int): the id of the user.
+        task_id (int): the id of the task.
+        timestamp (datetime): the time of the submission.
+        check (callable): called with the counters of the user (as
+                          returned by get), returns None if the
+                          submission is within the limits.
+        return (object): what check returned; the submission has
+                         been counted if it is None.
+
+        """
+        while True:
+            self.get(user_id)
+            try:
+                return self._state.add_submission(user_id, task_id,
+                                                  timestamp, check)
+            except KeyError:
+                # Another process reset the counters in the meantime.
+                pass
+
+    def invalidate(self, user_id):
+        """Forget the counters of a user, e.g., because a submission
+        we counted has not been stored.
+
+        user_id (int): the id of the user.
+
+        """
+        self._state.reset_counters(user_id)
+
+
 class BaseHandler(CommonRequestHandler):
     """Base RequestHandler for this application.
 
@@ -93,8 +374,8 @@ class BaseHandler(CommonRequestHandler):
         self.set_header("Cache-Control", "no-cache, must-revalidate")
 
         self.sql_session = Session()
-        self.contest = Contest.get_from_id(self.application.service.contest,
-                                           self.sql_session)
+        self.contest = self.application.service.contest_cache.get_contest(
+            self.sql_session)
 
         self._ = self.locale.translate
 
@@ -123,9 +404,8 @@ class BaseHandler(CommonRequestHandler):
             self.clear_cookie("login")
             return None
 
-        user = self.sql_session.query(User)\
-            .filter(User.contest == self.contest)\
-            .filter(User.username == username).first()
+        user = self.application.service.contest_cache.get_user(
+            self.sql_session, username)
         if user is None:
             self.clear_cookie("login")
             return None
@@ -191,8 +471,10 @@ class BaseHandler(CommonRequestHandler):
             cms_locale.add_fallback(iso_639_locale)
             cms_locale.add_fallback(iso_3166_locale)
             cms_locale.add_fallback(shared_mime_info_locale)
+            cms_locale.code = ",".join(locales)
         else:
             cms_locale = gettext.NullTranslations()
+            cms_locale.code = ""
 
         # Add translate method to simulate tornado.Locale's interface
         def translate(message, plural_message=None, count=None):
@@ -205,22 +487,6 @@ class BaseHandler(CommonRequestHandler):
 
         return cms_locale
 
-    @staticmethod
-    def _get_token_status(obj):
-        """Return the status of the tokens for the given object.
-
-        obj (Contest or Task): an object that has the token_* attributes.
-        return (int): one of 0 (disabled), 1 (enabled/finite) and 2
-                      (enabled/infinite).
-
-        """
-        if obj.token_initial is None:
-            return 0
-        elif obj.token_gen_number and not obj.token_gen_time:
-            return 2
-        else:
-            return 1
-
     def render_params(self):
         """Return the default render params used by almost all handlers.
 
@@ -232,6 +498,7 @@ class BaseHandler(CommonRequestHandler):
         ret["contest"] = self.contest
         ret["url_root"] = get_url_root(self.request.path)
         ret["cookie"] = str(self.cookies)  # FIXME really needed?
+        ret["notifications_push"] = config.notifications_push
 
         ret["phase"] = self.contest.phase(self.timestamp)
 
@@ -305,21 +572,8 @@ class BaseHandler(CommonRequestHandler):
             ret["timezone"] = get_timezone(self.current_user, self.contest)
 
         # some information about token configuration
-        ret["tokens_contest"] = self._get_token_status(self.contest)
-        if ret["tokens_contest"] == 2 and not self.contest.token_min_interval:
-            ret["tokens_contest"] = 3  # infinite and no min_interval
-
-        t_tokens = sum(self._get_token_status(t) for t in self.contest.tasks)
-        if t_tokens == 0:
-            ret["tokens_tasks"] = 0  # all disabled
-        elif t_tokens == 2 * len(self.contest.tasks):
-            ret["tokens_tasks"] = 2  # all infinite
-        else:
-            ret["tokens_tasks"] = 1  # all finite or mixed
-        if ret["tokens_tasks"] == 2 and \
-            all(t.token_min_interval <= self.contest.token_min_interval
-                for t in self.contest.tasks):
-            ret["tokens_tasks"] = 3  # all infinite and no min_intervals
+        ret["tokens_contest"], ret["tokens_tasks"] = \
+            self.application.service.contest_cache.get_token_summary()
 
         return ret
 
@@ -368,16 +622,59 @@ class ContestWebServer(WebService):
     """Service that runs the web server serving the contestants.
 
     """
+
+    # Number of threads storing the submissions.
+    STORAGE_THREADS = 4
+
     def __init__(self, shard, contest):
-        logger.initialize(ServiceCoord("ContestWebServer", shard))
         self.contest = contest
+        self.contest_cache = ContestCache(contest)
+
+        # With more than one worker, we bind the port and then fork
+        # (the parent process just restarts the workers that die).
+        # Only the first worker accepts RPCs, and the state that
+        # needs to be seen by all of them goes through SQLite. The
+        # logger is initialized after forking, so that each worker
+        # has its own log file and connection to LogService.
+        sockets = None
+        self.worker = 0
+        if config.contest_workers > 1:
+            sockets = tornado.netutil.bind_sockets(
+                config.contest_listen_port[shard],
+                address=config.contest_listen_address[shard])
+            mkdir(config.data_dir)
+            state_path = os.path.join(config.data_dir,
+                                      "cws-state-%d.sqlite" % shard)
+            SQLiteState.reset(state_path)
+            self.parent_pid = os.getpid()
+            self.worker = tornado.process.fork_processes(
+                config.contest_workers)
+            # The connections in the pool (e.g., the one used by
+            # ask_for_contest) have been opened by the parent: each
+            # worker needs its own.
+            db.dispose()
+            logger.initialize(ServiceCoord("ContestWebServer", shard),
+                              self.worker)
+            self.shared_state = SQLiteState(state_path, self.worker)
+        else:
+            logger.initialize(ServiceCoord("ContestWebServer", shard))
+            self.shared_state = MemoryState()
+
+        # The shared state keeps the pending notifications of each
+        # user. Things like "Yay, your submission went through.", not
+        # things like "Your question has been replied", that are
+        # handled by the db.
+
+        # For each username, the callbacks of the requests waiting for
+        # new notifications.
+        self.notification_waiters = {}
 
-        # This is a dictionary (indexed by username) of pending
-        # notification. Things like "Yay, your submission went
-        # through.", not things like "Your question has been replied",
-        # that are handled by the db. Each username points to a list
-        # of tuples (timestamp, subject, text).
-        self.notifications = {}
+        # For each user id, the most recent changes of the status of
+        # their submissions, as (sequence number, task id), and the
+        # callbacks of the requests waiting for the next change.
+        self.status_seq = 0
+        self.status_changes = {}
+        self.status_waiters = {}
 
         parameters = {
             "login_url": "/",
@@ -395,12 +692,29 @@ class ContestWebServer(WebService):
             _cws_handlers,
             parameters,
             shard=shard,
-            listen_address=config.contest_listen_address[shard])
+            listen_address=config.contest_listen_address[shard],
+            sockets=sockets,
+            rpc_server=self.worker == 0)
+        self.shared_state.start(self.instance, self._on_event)
+        if config.contest_workers > 1:
+            self.add_timeout(self._check_parent, None, 1.0)
         self.file_cacher = FileCacher(self)
+        # Submissions are stored by some threads, using a FileCacher
+        # of their own (that doesn't run the service loop).
+        self.submission_counters = SubmissionCounters(self.shared_state)
+        self.storage_file_cacher = FileCacher()
+        self.storage_workers = WorkerPool(
+            self.instance, ContestWebServer.STORAGE_THREADS)
         self.evaluation_service = self.connect_to(
             ServiceCoord("EvaluationService", 0))
         self.scoring_service = self.connect_to(
             ServiceCoord("ScoringService", 0))
+        # The other shards, to tell them when we change a user.
+        self.contest_web_servers = []
+        for i in xrange(get_service_shards("ContestWebServer")):
+            if i != shard:
+                self.contest_web_servers.append(self.connect_to(
+                    ServiceCoord("ContestWebServer", i)))
 
     @staticmethod
     def authorized_rpc(service, method, arguments):
@@ -431,9 +745,156 @@ class ContestWebServer(WebService):
         level (string): one of NOTIFICATION_* (defined above)
 
         """
-        if username not in self.notifications:
-            self.notifications[username] = []
-        self.notifications[username].append((timestamp, subject, text, level))
+        self.shared_state.add_notification(
+            username, (timestamp, subject, text, level))
+        self.shared_state.publish("notify", [username])
+
+    @rpc_method
+    def notifications_changed(self, username=None):
+        """Called by AWS when there is something new for a user (a
+        message, a reply) or for all of them (an announcement), to
+        wake up the requests waiting for notifications.
+
+        username (string): the user, or None for all of them.
+
+        """
+        self.shared_state.publish("notify", [username])
+
+    def _on_event(self, seq, kind, args, own):
+        """Apply an event of the shared state (see SharedState).
+
+        """
+        if kind == "notify":
+            self._wake_notification_waiters(*args)
+        elif kind == "invalidate":
+            self.contest_cache.invalidate(*args)
+        elif kind == "status":
+            self._add_status_change(seq, *args)
+
+    def _check_parent(self):
+        """Exit if the parent process died, as nobody would restart
+        us anymore.
+
+        """
+        if os.getppid() != self.parent_pid:
+            logger.error("Parent process died, exiting.")
+            self.exit()
+            return False
+        return True
+
+    def _wake_notification_waiters(self, username):
+        """Wake up the requests waiting for notifications for a
+        user, or for all of them if username is None.
+
+        """
+        if username is None:
+            waiters = self.notification_waiters
+            self.notification_waiters = {}
+            callbacks = sum(waiters.itervalues(), [])
+        else:
+            callbacks = self.notification_waiters.pop(username, [])
+        for callback in callbacks:
+            callback()
+
+    def add_notification_waiter(self, username, callback):
+        self.notification_waiters.setdefault(username, []).append(callback)
+
+    def remove_notification_waiter(self, username, callback):
+        waiters = self.notification_waiters.get(username, [])
+        if callback in waiters:
+            waiters.remove(callback)
+        if not waiters:
+            self.notification_waiters.pop(username, None)
+
+    @rpc_method
+    def invalidate_cache(self, username=None):
+        """Called by AWS (and by the other shards) when the data of
+        the contest changed, to drop the cached copy.
+
+        username (string): if given, only the data of this user
+                           changed.
+
+        """
+        logger.debug("Invalidating cached data (user %s)." % username)
+        self.shared_state.publish("invalidate", [username])
+
+    def user_changed(self, username):
+        """Drop the cached data of a user we changed, here and in the
+        other shards.
+
+        username (string): the user.
+
+        """
+        self.contest_cache.invalidate(username)
+        self.shared_state.publish("invalidate", [username])
+        for contest_web_server in self.contest_web_servers:
+            contest_web_server.invalidate_cache(username=username)
+
+    # How many changes we remember for each user.
+    STATUS_CHANGES_PER_USER = 100
+
+    @rpc_method
+    def submission_status_changed(self, user_id, task_id):
+        """Called by ES and SS when the status of a submission (as
+        shown to the contestant) changed, to wake up the pages waiting
+        for it.
+
+        user_id (int): the owner of the submission.
+        task_id (int): the task of the submission.
+
+        """
+        self.shared_state.publish("status", [user_id, task_id])
+
+    def _add_status_change(self, seq, user_id, task_id):
+        """Record a change of the status of a submission, and wake
+        up the requests waiting for it.
+
+        seq (int): the sequence number of the change.
+        user_id (int): the owner of the submission.
+        task_id (int): the task of the submission.
+
+        """
+        self.status_seq = seq
+        if user_id not in self.status_changes:
+            self.status_changes[user_id] = deque(
+                maxlen=ContestWebServer.STATUS_CHANGES_PER_USER)
+        self.status_changes[user_id].append((self.status_seq, task_id))
+
+        for callback in self.status_waiters.pop(user_id, []):
+            callback()
+
+    def get_status_changes(self, user_id, cursor):
+        """Return the changes of the status of the submissions of a
+        user after a given point.
+
+        user_id (int): the user.
+        cursor (int): the sequence number of the last change known,
+                      or None.
+
+        return (tuple): the new cursor and the list of the ids of the
+                        tasks with changes, or None if there are no
+                        changes after cursor.
+
+        """
+        changes = self.status_changes.get(user_id, [])
+        if cursor is None or cursor > self.status_seq:
+            # The client knows nothing, or its cursor comes from
+            # another run: it has to reload everything anyway.
+            return self.status_seq, []
+        tasks = set(task_id for seq, task_id in changes if seq > cursor)
+        if not tasks:
+            return None
+        return self.status_seq, sorted(tasks)
+
+    def add_status_waiter(self, user_id, callback):
+        self.status_waiters.setdefault(user_id, []).append(callback)
+
+    def remove_status_waiter(self, user_id, callback):
+        waiters = self.status_waiters.get(user_id, [])
+        if callback in waiters:
+            waiters.remove(callback)
+        if not waiters:
+            self.status_waiters.pop(user_id, None)
 
 
 class MainHandler(BaseHandler):
@@ -462,9 +923,8 @@ class LoginHandler(BaseHandler):
         username = self.get_argument("username", "")
         password = self.get_argument("password", "")
         next_page = self.get_argument("next", "/")
-        user = self.sql_session.query(User)\
-            .filter(User.contest == self.contest)\
-            .filter(User.username == username).first()
+        user = self.application.service.contest_cache.get_user(
+            self.sql_session, username)
 
         filtered_user = filter_ascii(username)
         filtered_pass = filter_ascii(password)
@@ -508,6 +968,7 @@ class StartHandler(BaseHandler):
         logger.info("Starting now for user %s" % user.username)
         user.starting_time = self.timestamp
         self.sql_session.commit()
+        self.application.service.user_changed(user.username)
 
         self.redirect("/")
 
@@ -695,56 +1156,104 @@ class CommunicationHandler(BaseHandler):
 class NotificationsHandler(BaseHandler):
     """Displays notifications.
 
+    The client sends the timestamp of the most recent notification it
+    has, and gets the ones after it. If it asks to wait and there are
+    none, we wait for something new for up to WAIT_TIME seconds before
+    replying (long polling), so that idle clients don't have to ask
+    over and over again.
+
     """
 
     refresh_cookie = False
 
+    WAIT_TIME = 30
+
+    @tornado.web.asynchronous
     @tornado.web.authenticated
     def get(self):
         if not self.current_user:
             raise tornado.web.HTTPError(403)
-        res = []
-        last_notification = make_datetime(
+        self.user_id = self.current_user.id
+        self.username = self.current_user.username
+        self.timeout = None
+        self.last_notification = make_datetime(
             float(self.get_argument("last_notification", "0")))
 
-        # Announcements
-        for announcement in self.contest.announcements:
-            if announcement.timestamp > last_notification \
-                    and announcement.timestamp < self.timestamp:
-                res.append({"type": "announcement",
-                            "timestamp":
-                            make_timestamp(announcement.timestamp),
-                            "subject": announcement.subject,
-                            "text": announcement.text})
+        service = self.application.service
+        res = self.get_notifications()
+        if res or service.shared_state.has_notifications(self.username) \
+                or self.get_argument("wait", "0") != "1":
+            self.reply(res)
+            return
 
-        if self.current_user is not None:
-            # Private messages
-            for message in self.current_user.messages:
-                if message.timestamp > last_notification \
-                        and message.timestamp < self.timestamp:
-                    res.append({"type": "message",
-                                "timestamp": make_timestamp(message.timestamp),
-                                "subject": message.subject,
-                                "text": message.text})
-
-            # Answers to questions
-            for question in self.current_user.questions:
-                if question.reply_timestamp is not None \
-                        and question.reply_timestamp > last_notification \
-                        and question.reply_timestamp < self.timestamp:
-                    subject = question.reply_subject
-                    text = question.reply_text
-                    if question.reply_subject is None:
-                        subject = question.reply_text
-                        text = ""
-                    elif question.reply_text is None:
-                        text = ""
-                    res.append({"type": "question",
-                                "timestamp":
-                                make_timestamp(question.reply_timestamp),
-                                "subject": subject,
-                                "text": text})
+        # We don't need the database while waiting.
+        self.sql_session.close()
+        service.add_notification_waiter(self.username, self.on_notification)
+        self.timeout = service.instance.add_timeout(
+            time.time() + NotificationsHandler.WAIT_TIME,
+            self.on_timeout)
 
+    def get_notifications(self):
+        """Return the notifications for the user after
+        last_notification.
+
+        return ([dict]): the notifications.
+
+        """
+        res = self.application.service.contest_cache.get_announcements(
+            self.last_notification, self.timestamp)
+
+        # Private messages
+        messages = self.sql_session.query(Message)\
+            .filter(Message.user_id == self.user_id)\
+            .filter(Message.timestamp > self.last_notification)\
+            .filter(Message.timestamp < self.timestamp)\
+            .all()
+        for message in messages:
+            res.append({"type": "message",
+                        "timestamp": make_timestamp(message.timestamp),
+                        "subject": message.subject,
+                        "text": message.text})
+
+        # Answers to questions
+        questions = self.sql_session.query(Question)\
+            .filter(Question.user_id == self.user_id)\
+            .filter(Question.reply_timestamp > self.last_notification)\
+            .filter(Question.reply_timestamp < self.timestamp)\
+            .all()
+        for question in questions:
+            subject = question.reply_subject
+            text = question.reply_text
+            if question.reply_subject is None:
+                subject = question.reply_text
+                text = ""
+            elif question.reply_text is None:
+                text = ""
+            res.append({"type": "question",
+                        "timestamp":
+                        make_timestamp(question.reply_timestamp),
+                        "subject": subject,
+                        "text": text})
+
+        return res
+
+    def on_notification(self):
+        self.application.service.instance.remove_timeout(self.timeout)
+        self.timestamp = make_datetime()
+        self.reply(self.get_notifications())
+
+    def on_timeout(self):
+        self.application.service.remove_notification_waiter(
+            self.username, self.on_notification)
+        self.reply([])
+
+    def on_connection_close(self):
+        self.application.service.remove_notification_waiter(
+            self.username, self.on_notification)
+        if self.timeout is not None:
+            self.application.service.instance.remove_timeout(self.timeout)
+
+    def reply(self, res):
         # Update the unread_count cookie before taking notifications
         # into account because we don't want to count them.
         prev_unread_count = self.get_secure_cookie("unread_count")
@@ -753,18 +1262,17 @@ class NotificationsHandler(BaseHandler):
         self.set_secure_cookie("unread_count", str(next_unread_count))
 
         # Simple notifications
-        notifications = self.application.service.notifications
-        username = self.current_user.username
-        if username in notifications:
-            for notification in notifications[username]:
-                res.append({"type": "notification",
-                            "timestamp": make_timestamp(notification[0]),
-                            "subject": notification[1],
-                            "text": notification[2],
-                            "level": notification[3]})
-            del notifications[username]
+        for notification in \
+                self.application.service.shared_state.pop_notifications(
+                    self.username):
+            res.append({"type": "notification",
+                        "timestamp": make_timestamp(notification[0]),
+                        "subject": notification[1],
+                        "text": notification[2],
+                        "level": notification[3]})
 
         self.write(json.dumps(res))
+        self.finish()
 
 
 class QuestionHandler(BaseHandler):
@@ -802,132 +1310,176 @@ class QuestionHandler(BaseHandler):
 class SubmitHandler(BaseHandler):
     """Handles the received submissions.
 
+    The checks are done with the data kept in memory by the service
+    (see SubmissionCounters); extracting archives, storing the files
+    and committing the submission are then done by the storage
+    workers, so that the other requests are served in the meantime.
+
     """
     @tornado.web.authenticated
     @actual_phase_required(0)
+    @tornado.web.asynchronous
     def post(self, task_name):
         try:
             task = self.contest.get_task(task_name)
         except KeyError:
             raise tornado.web.HTTPError(404)
 
-        # Alias for easy access
-        contest = self.contest
+        service = self.application.service
+
+        # What we need after having released the session.
+        self.task = task
+        self.task_id = task.id
+        self.user_id = self.current_user.id
+        self.username = self.current_user.username
+        self.task_url = "/tasks/%s/submissions" % quote(task.name, safe='')
+
+        # We check the limits now, to refuse the submission early, and
+        # again (atomically) when counting it.
+        error = self.check_limits(
+            service.submission_counters.get(self.user_id))
+        if error is not None:
+            self.fail(*error)
+            return
+
+        # Ensure that the user did not submit multiple files with the
+        # same name.
+        if any(len(x) != 1 for x in self.request.files.values()):
+            self.fail(self._("Invalid submission format!"),
+                      self._("Please select the correct files."))
+            return
+
+        # If the user submitted an archive, extract it (in a worker)
+        # and use content as request.files.
+        if len(self.request.files) == 1 and \
+                self.request.files.keys()[0] == "submission":
+            archive_data = self.request.files["submission"][0]
+            del self.request.files["submission"]
+            service.storage_workers.run(
+                partial(self.extract, archive_data),
+                self.async_callback(self.on_extracted))
+        else:
+            self.check_files()
+
+    def check_limits(self, counters):
+        """Check that the submission is within the limits on the
+        number of submissions and on the time between them.
+
+        counters (dict): the counters of the user, as returned by
+                         SubmissionCounters.get.
+        return ((string, string)|None): the subject and the text of
+                                        the notification to send if
+                                        the submission is refused,
+                                        None if it can be accepted.
+
+        """
+        task_counter = counters.get(self.task_id, [0, None])
+        contest_count = sum(count for count, last in counters.itervalues())
+        contest_last = max([last for count, last in counters.itervalues()
+                            if last is not None] or [None])
 
         # Enforce maximum number of submissions
         try:
-            if contest.max_submission_number is not None:
-                submission_c = self.sql_session\
-                    .query(func.count(Submission.id))\
-                    .join(Submission.task)\
-                    .filter(Task.contest == contest)\
-                    .filter(Submission.user == self.current_user).scalar()
-                if submission_c >= contest.max_submission_number:
+            if self.contest.max_submission_number is not None:
+                if contest_count >= self.contest.max_submission_number:
                     raise ValueError(
                         self._("You have reached the maximum limit of "
                                "at most %d submissions among all tasks.") %
-                        contest.max_submission_number)
-            if task.max_submission_number is not None:
-                submission_t = self.sql_session\
-                    .query(func.count(Submission.id))\
-                    .filter(Submission.task == task)\
-                    .filter(Submission.user == self.current_user).scalar()
-                if submission_t >= task.max_submission_number:
+                        self.contest.max_submission_number)
+            if self.task.max_submission_number is not None:
+                if task_counter[0] >= self.task.max_submission_number:
                     raise ValueError(
                         self._("You have reached the maximum limit of "
                                "at most %d submissions on this task.") %
-                        task.max_submission_number)
+                        self.task.max_submission_number)
         except ValueError as error:
-            self.application.service.add_notification(
-                self.current_user.username,
-                self.timestamp,
-                self._("Too many submissions!"),
-                str(error),
-                ContestWebServer.NOTIFICATION_ERROR)
-            self.redirect("/tasks/%s/submissions" % quote(task.name, safe=''))
-            return
+            return self._("Too many submissions!"), str(error)
 
         # Enforce minimum time between submissions
         try:
-            if contest.min_submission_interval is not None:
-                last_submission_c = self.sql_session.query(Submission)\
-                    .join(Submission.task)\
-                    .filter(Task.contest == contest)\
-                    .filter(Submission.user == self.current_user)\
-                    .order_by(Submission.timestamp.desc()).first()
-                if last_submission_c is not None and \
-                        self.timestamp - last_submission_c.timestamp < \
-                        contest.min_submission_interval:
+            if self.contest.min_submission_interval is not None:
+                if contest_last is not None and \
+                        self.timestamp - contest_last < \
+                        self.contest.min_submission_interval:
                     raise ValueError(
                         self._("Among all tasks, you can submit again "
                                "after %d seconds from last submission.") %
-                        contest.min_submission_interval.total_seconds())
-            # We get the last submission even if we may not need it
-            # for min_submission_interval because we may need it later,
-            # in case this is a ALLOW_PARTIAL_SUBMISSION task.
-            last_submission_t = self.sql_session.query(Submission)\
-                .filter(Submission.task == task)\
-                .filter(Submission.user == self.current_user)\
-                .order_by(Submission.timestamp.desc()).first()
-            if task.min_submission_interval is not None:
-                if last_submission_t is not None and \
-                        self.timestamp - last_submission_t.timestamp < \
-                        task.min_submission_interval:
+                        self.contest.min_submission_interval.total_seconds())
+            if self.task.min_submission_interval is not None:
+                if task_counter[1] is not None and \
+                        self.timestamp - task_counter[1] < \
+                        self.task.min_submission_interval:
                     raise ValueError(
                         self._("For this task, you can submit again "
                                "after %d seconds from last submission.") %
-                        task.min_submission_interval.total_seconds())
+                        self.task.min_submission_interval.total_seconds())
         except ValueError as error:
-            self.application.service.add_notification(
-                self.current_user.username,
-                self.timestamp,
-                self._("Submissions too frequent!"),
-                str(error),
-                ContestWebServer.NOTIFICATION_ERROR)
-            self.redirect("/tasks/%s/submissions" % quote(task.name, safe=''))
-            return
+            return self._("Submissions too frequent!"), str(error)
 
-        # Ensure that the user did not submit multiple files with the
-        # same name.
-        if any(len(x) != 1 for x in self.request.files.values()):
-            self.application.service.add_notification(
-                self.current_user.username,
-                self.timestamp,
-                self._("Invalid submission format!"),
-                self._("Please select the correct files."),
-                ContestWebServer.NOTIFICATION_ERROR)
-            self.redirect("/tasks/%s/submissions" % quote(task.name, safe=''))
-            return
+        return None
 
-        # If the user submitted an archive, extract it and use content
-        # as request.files.
-        if len(self.request.files) == 1 and \
-                self.request.files.keys()[0] == "submission":
-            archive_data = self.request.files["submission"][0]
-            del self.request.files["submission"]
+    def fail(self, subject, text):
+        """Tell the user that the submission has been refused, and go
+        back to the submissions of the task.
 
-            # Extract the files from the archive.
-            temp_archive_file, temp_archive_filename = \
-                tempfile.mkstemp(dir=config.temp_dir)
+        subject (string): subject of the notification.
+        text (string): body of the notification.
+
+        """
+        self.application.service.add_notification(
+            self.username,
+            self.timestamp,
+            subject,
+            text,
+            ContestWebServer.NOTIFICATION_ERROR)
+        self.redirect(self.task_url)
+
+    @staticmethod
+    def extract(archive_data):
+        """Extract the files from an archive (run in a worker).
+
+        archive_data (dict): the uploaded archive, as in
+                             request.files.
+
+        return (([dict], string)): the files, as in request.files,
+                                   or None and the reason why the
+                                   archive can't be opened (logged by
+                                   on_extracted).
+
+        """
+        temp_archive_file, temp_archive_filename = \
+            tempfile.mkstemp(dir=config.temp_dir)
+        try:
             with os.fdopen(temp_archive_file, "w") as temp_archive_file:
                 temp_archive_file.write(archive_data["body"])
+            return read_archive(temp_archive_filename,
+                                archive_data["filename"]), None
+        except ValueError as error:
+            return None, str(error)
+        finally:
+            os.unlink(temp_archive_filename)
+
+    def on_extracted(self, result, error):
+        archive_contents = None
+        if error is None:
+            archive_contents, message = result
+            if message is not None:
+                logger.warning(message)
+        if archive_contents is None:
+            self.fail(self._("Invalid archive format!"),
+                      self._("The submitted archive could not be opened."))
+            return
 
-            archive_contents = extract_archive(temp_archive_filename,
-                                               archive_data["filename"])
+        for item in archive_contents:
+            self.request.files[item["filename"]] = [item]
+        self.check_files()
 
-            if archive_contents is None:
-                self.application.service.add_notification(
-                    self.current_user.username,
-                    self.timestamp,
-                    self._("Invalid archive format!"),
-                    self._("The submitted archive could not be opened."),
-                    ContestWebServer.NOTIFICATION_ERROR)
-                self.redirect("/tasks/%s/submissions" % quote(task.name,
-                                                              safe=''))
-                return
+    def check_files(self):
+        """Check the submitted files and, if they're good, send them
+        to the storage workers.
 
-            for item in archive_contents:
-                self.request.files[item["filename"]] = [item]
+        """
+        task = self.task
 
         # This ensure that the user sent one file for every name in
         # submission format and no more. Less is acceptable if task
@@ -937,13 +1489,8 @@ class SubmitHandler(BaseHandler):
         provided = set(self.request.files.keys())
         if not (required == provided or (task_type.ALLOW_PARTIAL_SUBMISSION
                                          and required.issuperset(provided))):
-            self.application.service.add_notification(
-                self.current_user.username,
-                self.timestamp,
-                self._("Invalid submission format!"),
-                self._("Please select the correct files."),
-                ContestWebServer.NOTIFICATION_ERROR)
-            self.redirect("/tasks/%s/submissions" % quote(task.name, safe=''))
+            self.fail(self._("Invalid submission format!"),
+                      self._("Please select the correct files."))
             return
 
         # Add submitted files. After this, files is a dictionary indexed
@@ -960,8 +1507,14 @@ class SubmitHandler(BaseHandler):
         submission_lang = None
         file_digests = {}
         retrieved = 0
-        if task_type.ALLOW_PARTIAL_SUBMISSION and \
-                last_submission_t is not None:
+        if task_type.ALLOW_PARTIAL_SUBMISSION:
+            last_submission_t = self.sql_session.query(Submission)\
+                .filter(Submission.task_id == self.task_id)\
+                .filter(Submission.user_id == self.user_id)\
+                .order_by(Submission.timestamp.desc()).first()
+        else:
+            last_submission_t = None
+        if last_submission_t is not None:
             for filename in required.difference(provided):
                 if filename in last_submission_t.files:
                     # If we retrieve a language-dependent file from
@@ -1007,91 +1560,121 @@ class SubmitHandler(BaseHandler):
                 else:
                     submission_lang = lang
         if error is not None:
-            self.application.service.add_notification(
-                self.current_user.username,
-                self.timestamp,
-                self._("Invalid submission!"),
-                error,
-                ContestWebServer.NOTIFICATION_ERROR)
-            self.redirect("/tasks/%s/submissions" % quote(task.name, safe=''))
+            self.fail(self._("Invalid submission!"), error)
             return
 
         # Check if submitted files are small enough.
         if any([len(f[1]) > config.max_submission_length
                 for f in files.values()]):
-            self.application.service.add_notification(
-                self.current_user.username,
-                self.timestamp,
-                self._("Submission too big!"),
-                self._("Each source file must be at most %d bytes long.") %
-                config.max_submission_length,
-                ContestWebServer.NOTIFICATION_ERROR)
-            self.redirect("/tasks/%s/submissions" % quote(task.name, safe=''))
+            self.fail(self._("Submission too big!"),
+                      self._("Each source file must be at most %d bytes "
+                             "long.") % config.max_submission_length)
             return
 
-        # All checks done, submission accepted.
+        # All checks done, submission accepted if still within the
+        # limits. We count it now, so that the limits hold also for
+        # the submissions sent (possibly to other processes) while
+        # this one is being stored.
+        error = self.application.service.submission_counters.add(
+            self.user_id, self.task_id, self.timestamp, self.check_limits)
+        if error is not None:
+            self.fail(*error)
+            return
+
+        # We don't need the database anymore.
+        self.sql_session.close()
 
+        self.application.service.storage_workers.run(
+            partial(self.store, files, file_digests, submission_lang),
+            self.async_callback(self.on_stored))
+
+    def store(self, files, file_digests, submission_lang):
+        """Save the local copy of the submission, send the files to
+        the storage and commit the submission (run in a worker).
+
+        files (dict): the submitted files, as (user filename, content)
+                      indexed by our filenames.
+        file_digests (dict): the digests of the files already in the
+                             storage, indexed by our filenames.
+        submission_lang (string): the language of the submission.
+
+        return ((int, string)): the id of the new submission, and the
+                                traceback of the failure of the local
+                                copy (None if it didn't fail),
+                                logged by on_stored.
+
+        """
         # Attempt to store the submission locally to be able to
         # recover a failure.
+        local_copy_error = None
         if config.submit_local_copy:
             try:
                 path = os.path.join(
                     config.submit_local_copy_path.replace("%s",
                                                           config.data_dir),
-                    self.current_user.username)
+                    self.username)
                 if not os.path.exists(path):
                     os.makedirs(path)
                 with codecs.open(
                         os.path.join(path,
                                      str(int(make_timestamp(self.timestamp)))),
                         "w", "utf-8") as file_:
-                    pickle.dump((self.contest.id,
-                                 self.current_user.id,
-                                 task.id,
+                    pickle.dump((self.application.service.contest,
+                                 self.user_id,
+                                 self.task_id,
                                  files), file_)
-            except Exception as error:
-                logger.warning("Submission local copy failed - %s" %
-                               traceback.format_exc())
+            except Exception:
+                local_copy_error = traceback.format_exc()
 
         # We now have to send all the files to the destination...
+        file_cacher = self.application.service.storage_file_cacher
+        for filename in files:
+            digest = file_cacher.put_file(
+                description="Submission file %s sent by %s at %d." % (
+                    filename,
+                    self.username,
+                    make_timestamp(self.timestamp)),
+                binary_data=files[filename][1])
+            file_digests[filename] = digest
+
+        # All the files are stored, ready to submit!
+        session = Session()
         try:
-            for filename in files:
-                digest = self.application.service.file_cacher.put_file(
-                    description="Submission file %s sent by %s at %d." % (
-                        filename,
-                        self.current_user.username,
-                        make_timestamp(self.timestamp)),
-                    binary_data=files[filename][1])
-                file_digests[filename] = digest
+            submission = Submission(
+                self.timestamp,
+                submission_lang,
+                user=User.get_from_id(self.user_id, session),
+                task=Task.get_from_id(self.task_id, session))
+            for filename, digest in file_digests.items():
+                session.add(File(filename, digest, submission=submission))
+            session.add(submission)
+            session.commit()
+            return submission.id, local_copy_error
+        finally:
+            session.close()
+
+    def on_stored(self, result, error):
+        service = self.application.service
 
         # In case of error, the server aborts the submission
-        except Exception as error:
+        if error is not None:
             logger.error("Storage failed! %s" % error)
-            self.application.service.add_notification(
-                self.current_user.username,
-                self.timestamp,
-                self._("Submission storage failed!"),
-                self._("Please try again."),
-                ContestWebServer.NOTIFICATION_ERROR)
-            self.redirect("/tasks/%s/submissions" % quote(task.name, safe=''))
+            service.submission_counters.invalidate(self.user_id)
+            self.fail(self._("Submission storage failed!"),
+                      self._("Please try again."))
             return
 
-        # All the files are stored, ready to submit!
+        submission_id, local_copy_error = result
+        if local_copy_error is not None:
+            logger.warning("Submission local copy failed - %s" %
+                           local_copy_error)
         logger.info("All files stored for submission sent by %s" %
-                    self.current_user.username)
-        submission = Submission(self.timestamp,
-                                submission_lang,
-                                user=self.current_user,
-                                task=task)
-
-        for filename, digest in file_digests.items():
-            self.sql_session.add(File(filename, digest, submission=submission))
-        self.sql_session.add(submission)
-        self.sql_session.commit()
-        self.application.service.evaluation_service.new_submission(
-            submission_id=submission.id)
-        self.application.service.add_notification(
-            self.current_user.username,
+                    self.username)
+
+        service.evaluation_service.new_submission(
+            submission_id=submission_id)
+        service.add_notification(
+            self.username,
             self.timestamp,
             self._("Submission received"),
             self._("Your submission has been received "
@@ -1101,9 +1684,8 @@ class SubmitHandler(BaseHandler):
         # (nor it discloses information to the user), but it is useful
         # for automatic testing to obtain the submission id).
         # FIXME is it actually used by something?
-        self.redirect("/tasks/%s/submissions?%s" % (
-            quote(task.name, safe=''),
-            encrypt_number(submission.id)))
+        self.redirect("%s?%s" % (self.task_url,
+                                 encrypt_number(submission_id)))
 
 
 class UseTokenHandler(BaseHandler):
@@ -1240,6 +1822,71 @@ class SubmissionStatusHandler(BaseHandler):
         self.write(data)
 
 
+class SubmissionUpdatesHandler(BaseHandler):
+    """Wait for a change of the status of the submissions of the user
+    (long polling), to tell the pages when they have to reload it.
+
+    The reply is a JSON object with the cursor to use for the next
+    request and the ids of the tasks with changes. If nothing changes
+    in WAIT_TIME seconds we reply with an empty list, and the page can
+    check the status anyway, just in case.
+
+    """
+
+    refresh_cookie = False
+
+    WAIT_TIME = 30
+
+    @tornado.web.asynchronous
+    @tornado.web.authenticated
+    @actual_phase_required(0)
+    def get(self):
+        self.user_id = self.current_user.id
+        self.timeout = None
+        # We don't need the database while waiting.
+        self.sql_session.close()
+
+        try:
+            cursor = int(self.get_argument("cursor"))
+        except (tornado.web.MissingArgumentError, ValueError):
+            cursor = None
+        self.cursor = cursor
+
+        service = self.application.service
+        changes = service.get_status_changes(self.user_id, cursor)
+        if changes is not None:
+            self.reply(*changes)
+            return
+
+        service.add_status_waiter(self.user_id, self.on_change)
+        self.timeout = service.instance.add_timeout(
+            time.time() + SubmissionUpdatesHandler.WAIT_TIME,
+            self.on_timeout)
+
+    def on_change(self):
+        self.application.service.instance.remove_timeout(self.timeout)
+        changes = self.application.service.get_status_changes(
+            self.user_id, self.cursor)
+        if changes is None:
+            changes = (self.cursor, [])
+        self.reply(*changes)
+
+    def on_timeout(self):
+        self.application.service.remove_status_waiter(
+            self.user_id, self.on_change)
+        self.reply(self.cursor, [])
+
+    def on_connection_close(self):
+        self.application.service.remove_status_waiter(
+            self.user_id, self.on_change)
+        if self.timeout is not None:
+            self.application.service.instance.remove_timeout(self.timeout)
+
+    def reply(self, cursor, task_ids):
+        self.write({"cursor": cursor, "tasks": task_ids})
+        self.finish()
+
+
 class SubmissionDetailsHandler(BaseHandler):
 
     refresh_cookie = False
@@ -1271,7 +1918,8 @@ class SubmissionDetailsHandler(BaseHandler):
                 details = sr.public_score_details
 
             if sr.scored():
-                details = score_type.get_html_details(details, self._)
+                details = score_type.get_html_details(
+                    details, self._, self.locale.code)
             else:
                 details = None
 
@@ -1817,6 +2465,7 @@ _cws_handlers = [
     (r"/tasks/(.*)/attachments/(.*)", TaskAttachmentViewHandler),
     (r"/tasks/(.*)/submit", SubmitHandler),
     (r"/tasks/(.*)/submissions/([1-9][0-9]*)", SubmissionStatusHandler),
+    (r"/submission_updates", SubmissionUpdatesHandler),
     (r"/tasks/(.*)/submissions/([1-9][0-9]*)/details",
      SubmissionDetailsHandler),
     (r"/tasks/(.*)/submissions/([1-9][0-9]*)/files/(.*)",
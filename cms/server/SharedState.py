@@ -0,0 +1,403 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Programming contest management system
+# Copyright © 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The transient state of a ContestWebServer that has to be shared
+by all its processes.
+
+This is the notifications waiting to be sent to each user, the
+counters of the submissions of each user (so that the limits on
+submissions hold whichever process receives them) and a sequence of
+events (e.g., "the cached data of a user changed") that every process
+has to know about. When CWS runs in a single process they are kept in
+memory (MemoryState); otherwise in a SQLite database that all the
+processes of the shard open (SQLiteState).
+
+The counters of a user are, for each task id, a pair [number of
+submissions, time of the last one (as datetime, or None)]. They are
+loaded from the database by the caller, and then kept up to date by
+add_submission, that checks the limits and counts the submission
+atomically.
+
+Events are pairs (kind, args), where args is a list of
+JSON-serializable values; the listener is called, in the IOLoop, as
+listener(seq, kind, args, own), where seq is the (increasing) number
+of the event and own tells whether the event has been published by
+the same process.
+
+"""
+
+import os
+import sqlite3
+
+import simplejson as json
+import tornado.ioloop
+
+from cms import logger
+from cmscommon.DateTime import make_datetime, make_timestamp
+
+
+def _to_unicode(string):
+    """Return string as unicode, decoding it from UTF-8 if needed."""
+    if isinstance(string, str):
+        return string.decode("utf-8")
+    return string
+
+
+class MemoryState:
+    """Shared state for a single process.
+
+    """
+    def __init__(self):
+        self._notifications = {}
+        self._counters = {}
+        self._seq = 0
+        self._listener = None
+
+    def start(self, io_loop, listener):
+        """Start delivering the events.
+
+        io_loop (IOLoop): the loop of the process.
+        listener (callable): called for each event (see above).
+
+        """
+        self._listener = listener
+
+    def add_notification(self, username, notification):
+        """Store a notification to send to a user.
+
+        username (string): the user.
+        notification (tuple): timestamp (as datetime), subject, text
+                              and level of the notification.
+
+        """
+        self._notifications.setdefault(username, []).append(notification)
+
+    def has_notifications(self, username):
+        """Return whether there are notifications for a user.
+
+        username (string): the user.
+        return (bool): True if there are notifications.
+
+        """
+        return username in self._notifications
+
+    def pop_notifications(self, username):
+        """Return, and forget, the notifications for a user.
+
+        username (string): the user.
+        return ([tuple]): the notifications, as given to
+                          add_notification.
+
+        """
+        return self._notifications.pop(username, [])
+
+    def get_counters(self, user_id):
+        """Return the submission counters of a user.
+
+        user_id (int): the user.
+        return (dict|None): the counters, indexed by task id, or None
+                            if they have not been loaded.
+
+        """
+        counters = self._counters.get(user_id)
+        if counters is None:
+            return None
+        return dict((task_id, list(counter))
+                    for task_id, counter in counters.iteritems())
+
+    def load_counters(self, user_id, counters):
+        """Set the submission counters of a user, unless they have
+        already been loaded (possibly by another process, that may
+        have counted more submissions since).
+
+        user_id (int): the user.
+        counters (dict): the counters, indexed by task id.
+
+        """
+        if user_id not in self._counters:
+            self._counters[user_id] = dict(
+                (task_id, list(counter))
+                for task_id, counter in counters.iteritems())
+
+    def add_submission(self, user_id, task_id, timestamp, check):
+        """Count a submission, if the limits allow it.
+
+        user_id (int): the user.
+        task_id (int): the task.
+        timestamp (datetime): the time of the submission.
+        check (callable): called with the counters of the user; it
+                          returns None if the submission can be
+                          accepted, something else (that we return)
+                          if not.
+        return (object): what check returned.
+
+        raise (KeyError): if the counters of the user have not been
+                          loaded.
+
+        """
+        counters = self._counters[user_id]
+        error = check(self.get_counters(user_id))
+        if error is None:
+            counter = counters.setdefault(task_id, [0, None])
+            counter[0] += 1
+            if counter[1] is None or counter[1] < timestamp:
+                counter[1] = timestamp
+        return error
+
+    def reset_counters(self, user_id):
+        """Forget the submission counters of a user, to have them
+        loaded again.
+
+        user_id (int): the user.
+
+        """
+        self._counters.pop(user_id, None)
+
+    def publish(self, kind, args):
+        """Send an event to all the processes (including this one).
+
+        kind (string): the kind of the event.
+        args (list): its arguments.
+
+        """
+        self._seq += 1
+        if self._listener is not None:
+            self._listener(self._seq, kind, args, True)
+
+
+class SQLiteState:
+    """Shared state for many processes, kept in a SQLite database.
+
+    Each process polls the database every POLL_INTERVAL seconds for
+    new events.
+
+    """
+
+    POLL_INTERVAL = 0.1
+
+    # How many events we keep in the database.
+    KEEP_EVENTS = 10000
+
+    @staticmethod
+    def reset(path):
+        """Create an empty database, to be called before starting the
+        processes that will share it.
+
+        path (string): the path of the database.
+
+        """
+        for suffix in ["", "-wal", "-shm"]:
+            try:
+                os.remove(path + suffix)
+            except OSError:
+                pass
+        connection = sqlite3.connect(path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE notifications ("
+                           "id INTEGER PRIMARY KEY, "
+                           "username TEXT NOT NULL, "
+                           "timestamp REAL NOT NULL, "
+                           "subject TEXT, "
+                           "text TEXT, "
+                           "level TEXT)")
+        connection.execute("CREATE INDEX notifications_username "
+                           "ON notifications (username)")
+        connection.execute("CREATE TABLE counted_users ("
+                           "user_id INTEGER PRIMARY KEY)")
+        connection.execute("CREATE TABLE counters ("
+                           "user_id INTEGER NOT NULL, "
+                           "task_id INTEGER NOT NULL, "
+                           "count INTEGER NOT NULL, "
+                           "last REAL, "
+                           "PRIMARY KEY (user_id, task_id))")
+        connection.execute("CREATE TABLE events ("
+                           "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                           "origin INTEGER NOT NULL, "
+                           "kind TEXT NOT NULL, "
+                           "args TEXT NOT NULL)")
+        connection.commit()
+        connection.close()
+
+    def __init__(self, path, process):
+        """Open the database (created by reset).
+
+        path (string): the path of the database.
+        process (int): the number of this process.
+
+        """
+        self._process = process
+        # In autocommit mode, we start the transactions ourselves.
+        self._connection = sqlite3.connect(path, timeout=10.0,
+                                           isolation_level=None)
+        self._connection.execute("PRAGMA synchronous=OFF")
+        self._seq = self._connection.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM events").fetchone()[0]
+        self._listener = None
+        self._polls = 0
+
+    def start(self, io_loop, listener):
+        """See MemoryState.start."""
+        self._listener = listener
+        tornado.ioloop.PeriodicCallback(
+            self._poll, SQLiteState.POLL_INTERVAL * 1000,
+            io_loop=io_loop).start()
+
+    def add_notification(self, username, notification):
+        """See MemoryState.add_notification."""
+        timestamp, subject, text, level = notification
+        self._connection.execute(
+            "INSERT INTO notifications "
+            "(username, timestamp, subject, text, level) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (_to_unicode(username), make_timestamp(timestamp),
+             _to_unicode(subject), _to_unicode(text), level))
+
+    def has_notifications(self, username):
+        """See MemoryState.has_notifications."""
+        return self._connection.execute(
+            "SELECT 1 FROM notifications WHERE username = ? LIMIT 1",
+            (_to_unicode(username),)).fetchone() is not None
+
+    def pop_notifications(self, username):
+        """See MemoryState.pop_notifications."""
+        username = _to_unicode(username)
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self._connection.execute(
+                "SELECT timestamp, subject, text, level FROM notifications "
+                "WHERE username = ? ORDER BY id", (username,)).fetchall()
+            self._connection.execute(
+                "DELETE FROM notifications WHERE username = ?", (username,))
+        finally:
+            self._connection.execute("COMMIT")
+        return [(make_datetime(timestamp), subject, text, level)
+                for timestamp, subject, text, level in rows]
+
+    def _get_counters(self, user_id):
+        """See MemoryState.get_counters, without starting a
+        transaction.
+
+        """
+        if self._connection.execute(
+                "SELECT 1 FROM counted_users WHERE user_id = ?",
+                (user_id,)).fetchone() is None:
+            return None
+        return dict(
+            (task_id, [count, make_datetime(last)
+                       if last is not None else None])
+            for task_id, count, last in self._connection.execute(
+                "SELECT task_id, count, last FROM counters "
+                "WHERE user_id = ?", (user_id,)))
+
+    def get_counters(self, user_id):
+        """See MemoryState.get_counters."""
+        self._connection.execute("BEGIN")
+        try:
+            return self._get_counters(user_id)
+        finally:
+            self._connection.execute("COMMIT")
+
+    def load_counters(self, user_id, counters):
+        """See MemoryState.load_counters."""
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            if self._connection.execute(
+                    "INSERT OR IGNORE INTO counted_users (user_id) "
+                    "VALUES (?)", (user_id,)).rowcount == 1:
+                self._connection.executemany(
+                    "INSERT INTO counters (user_id, task_id, count, last) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(user_id, task_id, count,
+                      make_timestamp(last) if last is not None else None)
+                     for task_id, (count, last) in counters.iteritems()])
+        except:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
+
+    def add_submission(self, user_id, task_id, timestamp, check):
+        """See MemoryState.add_submission. The check and the update
+        are done in the same transaction, so no other process can
+        count a submission in between.
+
+        """
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            counters = self._get_counters(user_id)
+            if counters is None:
+                raise KeyError(user_id)
+            error = check(counters)
+            if error is None:
+                count, last = counters.get(task_id, [0, None])
+                if last is None or last < timestamp:
+                    last = timestamp
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO counters "
+                    "(user_id, task_id, count, last) VALUES (?, ?, ?, ?)",
+                    (user_id, task_id, count + 1, make_timestamp(last)))
+        except:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
+        return error
+
+    def reset_counters(self, user_id):
+        """See MemoryState.reset_counters."""
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._connection.execute(
+                "DELETE FROM counted_users WHERE user_id = ?", (user_id,))
+            self._connection.execute(
+                "DELETE FROM counters WHERE user_id = ?", (user_id,))
+        finally:
+            self._connection.execute("COMMIT")
+
+    def publish(self, kind, args):
+        """See MemoryState.publish. The event reaches the listeners
+        (this process's too) at their next poll.
+
+        """
+        self._connection.execute(
+            "INSERT INTO events (origin, kind, args) VALUES (?, ?, ?)",
+            (self._process, kind, json.dumps(args)))
+
+    def _poll(self):
+        """Deliver the new events to the listener."""
+        try:
+            rows = self._connection.execute(
+                "SELECT seq, origin, kind, args FROM events "
+                "WHERE seq > ? ORDER BY seq", (self._seq,)).fetchall()
+
+            self._polls += 1
+            if self._process == 0 and self._polls % 100 == 0:
+                self._connection.execute(
+                    "DELETE FROM events WHERE seq <= ?",
+                    (self._seq - SQLiteState.KEEP_EVENTS,))
+        except sqlite3.Error as error:
+            logger.warning("Cannot read the shared state: %r." % error)
+            return
+
+        for seq, origin, kind, args in rows:
+            self._seq = seq
+            try:
+                self._listener(seq, kind, json.loads(args),
+                               origin == self._process)
+            except Exception as error:
+                logger.error("Error while handling event %s: %r." %
+                             (kind, error))
@@ -26,11 +26,14 @@
 
 import os
 import time
+import threading
+import traceback
+import Queue
 
 import tarfile
 import zipfile
 
-from functools import wraps
+from functools import wraps, partial
 from tornado.web import RequestHandler
 import tornado.locale
 
@@ -55,12 +58,17 @@ def actual_phase_required(*actual_phases):
     return decorator
 
 
-def extract_archive(temp_name, original_filename):
-    """Obtain a list of files inside the specified archive.
+def read_archive(temp_name, original_filename):
+    """Obtain a list of files inside the specified archive, leaving
+    to the caller how to report the errors.
 
-    Returns a list of the files inside the archive located in
-    temp_name, using original_filename to guess the type of the
-    archive.
+    temp_name (string): the path of the archive.
+    original_filename (string): its original name, used to guess the
+                                type of the archive.
+
+    return ([dict]): the files, with keys "filename" and "body".
+
+    raise (ValueError): if the archive can't be read.
 
     """
     file_list = []
@@ -72,9 +80,8 @@ def extract_archive(temp_name, original_filename):
                     "filename": item.filename,
                     "body": zip_object.read(item)})
         except Exception as error:
-            logger.warning("Exception while extracting zip file `%s'. %r" %
-                           (original_filename, error))
-            return None
+            raise ValueError("Exception while extracting zip file `%s'. %r" %
+                             (original_filename, error))
     elif original_filename.endswith(".tar.gz") \
             or original_filename.endswith(".tar.bz2") \
             or original_filename.endswith(".tar"):
@@ -85,19 +92,30 @@ def extract_archive(temp_name, original_filename):
                     file_list.append({
                         "filename": item.name,
                         "body": tar_object.extractfile(item).read()})
-        except tarfile.TarError:
-            logger.warning("Exception while extracting tar file `%s'. %r" %
-                           (original_filename, error))
-            return None
-        except IOError:
-            return None
+        except (tarfile.TarError, IOError) as error:
+            raise ValueError("Exception while extracting tar file `%s'. %r" %
+                             (original_filename, error))
     else:
-        logger.warning("Compressed file `%s' not recognized."
-                       % original_filename)
-        return None
+        raise ValueError("Compressed file `%s' not recognized."
+                         % original_filename)
     return file_list
 
 
+def extract_archive(temp_name, original_filename):
+    """Obtain a list of files inside the specified archive.
+
+    Returns a list of the files inside the archive located in
+    temp_name, using original_filename to guess the type of the
+    archive, or None if it can't be read.
+
+    """
+    try:
+        return read_archive(temp_name, original_filename)
+    except ValueError as error:
+        logger.warning(str(error))
+        return None
+
+
 UNITS = ['B', 'KiB', 'MiB', 'GiB', 'TiB', 'PiB', 'EiB', 'ZiB', 'YiB']
 DIMS = list(1024 ** x for x in xrange(9))
 
@@ -434,56 +452,199 @@ def file_handler_gen(BaseClass):
     class FileHandler(BaseClass):
         """Base class for handlers that need to serve a file to the user.
 
+        The file is read directly from the cache of the FileCacher,
+        and each chunk is sent as soon as the previous one has been
+        written to the socket. Since a digest always identifies the
+        same content, it is used as the ETag, so that browsers can
+        check whether their copy is still valid without downloading it
+        again. HEAD requests and (single) byte ranges are supported.
+
         """
+
+        # Whether the URL identifies the content (i.e., it contains
+        # the digest), in which case browsers can cache the file
+        # forever without checking it again.
+        immutable = False
+
+        def head(self, *args, **kwargs):
+            """Like GET, but without the content (see fetch)."""
+            self.get(*args, **kwargs)
+
         def fetch(self, digest, content_type, filename):
-            """Sends the RPC to the FS.
+            """Send the file with the given digest to the user.
+
+            digest (string): the digest of the file.
+            content_type (string): the MIME type of the file.
+            filename (string): the name proposed to the user.
 
             """
             if digest == "":
                 logger.error("No digest given")
                 self.finish()
                 return
+
+            self.set_header("Etag", '"%s"' % digest)
+            if self.immutable:
+                self.set_header("Cache-Control",
+                                "private, max-age=31536000, immutable")
+            else:
+                self.set_header("Cache-Control", "private, no-cache")
+            if self.request.headers.get("If-None-Match") == \
+                    '"%s"' % digest:
+                self.set_status(304)
+                self.finish()
+                return
+
             try:
-                self.temp_filename = \
-                    self.application.service.file_cacher.get_file(
-                        digest, temp_path=True)
+                path = self.application.service.file_cacher.get_cache_path(
+                    digest)
+                self.file = open(path, "rb")
             except Exception as error:
                 logger.error("Exception while retrieving file `%s'. %r" %
                              (filename, error))
                 self.finish()
                 return
+            size = os.fstat(self.file.fileno()).st_size
 
             self.set_header("Content-Type", content_type)
             self.set_header("Content-Disposition",
                             "attachment; filename=\"%s\"" % filename)
+            self.set_header("Accept-Ranges", "bytes")
+
+            start, end = 0, size
+            byte_range = self._parse_range(size)
+            if byte_range is None:
+                self.set_status(416)
+                self.set_header("Content-Range", "bytes */%d" % size)
+                self.file.close()
+                self.finish()
+                return
+            elif byte_range is not False:
+                start, end = byte_range
+                self.set_status(206)
+                self.set_header("Content-Range",
+                                "bytes %d-%d/%d" % (start, end - 1, size))
+            self.set_header("Content-Length", end - start)
+
+            if self.request.method == "HEAD":
+                self.file.close()
+                self.finish()
+                return
+
+            self.file.seek(start)
+            self.remaining = end - start
             self.start_time = time.time()
-            self.size = 0
-            self.temp_file = open(self.temp_filename, "rb")
-            self.application.service.add_timeout(self._fetch_write_chunk,
-                                                 None, 0.02,
-                                                 immediately=True)
+            self._write_chunk()
+
+        def _parse_range(self, size):
+            """Interpret the Range header of the request.
+
+            size (int): the size of the file.
+
+            return (tuple|bool|None): the (start, end) interval to
+                                      send, end excluded; False to send
+                                      the whole file; None if the range
+                                      can't be satisfied.
 
-        def _fetch_write_chunk(self):
-            """Send a chunk of the file to the browser.
+            """
+            header = self.request.headers.get("Range")
+            if header is None or not header.startswith("bytes=") or \
+                    "," in header:
+                # Not present, or something we don't handle (e.g.,
+                # many ranges): the whole file is a valid reply.
+                return False
+            try:
+                first, last = header[len("bytes="):].strip().split("-")
+                if first == "":
+                    # The last bytes of the file.
+                    start = max(0, size - int(last))
+                    end = size
+                else:
+                    start = int(first)
+                    end = size if last == "" else min(size, int(last) + 1)
+            except ValueError:
+                return False
+            if start >= end:
+                return None
+            return start, end
+
+        def _write_chunk(self):
+            """Send a chunk of the file to the browser, and schedule the
+            next one for when it has been written.
 
             """
-            data = self.temp_file.read(FileCacher.CHUNK_SIZE)
-            length = len(data)
-            self.size += length / 1024.0 / 1024.0
+            data = self.file.read(min(self.remaining,
+                                      FileCacher.CHUNK_SIZE))
+            self.remaining -= len(data)
             self.write(data)
-            if length < FileCacher.CHUNK_SIZE:
-                self.temp_file.close()
-                os.unlink(self.temp_filename)
-                duration = time.time() - self.start_time
-                logger.info("%.3lf seconds for %.3lf MB, %.3lf MB/s" %
-                            (duration, self.size, self.size / duration))
+            if self.remaining > 0 and len(data) > 0:
+                self.flush(callback=self._write_chunk)
+            else:
+                self.file.close()
+                logger.debug("%.3lf seconds to send file." %
+                             (time.time() - self.start_time))
                 self.finish()
-                return False
-            return True
+
+        def on_connection_close(self):
+            if hasattr(self, "file"):
+                self.file.close()
 
     return FileHandler
 
 
+class WorkerPool:
+    """Run blocking jobs (e.g., writing to the storage or to the
+    database) in a fixed number of threads, and give their results back
+    to the thread of the IOLoop, that can meanwhile serve other
+    requests.
+
+    """
+    def __init__(self, io_loop, threads):
+        """Start the threads.
+
+        io_loop (IOLoop): the loop where the callbacks are run.
+        threads (int): the number of threads.
+
+        """
+        self.io_loop = io_loop
+        self.queue = Queue.Queue()
+        for i in xrange(threads):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+    def run(self, function, callback):
+        """Queue a job.
+
+        function (callable): the job, called without arguments in one
+                             of the threads.
+        callback (callable): called in the IOLoop with two arguments:
+                             the return value of function and the
+                             exception it raised (one of them is None).
+
+        """
+        self.queue.put((function, callback))
+
+    def _run(self):
+        while True:
+            function, callback = self.queue.get()
+            result, error, trace = None, None, None
+            try:
+                result = function()
+            except Exception as error:
+                trace = traceback.format_exc()
+            self.io_loop.add_callback(
+                partial(self._done, callback, result, error, trace))
+
+    @staticmethod
+    def _done(callback, result, error, trace):
+        # The error is logged in the IOLoop, just before the callback
+        # handles it.
+        if trace is not None:
+            logger.error("Unexpected error in background job: %s" % trace)
+        callback(result, error)
+
+
 def get_url_root(request_path):
     '''Generates a URL relative to request_uri which would point to the root of
     the website.'''
@@ -16,12 +16,14 @@ var Utils = new function () {
         self.unread_count = 0;
     };
 
-    self.update_notifications = function () {
-        $.get(
-            url_root + "/notifications",
-            {"last_notification": self.last_notification},
-            function (data) {
-                var counter = 0;    
+    self.update_notifications = function (wait) {
+        $.ajax({
+            url: url_root + "/notifications",
+            data: {"last_notification": self.last_notification,
+                   "wait": wait ? 1 : 0},
+            dataType: "json",
+            success: function (data) {
+                var counter = 0;
                 for (var i = 0; i < data.length; i += 1) {
                   self.display_notification(
                       data[i].type,
@@ -34,7 +36,24 @@ var Utils = new function () {
                   }
                 }
                 self.update_unread_counts(counter);
-            }, "json");
+                if (wait) {
+                    self.update_notifications(true);
+                }
+            },
+            error: function () {
+                if (wait) {
+                    setTimeout(function () {
+                        self.update_notifications(true);
+                    }, 15000);
+                }
+            }});
+    };
+
+    /* Keep a request open to get the notifications as soon as they
+     * arrive, instead of asking for them periodically.
+     */
+    self.listen_notifications = function () {
+        self.update_notifications(true);
     };
 
     self.display_notification = function (type, timestamp, subject, text, level) {
@@ -650,6 +650,9 @@ class EvaluationService(Service):
         self.pool = WorkerPool(self)
         self.scoring_service = self.connect_to(
             ServiceCoord("ScoringService", 0))
+        self.contest_web_servers = [
+            self.connect_to(ServiceCoord("ContestWebServer", i))
+            for i in xrange(get_service_shards("ContestWebServer"))]
 
         for i in xrange(get_service_shards("Worker")):
             worker = ServiceCoord("Worker", i)
@@ -1111,6 +1114,26 @@ class EvaluationService(Service):
 
             session.commit()
 
+            # The contestant sees the status of the submission on the
+            # active dataset, and it may have changed.
+            if job_type in [EvaluationService.JOB_TYPE_COMPILATION,
+                            EvaluationService.JOB_TYPE_EVALUATION]:
+                submission = submission_result.submission
+                if dataset_id == submission.task.active_dataset_id:
+                    self.notify_submission_status(submission)
+
+    def notify_submission_status(self, submission):
+        """Tell the ContestWebServers that the status of a submission
+        changed.
+
+        submission (Submission): the submission.
+
+        """
+        for contest_web_server in self.contest_web_servers:
+            contest_web_server.submission_status_changed(
+                user_id=submission.user_id,
+                task_id=submission.task_id)
+
     def compilation_ended(self, submission_result):
         """Actions to be performed when we have a submission that has
         ended compilation . In particular: we queue evaluation if
@@ -0,0 +1,409 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Programming contest management system
+# Copyright © 2010-2012 Giovanni Mascellani <mascellani@poisson.phc.unipi.it>
+# Copyright © 2010-2012 Stefano Maggiolo <s.maggiolo@gmail.com>
+# Copyright © 2010-2012 Matteo Boscariol <boscarim@hotmail.com>
+# Copyright © 2013 Luca Wehrstedt <luca.wehrstedt@gmail.com>
+# Copyright © 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The client ScoringService uses to keep a ranking up to date.
+
+Each ranking gets a RankingProxy, which queues the data to send and
+sends it from a thread of its own, so that a slow or unreachable
+ranking doesn't delay the others.
+
+"""
+
+from httplib import HTTPConnection
+from cStringIO import StringIO
+import gzip
+import os
+import socket
+import ssl
+import threading
+import time
+
+import simplejson as json
+
+from cms import config
+
+
+class CannotSendError(Exception):
+    pass
+
+
+# Taken from [1], with removed client key and certificate and added
+# server certificate validation. Note: tunneling capabilities have been
+# removed, too.
+#
+# [1] http://hg.python.org/releasing/2.7.3/file/7bb96963d067/Lib/httplib.py
+class HTTPSConnection(HTTPConnection):
+    """A subclass of HTTPConnection with HTTPS capabilities
+
+    Check that the certificate provided by the server is trusted using
+    the ones in config.https_certfile. This allows many configurations:
+    - a single self-signed certificate used both by SS and RWS;
+    - a different self-signed cerficiate for each RWS, all included in
+      the list used by SS;
+    - a single self-signed certificate used by SS, used to sign other
+      certificates used by the RWSs;
+    - etc.
+
+    """
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port),
+                                        self.timeout, self.source_address)
+
+        self.sock = ssl.wrap_socket(sock,
+                                    ssl_version=ssl.PROTOCOL_TLSv1,
+                                    cert_reqs=ssl.CERT_REQUIRED,
+                                    ca_certs=config.https_certfile)
+
+
+class RankingProxy:
+    """Queue the data for a ranking and send it, in a thread.
+
+    Submissions and subchanges are kept in dicts indexed by their
+    (encoded) id, so that many updates to the same entity collapse
+    into one. The queues are also saved to disk as soon as something is
+    queued (and until the ranking acknowledges it), so that they
+    survive a restart of the service.
+
+    The thread wakes up as soon as something is queued and waits
+    config.rankings_dispatch_window seconds to collect more data
+    before sending; it doesn't wait if there is already enough data
+    for a full request. While a batch is being sent new data piles up
+    and is sent with the next one, so batches grow with the load.
+
+    """
+
+    # Maximum time we wait between two attempts after failures.
+    MAX_BACKOFF_TIME = 60.0
+
+    # Timeout for connecting to the ranking and for its responses.
+    REQUEST_TIMEOUT = 30.0
+
+    # Maximum number of entities sent with a single request.
+    MAX_ENTITIES_PER_REQUEST = 1000
+
+    # Requests with a larger body are compressed.
+    MIN_GZIP_SIZE = 1024
+
+    def __init__(self, protocol, address, auth, log_bridge):
+        """Create the proxy and start its thread.
+
+        protocol (str): "http" or "https".
+        address (str): "host:port" of the ranking.
+        auth (str): the authorization string for the ranking.
+        log_bridge (LogBridge): the bridge to use to write logs.
+
+        """
+        if protocol not in ['http', 'https']:
+            raise ValueError("Unknown protocol '%s'." % protocol)
+        self.protocol = protocol
+        self.address = address
+        self.auth = auth
+        self.log_bridge = log_bridge
+
+        self.connection = None
+        self.backoff = 0.0
+
+        # The data to send. initialize_data is None or a list of
+        # (url, data) to send before everything else. pending_since
+        # is the time the oldest data still to send has been queued
+        # (None if there is nothing to send).
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.initialize_data = None
+        self.submissions = dict()
+        self.subchanges = dict()
+        self.pending_since = None
+        # The data the thread is sending: entries are removed (holding
+        # the lock) as soon as the ranking acknowledges them.
+        self.sending_submissions = dict()
+        self.sending_subchanges = dict()
+
+        self.metrics = {
+            "operations_sent": 0,
+            "requests_sent": 0,
+            "requests_failed": 0,
+            "bytes_sent": 0,
+            "last_success": None,
+            # Time from when the data is queued to when the ranking
+            # acknowledges it (for the oldest data of each batch).
+            "last_lag": None,
+            "max_lag": 0.0,
+            "total_lag": 0.0,
+            "batches_sent": 0,
+            }
+
+        self.queue_path = os.path.join(
+            config.data_dir, "ranking_queues",
+            "%s.json" % address.replace(":", "_"))
+        self._load_queues()
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def initialize(self, data):
+        """Send (again) the basic data of the contest.
+
+        data ([(str, dict)]): the urls and the data to send.
+
+        """
+        with self.lock:
+            self.initialize_data = data
+            self._notify()
+
+    def add_submissions(self, submissions):
+        """Queue some submissions.
+
+        submissions (dict): the data to send, indexed by encoded id.
+
+        """
+        with self.lock:
+            self.submissions.update(submissions)
+            self._save_queues()
+            self._notify()
+
+    def add_subchanges(self, subchanges):
+        """Queue some subchanges.
+
+        subchanges (dict): the data to send, indexed by encoded id.
+
+        """
+        with self.lock:
+            self.subchanges.update(subchanges)
+            self._save_queues()
+            self._notify()
+
+    def _notify(self):
+        """Wake up the thread, as something has been queued. To be
+        called holding the lock.
+
+        """
+        if self.pending_since is None:
+            self.pending_since = time.time()
+        self.condition.notify()
+
+    def get_metrics(self):
+        """Return some statistics on the data sent to the ranking.
+
+        return (dict): the metrics.
+
+        """
+        with self.lock:
+            metrics = dict(self.metrics)
+            metrics["address"] = self.address
+            metrics["pending_submissions"] = len(self.submissions)
+            metrics["pending_subchanges"] = len(self.subchanges)
+            if metrics["batches_sent"] > 0:
+                metrics["average_lag"] = \
+                    metrics["total_lag"] / metrics["batches_sent"]
+        return metrics
+
+    def _load_queues(self):
+        """Load the queues saved by a previous run, if any."""
+        try:
+            with open(self.queue_path) as queue_file:
+                data = json.load(queue_file)
+            self.submissions.update(data["submissions"])
+            self.subchanges.update(data["subchanges"])
+            if self.submissions or self.subchanges:
+                self.pending_since = time.time()
+        except IOError:
+            pass
+        except (ValueError, KeyError):
+            self.log_bridge.warning("Invalid queue file %s, ignoring it." %
+                                    self.queue_path)
+
+    def _save_queues(self):
+        """Save to disk, atomically, the data not yet acknowledged by
+        the ranking (being sent or queued). To be called holding the
+        lock.
+
+        """
+        submissions = dict(self.sending_submissions)
+        submissions.update(self.submissions)
+        subchanges = dict(self.sending_subchanges)
+        subchanges.update(self.subchanges)
+        try:
+            try:
+                os.makedirs(os.path.dirname(self.queue_path))
+            except OSError:
+                pass  # We assume the directory already exists...
+            temp_path = self.queue_path + ".tmp"
+            with open(temp_path, "w") as queue_file:
+                json.dump({"submissions": submissions,
+                           "subchanges": subchanges}, queue_file)
+            os.rename(temp_path, self.queue_path)
+        except (IOError, OSError) as error:
+            self.log_bridge.warning("Cannot save queue for ranking %s: %r." %
+                                    (self.address, error))
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while self.pending_since is None:
+                    self.condition.wait()
+                full = len(self.submissions) + len(self.subchanges) >= \
+                    RankingProxy.MAX_ENTITIES_PER_REQUEST
+            if not full:
+                time.sleep(config.rankings_dispatch_window)
+            self._dispatch()
+            if self.backoff > 0.0:
+                time.sleep(self.backoff)
+
+    def _dispatch(self):
+        """Send everything that is queued.
+
+        Whatever can't be sent is queued again (unless it has been
+        superseded by newer data in the meantime), and we wait longer
+        and longer before trying again.
+
+        """
+        with self.lock:
+            initialize_data = self.initialize_data
+            submissions = self.submissions
+            subchanges = self.subchanges
+            pending_since = self.pending_since
+            self.initialize_data = None
+            self.submissions = dict()
+            self.subchanges = dict()
+            self.pending_since = None
+            # They stay in the saved queues until acknowledged.
+            self.sending_submissions = submissions
+            self.sending_subchanges = subchanges
+
+        if initialize_data is None and not submissions and not subchanges:
+            return
+
+        sent = 0
+        try:
+            if initialize_data is not None:
+                self.log_bridge.info("Initializing ranking %s." %
+                                     self.address)
+                for url, data in initialize_data:
+                    self._put(url, data)
+                initialize_data = None
+
+            # Submissions have to be sent before their subchanges.
+            for url, queue in [("/submissions/", submissions),
+                               ("/subchanges/", subchanges)]:
+                while queue:
+                    keys = queue.keys()[
+                        :RankingProxy.MAX_ENTITIES_PER_REQUEST]
+                    chunk = dict((key, queue[key]) for key in keys)
+                    self._put(url, chunk)
+                    with self.lock:
+                        for key in keys:
+                            del queue[key]
+                    sent += len(chunk)
+
+        except CannotSendError:
+            self.backoff = min(max(1.0, self.backoff * 2),
+                               RankingProxy.MAX_BACKOFF_TIME)
+            self.log_bridge.info("Ranking %s not connected or generic "
+                                 "error, retrying in %.0f seconds." %
+                                 (self.address, self.backoff))
+        else:
+            self.backoff = 0.0
+
+        with self.lock:
+            self.metrics["operations_sent"] += sent
+            if self.backoff == 0.0:
+                lag = time.time() - pending_since
+                self.metrics["last_lag"] = lag
+                self.metrics["max_lag"] = max(self.metrics["max_lag"], lag)
+                self.metrics["total_lag"] += lag
+                self.metrics["batches_sent"] += 1
+            elif self.pending_since is None or \
+                    pending_since < self.pending_since:
+                # What we couldn't send is older than what has been
+                # queued in the meantime.
+                self.pending_since = pending_since
+            if self.initialize_data is None:
+                self.initialize_data = initialize_data
+            # Newer data (queued while we were sending) wins.
+            submissions.update(self.submissions)
+            self.submissions = submissions
+            subchanges.update(self.subchanges)
+            self.subchanges = subchanges
+            self.sending_submissions = dict()
+            self.sending_subchanges = dict()
+            self._save_queues()
+
+    def _put(self, url, data):
+        """Send some data to the ranking.
+
+        url (str): the relative url.
+        data (dict): the data to json-encode and send.
+
+        raise CannotSendError in case of communication errors.
+
+        """
+        body = json.dumps(data)
+        headers = {"Authorization": self.auth,
+                   "Content-Type": "application/json"}
+        if len(body) >= RankingProxy.MIN_GZIP_SIZE:
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb") as gzipped:
+                gzipped.write(body)
+            body = buf.getvalue()
+            headers["Content-Encoding"] = "gzip"
+
+        try:
+            if self.connection is None:
+                if self.protocol == "https":
+                    self.connection = HTTPSConnection(
+                        self.address, timeout=RankingProxy.REQUEST_TIMEOUT)
+                else:
+                    self.connection = HTTPConnection(
+                        self.address, timeout=RankingProxy.REQUEST_TIMEOUT)
+            self.connection.request("PUT", url, body, headers)
+            res = self.connection.getresponse()
+            res.read()
+        except Exception as error:
+            self._fail("Error %r while sending %s to ranking %s." %
+                       (error, url, self.address))
+        if res.status not in [200, 201]:
+            self._fail("Status %s while sending %s to ranking %s." %
+                       (res.status, url, self.address))
+
+        with self.lock:
+            self.metrics["requests_sent"] += 1
+            self.metrics["bytes_sent"] += len(body)
+            self.metrics["last_success"] = time.time()
+
+    def _fail(self, message):
+        """Log the failure of a request, drop the connection (a new one
+        will be opened for the next request) and raise.
+
+        message (str): what went wrong.
+
+        raise CannotSendError always.
+
+        """
+        self.log_bridge.info(message)
+        with self.lock:
+            self.metrics["requests_failed"] += 1
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        raise CannotSendError
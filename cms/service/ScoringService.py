@@ -30,88 +30,26 @@ services the scores, via http requests.
 
 """
 
-from httplib import HTTPConnection
 import threading
 import simplejson as json
 import base64
-import time
-import socket
-import ssl
+
+from sqlalchemy import and_
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql.expression import bindparam
 
 from cms import config, default_argument_parser, logger
-from cms.async import ServiceCoord
+from cms.async import ServiceCoord, get_service_shards
 from cms.async.AsyncLibrary import Service, rpc_method
 from cms.db import ask_for_contest
 from cms.db.SQLAlchemyAll import SessionGen, Submission, SubmissionResult, \
     Contest, Dataset, Task
 from cms.grading.scoretypes import get_score_type
 from cms.service import get_submission_results, get_datasets_to_judge
+from cms.service.RankingProxy import RankingProxy
 from cmscommon.DateTime import make_timestamp
 
 
-class CannotSendError(Exception):
-    pass
-
-
-# Taken from [1], with removed client key and certificate and added
-# server certificate validation. Note: tunneling capabilities have been
-# removed, too.
-#
-# [1] http://hg.python.org/releasing/2.7.3/file/7bb96963d067/Lib/httplib.py
-class HTTPSConnection(HTTPConnection):
-    """A subclass of HTTPConnection with HTTPS capabilities
-
-    Check that the certificate provided by the server is trusted using
-    the ones in config.https_certfile. This allows many configurations:
-    - a single self-signed certificate used both by SS and RWS;
-    - a different self-signed cerficiate for each RWS, all included in
-      the list used by SS;
-    - a single self-signed certificate used by SS, used to sign other
-      certificates used by the RWSs;
-    - etc.
-
-    """
-    def connect(self):
-        sock = socket.create_connection((self.host, self.port),
-                                        self.timeout, self.source_address)
-
-        self.sock = ssl.wrap_socket(sock,
-                                    ssl_version=ssl.PROTOCOL_TLSv1,
-                                    cert_reqs=ssl.CERT_REQUIRED,
-                                    ca_certs=config.https_certfile)
-
-
-# Used to store active connections to ranking servers.
-active_connections = dict()
-
-
-def get_connection(ranking, log_bridge):
-    """Return a connection to a ranking server
-
-    If we already have an open connection return that one, otherwise
-    attempt to open a new one.
-
-    ranking ((str, str)): protocol and address of ranking server
-    log_bridge (LogBridge): the bridge to use to write logs.
-
-    raise a CannotSendError if a new connection cannot be established.
-
-    """
-    if ranking[1] not in active_connections:
-        try:
-            if ranking[0] == 'https':
-                active_connections[ranking[1]] = HTTPSConnection(ranking[1])
-            elif ranking[0] == 'http':
-                active_connections[ranking[1]] = HTTPConnection(ranking[1])
-            else:
-                raise ValueError("Unknown protocol '%s'." % ranking[0])
-        except Exception as error:
-            log_bridge.info("Error %r while connecting to ranking %s." %
-                            (error, ranking[1]))
-            raise CannotSendError
-    return active_connections[ranking[1]]
-
-
 def get_authorization(username, password):
     """Compute the basic authentication string needed to send data to
     the ranking.
@@ -153,83 +91,37 @@ def encode_id(entity_id):
     return encoded_id
 
 
-def safe_put_data(connection, url, data, auth, operation, log_bridge):
-    """Send some data to url through the connection using username and
-    password specified in auth.
-
-    connection (httplib.HTTPConnection): the connection.
-    url (string): the relative url.
-    data (dict): the data to json-encode and send.
-    auth (string): the authorization as returned by get_authorization.
-    operation (str): a human-readable description of the operation
-                     we're performing (to produce log messages).
-    log_bridge (LogBridge): the bridge to use to write logs.
-
-    raise CannotSendError in case of communication errors.
-
-    """
-    try:
-        connection.request("PUT", url,
-                           json.dumps(data),
-                           {'Authorization': auth})
-        res = connection.getresponse()
-        res.read()
-    except Exception as error:
-        log_bridge.info("Error %r while %s." % (error, operation))
-        raise CannotSendError
-    if res.status not in [200, 201]:
-        log_bridge.info("Status %s while %s." % (res.status, operation))
-        raise CannotSendError
-
-
-def send_submissions(ranking, submission_put_data, log_bridge):
-    """Send a submission to the remote ranking.
-
-    ranking ((str, str, str)): protocol, address and authorization
-                               string of ranking server.
-    submission_put_data (dict): dictionary to send to the ranking to
-                                send the submission.
-    log_bridge (LogBridge): the bridge to use to write logs.
-
-    raise CannotSendError in case of communication errors.
-
-    """
-    log_bridge.info("Sending submissions to ranking %s." % ranking[1])
-
-    try:
-        safe_put_data(get_connection(ranking[:2], log_bridge), "/submissions/",
-                      submission_put_data, ranking[2],
-                      "sending submissions to ranking %s" % ranking[1],
-                      log_bridge)
-    except CannotSendError as error:
-        # Delete it to make get_connection try to create it again.
-        del active_connections[ranking[1]]
-        raise error
-
-
-def send_subchanges(ranking, subchange_put_data, log_bridge):
-    """Send a change to a submission (token or score update).
+def get_score_subchange(submission, score, ranking_score_details):
+    """Build the subchange that tells the rankings the score of a
+    submission on a dataset.
 
-    ranking ((str, str, str)): protocol, address and authorization
-                               string of ranking server.
-    subchange_put_data (dict): dictionary to send to the ranking to
-                               update the submission.
-    log_bridge (LogBridge): the bridge to use to write logs.
-
-    raise CannotSendError in case of communication errors.
+    submission (Submission): the submission.
+    score (float): its score, or None if not scored yet.
+    ranking_score_details (string): its JSON-encoded ranking score
+                                    details, as stored in the
+                                    SubmissionResult, or None.
+    return ((string, dict)): the (unencoded) subchange id and the
+                             dictionary to send to the rankings.
 
     """
-    log_bridge.info("Sending subchanges to ranking %s." % ranking[1])
-
     try:
-        safe_put_data(get_connection(ranking[:2], log_bridge), "/subchanges/",
-                      subchange_put_data, ranking[2],
-                      "sending subchanges to ranking %s" % ranking[1],
-                      log_bridge)
-    except CannotSendError as error:
-        # Delete it to make get_connection try to create it again.
-        del active_connections[ranking[1]]
-        raise error
+        ranking_score_details = json.loads(ranking_score_details)
+    except (TypeError, ValueError):
+        # It may be blank.
+        ranking_score_details = None
+
+    subchange_id = "%s%ss" % \
+        (int(make_timestamp(submission.timestamp)),
+         submission.id)
+    subchange_put_data = {
+        "submission": encode_id(submission.id),
+        "time": int(make_timestamp(submission.timestamp))}
+    if score is not None:
+        # We're sending the unrounded score to RWS
+        subchange_put_data["score"] = score
+    if ranking_score_details is not None:
+        subchange_put_data["extra"] = ranking_score_details
+    return subchange_id, subchange_put_data
 
 
 class LogBridge:
@@ -303,15 +195,15 @@ class ScoringService(Service):
 
     """
 
-    # How often we try to send data to remote rankings.
-    CHECK_DISPATCH_TIME = 5.0
-
     # How often we look for submission not scored/tokened.
     JOBS_NOT_DONE_CHECK_TIME = 347.0
 
     # How often we check for logs to be sent to LogServer
     FORWARD_LOG_TIME = 1.0
 
+    # How many old submission results we score at a time.
+    SCORE_BATCH_SIZE = 1000
+
     def __init__(self, shard, contest_id):
         logger.initialize(ServiceCoord("ScoringService", shard))
         Service.__init__(self, shard, custom_logger=logger)
@@ -344,27 +236,23 @@ class ScoringService(Service):
         self.submissions_tokened = set()
 
         # Initialize ranking web servers we need to send data to.
+        self.log_bridge = LogBridge()
         self.rankings = []
         for i in xrange(len(config.rankings_address)):
             address = config.rankings_address[i]
             username = config.rankings_username[i]
             password = config.rankings_password[i]
-            self.rankings.append((address[0],  # HTTP / HTTPS
-                                  "%s:%d" % tuple(address[1:]),
-                                  get_authorization(username, password)))
-        self.initialize_queue = set()
-        self.submission_queue = dict()
-        self.subchange_queue = dict()
-        self.operation_queue_lock = threading.Lock()
-
-        for ranking in self.rankings:
-            self.initialize_queue.add(ranking)
-
-        self.log_bridge = LogBridge()
-        thread = threading.Thread(target=self.dispath_operations_thread,
-                                  args=(self.log_bridge,))
-        thread.daemon = True
-        thread.start()
+            self.rankings.append(RankingProxy(
+                address[0],  # HTTP / HTTPS
+                "%s:%d" % tuple(address[1:]),
+                get_authorization(username, password),
+                self.log_bridge))
+        self.initialize_rankings()
+
+        # The CWSs, to tell them when a submission has been scored.
+        self.contest_web_servers = [
+            self.connect_to(ServiceCoord("ContestWebServer", i))
+            for i in xrange(get_service_shards("ContestWebServer"))]
 
         self.add_timeout(self.search_jobs_not_done, None,
                          ScoringService.JOBS_NOT_DONE_CHECK_TIME,
@@ -374,15 +262,23 @@ class ScoringService(Service):
                          ScoringService.FORWARD_LOG_TIME,
                          immediately=True)
 
-    def dispath_operations_thread(self, log_bridge):
-        while True:
-            self.dispatch_operations(log_bridge)
-            time.sleep(ScoringService.CHECK_DISPATCH_TIME)
-
     def forward_logs(self):
         self.log_bridge.push_logs(logger)
         return True
 
+    def notify_submission_status(self, user_task_ids):
+        """Tell the ContestWebServers that the status of some
+        submissions changed.
+
+        user_task_ids (set): the (user_id, task_id) pairs of the
+                             submissions.
+
+        """
+        for user_id, task_id in user_task_ids:
+            for contest_web_server in self.contest_web_servers:
+                contest_web_server.submission_status_changed(
+                    user_id=user_id, task_id=task_id)
+
     def _initialize_scorers(self):
         """Initialize scorers, the ScoreType objects holding all
         submissions for a given task and deciding scores, and create
@@ -466,14 +362,15 @@ class ScoringService(Service):
         self.scoring_old_submission = True
         to_score = len(self.submission_results_to_score)
         to_token = len(self.submissions_to_token)
-        to_score_now = to_score if to_score < 4 else 4
+        to_score_now = min(to_score, ScoringService.SCORE_BATCH_SIZE)
         to_token_now = to_token if to_token < 16 else 16
         logger.info("Old submission yet to score/token: %s/%s." %
                     (to_score, to_token))
 
-        for unused_i in xrange(to_score_now):
-            submission_id, dataset_id = self.submission_results_to_score.pop()
-            self.new_evaluation(submission_id, dataset_id)
+        if to_score_now > 0:
+            self.score_submission_results(
+                [self.submission_results_to_score.pop()
+                 for unused_i in xrange(to_score_now)])
         if to_score - to_score_now > 0:
             return True
 
@@ -487,147 +384,74 @@ class ScoringService(Service):
         self.scoring_old_submission = False
         return False
 
-    def dispatch_operations(self, log_bridge):
-        """Look at the operations still to do in the queue and tries
-        to dispatch them
-
-        log_bridge (LogBridge): the bridge to use to write logs.
+    def initialize_rankings(self):
+        """Send to the rankings all the data that are supposed to be
+        sent before the contest: contest, users, tasks. No support for
+        teams, flags and faces.
 
         """
-        with self.operation_queue_lock:
-            initialize_queue = self.initialize_queue
-            submission_queue = self.submission_queue
-            subchange_queue = self.subchange_queue
-            self.initialize_queue = set()
-            self.submission_queue = dict()
-            self.subchange_queue = dict()
-        pending = len(initialize_queue) + \
-            len(submission_queue) + \
-            len(subchange_queue)
-        if pending > 0:
-            log_bridge.info("%s operations still pending." % pending)
-
-        failed_rankings = set()
-
-        new_initialize_queue = set()
-        for ranking in initialize_queue:
-            if ranking in failed_rankings:
-                new_initialize_queue.add(ranking)
-                continue
-            try:
-                self.initialize(ranking, log_bridge)
-            except:
-                log_bridge.info("Ranking %s not connected or generic error." %
-                               ranking[1])
-                new_initialize_queue.add(ranking)
-                failed_rankings.add(ranking)
-
-        new_submission_queue = dict()
-        for ranking, data in submission_queue.iteritems():
-            if ranking in failed_rankings:
-                new_submission_queue[ranking] = data
-                continue
-            try:
-                send_submissions(ranking, data, log_bridge)
-            except:
-                log_bridge.info("Ranking %s not connected or generic error." %
-                               ranking[1])
-                new_submission_queue[ranking] = data
-                failed_rankings.add(ranking)
-
-        new_subchange_queue = dict()
-        for ranking, data in subchange_queue.iteritems():
-            if ranking in failed_rankings:
-                new_subchange_queue[ranking] = data
-                continue
-            try:
-                send_subchanges(ranking, data, log_bridge)
-            except:
-                log_bridge.info("Ranking %s not connected or generic error." %
-                               ranking[1])
-                new_subchange_queue[ranking] = data
-                failed_rankings.add(ranking)
-
-        with self.operation_queue_lock:
-            self.initialize_queue |= new_initialize_queue
-            for r in set(self.submission_queue) | set(new_submission_queue):
-                new_submission_queue.setdefault(r, dict()). \
-                    update(self.submission_queue.get(r, dict()))
-            self.submission_queue = new_submission_queue
-            for r in set(self.subchange_queue) | set(new_subchange_queue):
-                new_subchange_queue.setdefault(r, dict()). \
-                    update(self.subchange_queue.get(r, dict()))
-            self.subchange_queue = new_subchange_queue
-
-        # We want this to run forever.
-        return True
+        with SessionGen(commit=False) as session:
+            contest = Contest.get_from_id(self.contest_id, session)
 
-    def initialize(self, ranking, log_bridge):
-        """Send to the ranking all the data that are supposed to be
-        sent before the contest: contest, users, tasks. No support for
-        teams, flags and faces.
+            if contest is None:
+                logger.error("Received request for unexistent contest "
+                             "id %s." % self.contest_id)
+                raise KeyError
+            contest_url = "/contests/%s" % encode_id(contest.name)
+            contest_data = {
+                "name": contest.description,
+                "begin": int(make_timestamp(contest.start)),
+                "end": int(make_timestamp(contest.stop)),
+                "score_precision": contest.score_precision}
+
+            users = dict((encode_id(user.username),
+                          {"f_name": user.first_name,
+                           "l_name": user.last_name,
+                           "team": None})
+                         for user in contest.users
+                         if not user.hidden)
+
+            tasks = dict((encode_id(task.name),
+                          {"name": task.title,
+                           "contest": encode_id(contest.name),
+                           "max_score": 100.0,
+                           "score_precision": task.score_precision,
+                           "extra_headers": [],
+                           "order": task.num,
+                           "short_name": task.name})
+                         for task in contest.tasks)
+
+        for ranking in self.rankings:
+            ranking.initialize([(contest_url, contest_data),
+                                ("/users/", users),
+                                ("/tasks/", tasks)])
 
-        ranking ((str, str, str)): protocol, address and authorization
-                                   string of ranking server.
-        log_bridge (LogBridge): the bridge to use to write logs.
+    def enqueue_ranking_operations(self, submissions, subchanges):
+        """Queue data to be sent to all the rankings.
 
-        raise CannotSendError in case of communication errors.
+        submissions (dict): submission data, indexed by submission id.
+        subchanges ([(str, dict)]): pairs of subchange id and data.
 
         """
-        log_bridge.info("Initializing ranking %s." % ranking[1])
-
-        try:
-            connection = get_connection(ranking[:2], log_bridge)
-            auth = ranking[2]
-
-            with SessionGen(commit=False) as session:
-                contest = Contest.get_from_id(self.contest_id, session)
-
-                if contest is None:
-                    log_bridge.error("Received request for unexistent contest "
-                                   "id %s." % self.contest_id)
-                    raise KeyError
-                contest_name = contest.name
-                contest_url = "/contests/%s" % encode_id(contest_name)
-                contest_data = {
-                    "name": contest.description,
-                    "begin": int(make_timestamp(contest.start)),
-                    "end": int(make_timestamp(contest.stop)),
-                    "score_precision": contest.score_precision}
-
-                users = dict((encode_id(user.username),
-                              {"f_name": user.first_name,
-                               "l_name": user.last_name,
-                               "team": None})
-                             for user in contest.users
-                             if not user.hidden)
-
-                tasks = dict((encode_id(task.name),
-                              {"name": task.title,
-                               "contest": encode_id(contest.name),
-                               "max_score": 100.0,
-                               "score_precision": task.score_precision,
-                               "extra_headers": [],
-                               "order": task.num,
-                               "short_name": task.name})
-                             for task in contest.tasks)
-
-            safe_put_data(connection, contest_url, contest_data, auth,
-                          "sending contest %s to ranking %s" %
-                          (contest_name, ranking[1]), log_bridge)
-
-            safe_put_data(connection, "/users/", users, auth,
-                          "sending users to ranking %s" % ranking[1],
-                          log_bridge)
-
-            safe_put_data(connection, "/tasks/", tasks, auth,
-                          "sending tasks to ranking %s" % ranking[1],
-                          log_bridge)
-
-        except CannotSendError as error:
-            # Delete it to make get_connection try to create it again.
-            del active_connections[ranking[1]]
-            raise error
+        submissions = dict((encode_id(submission_id), data)
+                           for submission_id, data
+                           in submissions.iteritems())
+        subchanges = dict((encode_id(subchange_id), data)
+                          for subchange_id, data in subchanges)
+        for ranking in self.rankings:
+            if submissions:
+                ranking.add_submissions(submissions)
+            if subchanges:
+                ranking.add_subchanges(subchanges)
+
+    @rpc_method
+    def get_ranking_metrics(self):
+        """Return statistics on the data sent to each ranking.
+
+        return ([dict]): the metrics of each ranking.
+
+        """
+        return [ranking.get_metrics() for ranking in self.rankings]
 
     @rpc_method
     def reinitialize(self):
@@ -640,9 +464,7 @@ class ScoringService(Service):
         logger.info("Reinitializing rankings.")
         self.scorers = {}
         self._initialize_scorers()
-        with self.operation_queue_lock:
-            for ranking in self.rankings:
-                self.initialize_queue.add(ranking)
+        self.initialize_rankings()
 
     @rpc_method
     def new_evaluation(self, submission_id, dataset_id):
@@ -689,40 +511,28 @@ class ScoringService(Service):
 
             # Assign score to the submission.
             scorer = self.scorers[dataset_id]
-            scorer.add_submission(submission_id, submission.timestamp,
-                                  submission.user.username,
-                                  submission_result.evaluated(),
-                                  dict((ev.num,
-                                        {"outcome": ev.outcome,
-                                         "text": ev.text,
-                                         "time": ev.execution_time,
-                                         "memory": ev.memory_used})
-                                       for ev in submission_result.evaluations),
-                                  submission.tokened())
+            changed_submission_ids = scorer.add_submission(
+                submission_id, submission.timestamp,
+                submission.user.username,
+                submission_result.evaluated(),
+                dict((ev.num,
+                      {"outcome": ev.outcome,
+                       "text": ev.text,
+                       "time": ev.execution_time,
+                       "memory": ev.memory_used})
+                     for ev in submission_result.evaluations),
+                submission.tokened())
 
             # Mark submission as scored.
             self.submission_results_scored.add((submission_id, dataset_id))
 
             # Filling submission's score info in the db.
-            submission_result.score = \
-                scorer.pool[submission_id]["score"]
-            submission_result.public_score = \
-                scorer.pool[submission_id]["public_score"]
-
-            # And details.
-            submission_result.score_details = \
-                scorer.pool[submission_id]["details"]
-            submission_result.public_score_details = \
-                scorer.pool[submission_id]["public_details"]
-            submission_result.ranking_score_details = \
-                scorer.pool[submission_id]["ranking_details"]
+            self._save_score(scorer, submission_result)
 
-            try:
-                ranking_score_details = json.loads(
-                        submission_result.ranking_score_details)
-            except (TypeError, ValueError):
-                # It may be blank.
-                ranking_score_details = None
+            # Some score types (e.g., Relative) may have changed the
+            # score of other submissions, too.
+            subchanges = self._save_changed_scores(
+                scorer, dataset, changed_submission_ids, session)
 
             # If we are not a live dataset then we can bail out here,
             # and avoid updating RWS.
@@ -734,32 +544,205 @@ class ScoringService(Service):
                 "user": encode_id(submission.user.username),
                 "task": encode_id(submission.task.name),
                 "time": int(make_timestamp(submission.timestamp))}
-            subchange_id = "%s%ss" % \
-                (int(make_timestamp(submission.timestamp)),
-                 submission_id)
-            subchange_put_data = {
-                "submission": encode_id(submission_id),
-                "time": int(make_timestamp(submission.timestamp)),
-                # We're sending the unrounded score to RWS
-                "score": submission_result.score}
-            if ranking_score_details is not None:
-                subchange_put_data["extra"] = ranking_score_details
+            subchanges.append(get_score_subchange(
+                submission, submission_result.score,
+                submission_result.ranking_score_details))
+            user_task_id = (submission.user_id, submission.task_id)
 
-        # TODO: ScoreRelative here does not work with remote
-        # rankings (it does in the ranking view) because we
-        # update only the user owning the submission.
+        self.notify_submission_status([user_task_id])
 
         # Adding operations to the queue.
-        with self.operation_queue_lock:
-            for ranking in self.rankings:
-                self.submission_queue.setdefault(
-                    ranking,
-                    dict())[encode_id(submission_id)] = \
-                    submission_put_data
-                self.subchange_queue.setdefault(
-                    ranking,
-                    dict())[encode_id(subchange_id)] = \
-                    subchange_put_data
+        self.enqueue_ranking_operations(
+            {submission_id: submission_put_data}, subchanges)
+
+    def score_submission_results(self, submission_result_ids):
+        """Score many submission results at once.
+
+        The outcome is the same as calling new_evaluation on each of
+        them, but the submission results, their submissions and
+        evaluations are loaded with a few queries per dataset, the
+        scores are written back with a single bulk UPDATE per dataset
+        and the operations for the rankings are enqueued only once.
+
+        submission_result_ids ([(int, int)]): the (submission_id,
+                                              dataset_id) pairs to
+                                              score.
+
+        """
+        by_dataset = {}
+        for submission_id, dataset_id in submission_result_ids:
+            by_dataset.setdefault(dataset_id, set()).add(submission_id)
+
+        submissions_put_data = {}
+        subchanges = []
+        user_task_ids = set()
+        with SessionGen(commit=True) as session:
+            for dataset_id, submission_ids in by_dataset.iteritems():
+                dataset = Dataset.get_from_id(dataset_id, session)
+                if dataset is None:
+                    logger.error("[score_submission_results] Couldn't "
+                                 "find dataset %d in the database." %
+                                 dataset_id)
+                    continue
+                scorer = self.scorers[dataset_id]
+                live = dataset is dataset.task.active_dataset
+
+                # We feed the submissions to the scorer ordered by
+                # timestamp, as that is what it expects.
+                results = session.query(Submission, SubmissionResult)\
+                    .join(SubmissionResult)\
+                    .filter(SubmissionResult.dataset_id == dataset_id)\
+                    .filter(SubmissionResult.submission_id.in_(
+                        submission_ids))\
+                    .options(joinedload(Submission.user))\
+                    .options(joinedload(Submission.token))\
+                    .options(joinedload(SubmissionResult.evaluations))\
+                    .order_by(Submission.timestamp, Submission.id).all()
+
+                scored = set()
+                to_save = set()
+                skipped = 0
+                for submission, submission_result in results:
+                    if not submission_result.compiled() or \
+                            (submission_result.compilation_outcome == "ok"
+                             and not submission_result.evaluated()) or \
+                            submission.user.hidden:
+                        skipped += 1
+                        continue
+
+                    scored.add(submission.id)
+                    to_save.add(submission.id)
+                    to_save |= scorer.add_submission(
+                        submission.id, submission.timestamp,
+                        submission.user.username,
+                        submission_result.evaluated(),
+                        dict((ev.num,
+                              {"outcome": ev.outcome,
+                               "text": ev.text,
+                               "time": ev.execution_time,
+                               "memory": ev.memory_used})
+                             for ev in submission_result.evaluations),
+                        submission.tokened())
+                    self.submission_results_scored.add(
+                        (submission.id, dataset_id))
+
+                    if live:
+                        user_task_ids.add((submission.user_id,
+                                           submission.task_id))
+                        submissions_put_data[submission.id] = {
+                            "user": encode_id(submission.user.username),
+                            "task": encode_id(submission.task.name),
+                            "time": int(make_timestamp(
+                                submission.timestamp))}
+
+                logger.info("Scored %d submission results on dataset %d "
+                            "(%d other scores changed, %d skipped)." %
+                            (len(scored), dataset_id,
+                             len(to_save - scored), skipped))
+                if len(to_save) == 0:
+                    continue
+
+                # Bind parameters cannot have the same name as the
+                # columns they update, hence the prefix.
+                values = []
+                for submission_id in to_save:
+                    data = dict(
+                        ("_" + key, value) for key, value in
+                        self._get_score_values(scorer,
+                                               submission_id).iteritems())
+                    data["_submission_id"] = submission_id
+                    data["_dataset_id"] = dataset_id
+                    values.append(data)
+                table = SubmissionResult.__table__
+                session.execute(
+                    table.update()
+                    .where(and_(
+                        table.c.submission_id == bindparam("_submission_id"),
+                        table.c.dataset_id == bindparam("_dataset_id")))
+                    .values(
+                        score=bindparam("_score"),
+                        public_score=bindparam("_public_score"),
+                        score_details=bindparam("_score_details"),
+                        public_score_details=bindparam(
+                            "_public_score_details"),
+                        ranking_score_details=bindparam(
+                            "_ranking_score_details")),
+                    values)
+
+                if live:
+                    for submission in session.query(Submission)\
+                            .filter(Submission.id.in_(to_save)).all():
+                        data = scorer.pool[submission.id]
+                        subchanges.append(get_score_subchange(
+                            submission, data["score"],
+                            data["ranking_details"]))
+
+        self.notify_submission_status(user_task_ids)
+
+        # Adding operations to the queue.
+        self.enqueue_ranking_operations(submissions_put_data, subchanges)
+
+    def _get_score_values(self, scorer, submission_id):
+        """Return the values of the score columns of a
+        SubmissionResult, as computed by the scorer.
+
+        scorer (ScoreType): the scorer of the result's dataset.
+        submission_id (int): the id of the submission.
+
+        return (dict): column name to value.
+
+        """
+        data = scorer.pool[submission_id]
+        return {
+            "score": data["score"],
+            "public_score": data["public_score"],
+            "score_details": data["details"],
+            "public_score_details": data["public_details"],
+            "ranking_score_details": data["ranking_details"],
+            }
+
+    def _save_score(self, scorer, submission_result):
+        """Copy in submission_result the score and details that the
+        scorer computed for its submission.
+
+        scorer (ScoreType): the scorer of the result's dataset.
+        submission_result (SubmissionResult): the result to fill.
+
+        """
+        for key, value in self._get_score_values(
+                scorer, submission_result.submission_id).iteritems():
+            setattr(submission_result, key, value)
+
+    def _save_changed_scores(self, scorer, dataset, submission_ids,
+                             session):
+        """Save in the db the scores of submissions that the scorer
+        changed as a side effect of another operation.
+
+        scorer (ScoreType): the scorer of the dataset.
+        dataset (Dataset): the dataset.
+        submission_ids (set): ids of the changed submissions.
+        session (Session): the session to use.
+
+        return ([(string, dict)]): the subchanges to send to the
+                                   rankings, empty if the dataset is
+                                   not live.
+
+        """
+        subchanges = []
+        for submission_id in submission_ids:
+            submission = Submission.get_from_id(submission_id, session)
+            submission_result = submission.get_result(dataset)
+            if submission_result is None:
+                continue
+            self._save_score(scorer, submission_result)
+            if dataset is submission.task.active_dataset:
+                subchanges.append(get_score_subchange(
+                    submission, submission_result.score,
+                    submission_result.ranking_score_details))
+        if len(submission_ids) > 0:
+            logger.info("Score of %d submissions changed on "
+                        "dataset %d." % (len(submission_ids), dataset.id))
+        return subchanges
 
     @rpc_method
     def submission_tokened(self, submission_id):
@@ -770,7 +753,7 @@ class ScoringService(Service):
         timestamp (int): the time of the token.
 
         """
-        with SessionGen(commit=False) as session:
+        with SessionGen(commit=True) as session:
             submission = Submission.get_from_id(submission_id, session)
             if submission is None:
                 logger.error("[submission_tokened] Received token request for "
@@ -784,6 +767,17 @@ class ScoringService(Service):
             # Mark submission as tokened.
             self.submissions_tokened.add(submission_id)
 
+            # Inform the scorers that already know the submission, as
+            # the token may change other scores (e.g., with Relative).
+            subchanges = []
+            for dataset in get_datasets_to_judge(submission.task):
+                scorer = self.scorers.get(dataset.id)
+                if scorer is None or submission_id not in scorer.pool:
+                    continue
+                changed_submission_ids = scorer.add_token(submission_id)
+                subchanges.extend(self._save_changed_scores(
+                    scorer, dataset, changed_submission_ids, session))
+
             # Data to send to remote rankings.
             submission_put_data = {
                 "user": encode_id(submission.user.username),
@@ -796,18 +790,11 @@ class ScoringService(Service):
                 "submission": encode_id(submission_id),
                 "time": int(make_timestamp(submission.token.timestamp)),
                 "token": True}
+            subchanges.append((subchange_id, subchange_put_data))
 
         # Adding operations to the queue.
-        with self.operation_queue_lock:
-            for ranking in self.rankings:
-                self.submission_queue.setdefault(
-                    ranking,
-                    dict())[encode_id(submission_id)] = \
-                    submission_put_data
-                self.subchange_queue.setdefault(
-                    ranking,
-                    dict())[encode_id(subchange_id)] = \
-                    subchange_put_data
+        self.enqueue_ranking_operations(
+            {submission_id: submission_put_data}, subchanges)
 
     @rpc_method
     def invalidate_submission(self,
@@ -891,38 +878,15 @@ class ScoringService(Service):
 
                 if submission_result is None:
                     # Not yet compiled, evaluated or scored.
-                    score = None
-                    ranking_score_details = None
+                    subchanges.append(get_score_subchange(
+                        submission, None, None))
                 else:
-                    score = submission_result.score
-                    try:
-                        ranking_score_details = json.loads(
-                                submission_result.ranking_score_details)
-                    except (TypeError, ValueError):
-                        # It may be blank.
-                        ranking_score_details = None
-
-                # Data to send to remote rankings.
-                subchange_id = "%s%ss" % \
-                    (int(make_timestamp(submission.timestamp)),
-                     submission.id)
-                subchange_put_data = {
-                    "submission": encode_id(submission.id),
-                    "time": int(make_timestamp(submission.timestamp))}
-                if score is not None:
-                    # We're sending the unrounded score to RWS
-                    subchange_put_data["score"] = score
-                if ranking_score_details is not None:
-                    subchange_put_data["extra"] = ranking_score_details
-                subchanges.append((subchange_id, subchange_put_data))
+                    subchanges.append(get_score_subchange(
+                        submission, submission_result.score,
+                        submission_result.ranking_score_details))
 
         # Adding operations to the queue.
-        with self.operation_queue_lock:
-            for ranking in self.rankings:
-                for subchange_id, data in subchanges:
-                    self.subchange_queue.setdefault(
-                        ranking,
-                        dict())[encode_id(subchange_id)] = data
+        self.enqueue_ranking_operations({}, subchanges)
 
 
 def main():
@@ -48,17 +48,19 @@ class Loader:
     # Description of this loader, meant to be human readable.
     description = None
 
-    def __init__(self, path, file_cacher):
+    def __init__(self, path, file_cacher, jobs=4):
         """Initialize the Loader.
 
         path (str): the filesystem location given by the user.
         file_cacher (FileCacher): the file cacher to use to store
                                   files (i.e. statements, managers,
                                   testcases, etc.).
+        jobs (int): how many files the loader may store concurrently.
 
         """
         self.path = path
         self.file_cacher = file_cacher
+        self.jobs = jobs
 
     @classmethod
     def detect(cls, path):
@@ -28,11 +28,16 @@ idempotent.
 
 import io
 import argparse
+import hashlib
 import os
 import shutil
 import simplejson as json
-import tempfile
 import tarfile
+import threading
+import time
+from collections import deque
+from Queue import Queue, Empty
+from StringIO import StringIO
 
 from sqlalchemy.types import \
     Boolean, Integer, Float, String, DateTime, Interval
@@ -89,23 +94,61 @@ def get_archive_info(file_name):
     return ret
 
 
+class HashingReader(object):
+
+    """Wrap a file-like object, computing the SHA1 digest of what is
+    read from it.
+
+    """
+
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self.hasher = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self.fobj.read(size)
+        self.hasher.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
 class ContestExporter:
 
     """This service exports every data about the contest that CMS
     knows. The process of exporting and importing again should be
     idempotent.
 
+    Files are retrieved concurrently by a pool of threads. When
+    exporting to an archive they are streamed into it as soon as they
+    are ready, without being written to disk first. When exporting to
+    a directory, the digests of the files already retrieved are kept
+    in a checkpoint file, so that an interrupted export can be resumed
+    without retrieving them again.
+
     """
 
+    # Name of the file, in the export directory, listing the digests
+    # already retrieved.
+    CHECKPOINT_FILENAME = ".checkpoint"
+
+    # Files larger than this are not read in memory by the threads,
+    # but streamed from the storage to the archive.
+    MAX_BUFFERED_SIZE = 16 * 2 ** 20
+
     def __init__(self, contest_id, export_target,
                  dump_files, dump_model, light,
-                 skip_submissions, skip_user_tests):
+                 skip_submissions, skip_user_tests,
+                 jobs=4, resume=False):
         self.contest_id = contest_id
         self.dump_files = dump_files
         self.dump_model = dump_model
         self.light = light
         self.skip_submissions = skip_submissions
         self.skip_user_tests = skip_user_tests
+        self.jobs = jobs
+        self.resume = resume
 
         # If target is not provided, we use the contest's name.
         if export_target == "":
@@ -126,6 +169,7 @@ class ContestExporter:
 
         export_dir = self.export_target
         archive_info = get_archive_info(self.export_target)
+        archive = None
 
         if archive_info["write_mode"] != "":
             # We are able to write to this archive.
@@ -133,73 +177,317 @@ class ContestExporter:
                 logger.critical("The specified file already exists, "
                                 "I won't overwrite it.")
                 return False
-            export_dir = os.path.join(tempfile.mkdtemp(),
-                                      archive_info["basename"])
+            # The archive (and the JSON model that goes in it) is
+            # written here until completed. Files are streamed into
+            # the archive, they are not staged on disk.
+            export_dir = self.export_target + ".partial"
+            if self.resume and os.path.exists(export_dir):
+                # A compressed archive can't be appended to.
+                logger.warning("Exports to an archive can't be resumed, "
+                               "starting over.")
+                shutil.rmtree(export_dir)
 
         logger.info("Creating dir structure.")
-        try:
+        if os.path.exists(export_dir):
+            if not self.resume or not os.path.exists(
+                    os.path.join(export_dir, self.CHECKPOINT_FILENAME)):
+                logger.critical("The directory %s already exists and is "
+                                "not a resumable export, I won't "
+                                "overwrite it." % export_dir)
+                return False
+            logger.info("Resuming the export in %s." % export_dir)
+        else:
             os.mkdir(export_dir)
-        except OSError:
-            logger.critical("The specified directory already exists, "
-                            "I won't overwrite it.")
-            return False
-
-        files_dir = os.path.join(export_dir, "files")
-        descr_dir = os.path.join(export_dir, "descriptions")
-        os.mkdir(files_dir)
-        os.mkdir(descr_dir)
-
-        with SessionGen(commit=False) as session:
-
-            contest = Contest.get_from_id(self.contest_id, session)
-
-            # Export files.
-            if self.dump_files:
-                logger.info("Exporting files.")
-                files = contest.enumerate_files(self.skip_submissions,
-                                                self.skip_user_tests,
-                                                self.light)
-                for file_ in files:
-                    if not self.safe_get_file(file_,
-                                              os.path.join(files_dir, file_),
-                                              os.path.join(descr_dir, file_)):
-                        return False
 
-            # Export the contest in JSON format.
-            if self.dump_model:
-                logger.info("Exporting the contest to a JSON file.")
-
-                # We use strings because they'll be the keys of a JSON
-                # object; the contest will have ID 0.
-                self.ids = {contest.sa_identity_key: "0"}
-                self.queue = [contest]
+        if archive_info["write_mode"] != "":
+            archive_path = os.path.join(export_dir,
+                                        "archive.%s" %
+                                        archive_info["extension"])
+            archive = tarfile.open(archive_path, archive_info["write_mode"])
+        else:
+            for directory in ["files", "descriptions"]:
+                if not os.path.exists(os.path.join(export_dir, directory)):
+                    os.mkdir(os.path.join(export_dir, directory))
+            checkpoint_path = os.path.join(export_dir,
+                                           self.CHECKPOINT_FILENAME)
+            io.open(checkpoint_path, "ab").close()
 
-                data = dict()
-                while len(self.queue) > 0:
-                    obj = self.queue.pop(0)
-                    data[self.ids[obj.sa_identity_key]] = self.export_object(obj)
+        try:
+            with SessionGen(commit=False) as session:
 
-                # Specify the "root" of the data graph
-                data["_objects"] = ["0"]
+                contest = Contest.get_from_id(self.contest_id, session)
 
-                with io.open(os.path.join(export_dir,
-                                          "contest.json"), "wb") as fout:
-                    json.dump(data, fout, encoding="utf-8",
-                              indent=4, sort_keys=True)
+                # Export files.
+                if self.dump_files:
+                    logger.info("Exporting files.")
+                    files = contest.enumerate_files(self.skip_submissions,
+                                                    self.skip_user_tests,
+                                                    self.light)
+                    if not self.export_files(files, export_dir, archive,
+                                             archive_info["basename"]):
+                        return False
 
-        # If the admin requested export to file, we do that.
-        if archive_info["write_mode"] != "":
-            archive = tarfile.open(self.export_target,
-                                   archive_info["write_mode"])
-            archive.add(export_dir, arcname=archive_info["basename"])
-            archive.close()
-            shutil.rmtree(export_dir)
+                # Export the contest in JSON format.
+                if self.dump_model:
+                    logger.info("Exporting the contest to a JSON file.")
+                    model_path = os.path.join(export_dir, "contest.json")
+                    self.export_model(contest, model_path)
+                    if archive is not None:
+                        archive.add(model_path,
+                                    arcname=os.path.join(
+                                        archive_info["basename"],
+                                        "contest.json"))
+
+            # If the admin requested export to file, we complete it.
+            if archive is not None:
+                archive.close()
+                os.rename(archive_path, self.export_target)
+            else:
+                os.remove(checkpoint_path)
+        finally:
+            # Whether the export to an archive succeeded or not, the
+            # staging directory goes: it can't be resumed anyway.
+            if archive is not None:
+                archive.close()
+                shutil.rmtree(export_dir, ignore_errors=True)
 
         logger.info("Export finished.")
         logger.operation = ""
 
         return True
 
+    def export_files(self, files, export_dir, archive=None, basename=""):
+        """Retrieve files from the storage using self.jobs threads.
+
+        When exporting to a directory the files and their descriptions
+        are written in its "files" and "descriptions" subdirectories;
+        those listed in the checkpoint are skipped and the others are
+        added to it as soon as they are retrieved. When exporting to
+        an archive they are added to it (by this thread, as TarFile
+        isn't thread-safe) from memory or straight from the storage,
+        without being written to disk first.
+
+        files (set): digests of the files to export.
+        export_dir (string): the directory of the export.
+        archive (TarFile): if not None, the archive where to add the
+                           files.
+        basename (string): root directory of the archive.
+
+        return (bool): True if all ok, False if something wrong.
+
+        """
+        files_dir = None
+        descr_dir = None
+        checkpoint_path = None
+        done = set()
+        if archive is None:
+            files_dir = os.path.join(export_dir, "files")
+            descr_dir = os.path.join(export_dir, "descriptions")
+            checkpoint_path = os.path.join(export_dir,
+                                           self.CHECKPOINT_FILENAME)
+            with io.open(checkpoint_path, "rb") as checkpoint:
+                done = set(line.strip() for line in checkpoint) & files
+        to_fetch = list(files - done)
+        logger.info("%d files to export, %d already retrieved." %
+                    (len(files), len(done)))
+
+        in_queue = Queue()
+        out_queue = Queue()
+        stop = threading.Event()
+        for unused_i in xrange(self.jobs):
+            thread = threading.Thread(target=self.fetch_files_thread,
+                                      args=(in_queue, out_queue, stop,
+                                            files_dir, descr_dir))
+            thread.daemon = True
+            thread.start()
+
+        # We give the threads at most twice as many files as they are,
+        # so that those waiting to enter the archive can't fill the
+        # memory.
+        in_flight = min(len(to_fetch), 2 * self.jobs)
+        for digest in to_fetch[:in_flight]:
+            in_queue.put(digest)
+        next_index = in_flight
+
+        checkpoint = None
+        if checkpoint_path is not None:
+            checkpoint = io.open(checkpoint_path, "ab")
+        try:
+            for i in xrange(len(to_fetch)):
+                # Waiting with a timeout keeps the main thread
+                # interruptible.
+                while True:
+                    try:
+                        digest, error, data, description = \
+                            out_queue.get(timeout=1.0)
+                        break
+                    except Empty:
+                        pass
+                if next_index < len(to_fetch):
+                    in_queue.put(to_fetch[next_index])
+                    next_index += 1
+
+                if error is None and archive is not None:
+                    error = self.add_file_to_archive(
+                        archive, basename, digest, data, description)
+                if error is not None:
+                    logger.critical(error)
+                    return False
+
+                if checkpoint is not None:
+                    checkpoint.write(digest + "\n")
+                    checkpoint.flush()
+
+                if (i + 1) % 1000 == 0:
+                    logger.info("Retrieved %d files out of %d." %
+                                (i + 1, len(to_fetch)))
+        finally:
+            stop.set()
+            for unused_i in xrange(self.jobs):
+                # The None tells the thread to terminate.
+                in_queue.put(None)
+            if checkpoint is not None:
+                checkpoint.close()
+
+        return True
+
+    def fetch_files_thread(self, in_queue, out_queue, stop,
+                           files_dir, descr_dir):
+        """Body of the threads retrieving files. For each digest in
+        in_queue (until a None, or until stop is set), put in
+        out_queue the tuple (digest, error, data, description), where
+        error is None if all ok; see fetch_file for the rest.
+
+        The errors are logged by the main thread, which stops the
+        export.
+
+        """
+        while True:
+            digest = in_queue.get()
+            if digest is None or stop.is_set():
+                return
+            try:
+                data, description = \
+                    self.fetch_file(digest, files_dir, descr_dir)
+            except Exception as error:
+                out_queue.put((digest,
+                               "File %s could not be retrieved (%r)." %
+                               (digest, error), None, None))
+            else:
+                out_queue.put((digest, None, data, description))
+
+    def fetch_file(self, digest, files_dir, descr_dir):
+        """Retrieve a file, in a thread of the pool.
+
+        digest (string): the digest of the file.
+        files_dir (string): if not None, the directory where to write
+                            the file, and descr_dir the one where to
+                            write its description.
+        descr_dir (string): see files_dir.
+
+        return ((string, unicode)): the content of the file (None if
+                                    written to files_dir, or if it is
+                                    larger than MAX_BUFFERED_SIZE and
+                                    thus has to be streamed from the
+                                    storage) and its description.
+
+        raise (Exception): if the file can't be retrieved or its
+                           digest is wrong.
+
+        """
+        if files_dir is not None:
+            error = self.safe_get_file(digest,
+                                       os.path.join(files_dir, digest),
+                                       os.path.join(descr_dir, digest))
+            if error is not None:
+                raise Exception(error)
+            return None, None
+
+        backend = self.file_cacher.backend
+        description = backend.describe(digest) or u""
+        size = backend.get_size(digest)
+        if size is None:
+            raise KeyError("File %s not found." % digest)
+        if size > self.MAX_BUFFERED_SIZE:
+            return None, description
+        with backend.open_file(digest) as fobj:
+            data = fobj.read()
+        calc_digest = hashlib.sha1(data).hexdigest()
+        if digest != calc_digest:
+            raise ValueError("File %s has wrong hash %s." %
+                             (digest, calc_digest))
+        return data, description
+
+    def add_file_to_archive(self, archive, basename, digest,
+                            data, description):
+        """Add a retrieved file and its description to the archive.
+
+        archive (TarFile): the archive.
+        basename (string): root directory of the archive.
+        digest (string): the digest of the file.
+        data (string): its content, or None to stream it from the
+                       storage.
+        description (unicode): its description.
+
+        return (string): None if all ok, a description of the error
+                         if something wrong.
+
+        """
+        now = time.time()
+        try:
+            info = tarfile.TarInfo(os.path.join(basename, "files", digest))
+            info.mtime = now
+            if data is not None:
+                info.size = len(data)
+                archive.addfile(info, StringIO(data))
+            else:
+                backend = self.file_cacher.backend
+                info.size = backend.get_size(digest)
+                with backend.open_file(digest) as fobj:
+                    reader = HashingReader(fobj)
+                    archive.addfile(info, reader)
+                if reader.hexdigest() != digest:
+                    return "File %s has wrong hash %s." % \
+                        (digest, reader.hexdigest())
+
+            description = description.encode("utf-8")
+            info = tarfile.TarInfo(os.path.join(basename, "descriptions",
+                                                digest))
+            info.mtime = now
+            info.size = len(description)
+            archive.addfile(info, StringIO(description))
+        except Exception as error:
+            return "File %s could not be added to the archive (%r)." % \
+                (digest, error)
+
+        return None
+
+    def export_model(self, contest, path):
+        """Export the contest and all objects reachable from it as a
+        JSON object mapping IDs to objects, writing each object as
+        soon as it has been exported.
+
+        contest (Contest): the root of the export.
+        path (string): the file where to write.
+
+        """
+        # We use strings because they'll be the keys of a JSON
+        # object; the contest will have ID 0.
+        self.ids = {contest.sa_identity_key: "0"}
+        self.queue = deque([contest])
+
+        with io.open(path, "wb") as fout:
+            fout.write("{\n")
+            while len(self.queue) > 0:
+                obj = self.queue.popleft()
+                fout.write("%s: %s,\n" % (
+                    json.dumps(self.ids[obj.sa_identity_key]),
+                    json.dumps(self.export_object(obj), encoding="utf-8",
+                               sort_keys=True)))
+
+            # Specify the "root" of the data graph
+            fout.write("\"_objects\": [\"0\"]\n}\n")
+
     def get_id(self, obj):
         obj_key = obj.sa_identity_key
         if obj_key not in self.ids:
@@ -286,39 +574,38 @@ class ContestExporter:
     def safe_get_file(self, digest, path, descr_path=None):
 
         """Get file from FileCacher ensuring that the digest is
-        correct.
+        correct. It is safe to call it from many threads at once.
 
         digest (string): the digest of the file to retrieve.
         path (string): the path where to save the file.
         descr_path (string): the path where to save the description.
 
-        return (bool): True if all ok, False if something wrong.
+        return (string): None if all ok, a description of the error
+                         if something wrong.
 
         """
 
         # TODO - Probably this method could be merged in FileCacher
 
-        # First get the file
+        # First get the file. We go straight to the backend, as
+        # FileCacher would write a further copy in its local cache.
         try:
-            self.file_cacher.get_file(digest, path=path)
+            self.file_cacher.backend.get_file(digest, path)
         except Exception as error:
-            logger.error("File %s could not retrieved from file server (%r)."
-                         % (digest, error))
-            return False
+            return "File %s could not retrieved from file server (%r)." \
+                % (digest, error)
 
         # Then check the digest
         calc_digest = sha1sum(path)
         if digest != calc_digest:
-            logger.critical("File %s has wrong hash %s."
-                            % (digest, calc_digest))
-            return False
+            return "File %s has wrong hash %s." % (digest, calc_digest)
 
         # If applicable, retrieve also the description
         if descr_path is not None:
             with io.open(descr_path, 'wt', encoding='utf-8') as fout:
                 fout.write(self.file_cacher.describe(digest))
 
-        return True
+        return None
 
 
 def main():
@@ -338,6 +625,11 @@ def main():
                         help="don't export submissions")
     parser.add_argument("-U", "--no-user-tests", action="store_true",
                         help="don't export user tests")
+    parser.add_argument("-j", "--jobs", action="store", type=int, default=4,
+                        help="number of files to retrieve concurrently")
+    parser.add_argument("-r", "--resume", action="store_true",
+                        help="resume an interrupted export to the same "
+                        "target directory")
     parser.add_argument("export_target", nargs='?', default="",
                         help="target directory or archive for export")
 
@@ -352,7 +644,9 @@ def main():
                     dump_model=not args.files,
                     light=args.light,
                     skip_submissions=args.no_submissions,
-                    skip_user_tests=args.no_user_tests).do_export()
+                    skip_user_tests=args.no_user_tests,
+                    jobs=args.jobs,
+                    resume=args.resume).do_export()
 
 
 if __name__ == "__main__":
@@ -49,7 +49,6 @@ from cms.db.FileCacher import FileCacher
 from cms.db.SQLAlchemyAll import metadata, SessionGen, Contest, \
     Submission, UserTest
 
-from cmscontrib import sha1sum
 from cmscommon.DateTime import make_datetime
 
 # XXX We need mappers to be configured to access ._col_props and
@@ -92,13 +91,14 @@ class ContestImporter:
 
     def __init__(self, drop, import_source,
                  load_files, load_model, light,
-                 skip_submissions, skip_user_tests):
+                 skip_submissions, skip_user_tests, jobs=4):
         self.drop = drop
         self.load_files = load_files
         self.load_model = load_model
         self.light = light
         self.skip_submissions = skip_submissions
         self.skip_user_tests = skip_user_tests
+        self.jobs = jobs
 
         self.import_source = import_source
         self.import_dir = import_source
@@ -187,6 +187,11 @@ class ContestImporter:
                 contest_id = list()
                 contest_files = set()
 
+                # Give the objects their ids in advance, so that
+                # SQLAlchemy can insert all the rows of a table with
+                # a single executemany instead of one INSERT each.
+                self.assign_ids(session)
+
                 # Add each base object and all its dependencies
                 for id_ in self.datas["_objects"]:
                     contest = self.objs[id_]
@@ -241,15 +246,12 @@ class ContestImporter:
                 if contest_files is not None:
                     files &= contest_files
 
-                for digest in files:
-                    file_ = os.path.join(files_dir, digest)
-                    desc = os.path.join(descr_dir, digest)
-                    if not self.safe_put_file(file_, desc):
-                        logger.critical("Unable to put file `%s' in the database. "
-                                        "Aborting. Please remove the contest "
-                                        "from the database." % file_)
-                        # TODO: remove contest from the database.
-                        return False
+                if not self.safe_put_files(files, files_dir, descr_dir):
+                    logger.critical("Unable to put files in the database. "
+                                    "Aborting. Please remove the contest "
+                                    "from the database.")
+                    # TODO: remove contest from the database.
+                    return False
 
 
         if contest_id is not None:
@@ -348,42 +350,80 @@ class ContestImporter:
             else:
                 raise RuntimeError("Unknown RelationshipProperty value: %s" % type(val))
 
-    def safe_put_file(self, path, descr_path):
+    def assign_ids(self, session):
+
+        """Assign to each imported object with an integer id its
+        primary key, taking them from the table's sequence.
+
+        session (Session): the session to use.
+
+        """
+
+        objs_by_table = dict()
+        for obj in self.objs.itervalues():
+            table = type(obj).__table__
+            if "id" in table.c and table.c.id.primary_key:
+                objs_by_table.setdefault(table.name, []).append(obj)
+
+        for table_name, objs in objs_by_table.iteritems():
+            ids = session.execute(
+                "SELECT nextval('%s_id_seq') FROM generate_series(1, %d)" %
+                (table_name, len(objs))).fetchall()
+            for obj, (id_,) in zip(objs, ids):
+                obj.id = id_
+
+    def safe_put_files(self, files, files_dir, descr_dir):
 
-        """Put a file to FileCacher signaling every error (including
-        digest mismatch).
+        """Put files to FileCacher, self.jobs at a time, signaling
+        every error (including digest mismatch). Files already in the
+        storage are not sent again.
 
-        path (string): the path from which to load the file.
-        descr_path (string): same for description.
+        files (set): the digests of the files to put.
+        files_dir (string): the directory containing the files, named
+                            after their digest.
+        descr_dir (string): same for descriptions.
 
         return (bool): True if all ok, False if something wrong.
 
         """
 
-        # TODO - Probably this method could be merged in FileCacher
+        files = sorted(files)
+        logger.info("Putting %d files using %d threads." %
+                    (len(files), self.jobs))
+
+        # Files are sent in chunks, to be able to report progress.
+        chunk_size = 100
+        for start in xrange(0, len(files), chunk_size):
+            chunk = files[start:start + chunk_size]
+            to_put = []
+            for digest in chunk:
+                # First read the description.
+                try:
+                    with io.open(os.path.join(descr_dir, digest),
+                                 'rt', encoding='utf-8') as fin:
+                        description = fin.read()
+                except IOError:
+                    description = ''
+                to_put.append((os.path.join(files_dir, digest),
+                               description))
+
+            # Put the files.
+            try:
+                digests = self.file_cacher.put_files(to_put, jobs=self.jobs)
+            except Exception as error:
+                logger.critical("Files could not be put to file server "
+                                "(%r), aborting." % error)
+                return False
 
-        # First read the description.
-        try:
-            with io.open(descr_path, 'rt', encoding='utf-8') as fin:
-                description = fin.read()
-        except IOError:
-            description = ''
+            # Then check the digests.
+            for digest, calc_digest in zip(chunk, digests):
+                if digest != calc_digest:
+                    logger.critical("File %s has hash %s, aborting." %
+                                    (digest, calc_digest))
+                    return False
 
-        # Put the file.
-        try:
-            digest = self.file_cacher.put_file(path=path,
-                                               description=description)
-        except Exception as error:
-            logger.critical("File %s could not be put to file server (%r), "
-                            "aborting." % (path, error))
-            return False
-
-        # Then check the digest.
-        calc_digest = sha1sum(path)
-        if digest != calc_digest:
-            logger.critical("File %s has hash %s, but the server returned %s, "
-                            "aborting." % (path, calc_digest, digest))
-            return False
+            logger.info("Put %d files out of %d." %
+                        (start + len(chunk), len(files)))
 
         return True
 
@@ -406,6 +446,8 @@ def main():
                         help="don't import submissions")
     parser.add_argument("-U", "--no-user-tests", action="store_true",
                         help="don't import user tests")
+    parser.add_argument("-j", "--jobs", action="store", type=int, default=4,
+                        help="number of files to put concurrently")
     parser.add_argument("import_source",
                         help="source directory or compressed file")
 
@@ -417,7 +459,8 @@ def main():
                     load_model=not args.files,
                     light=args.light,
                     skip_submissions=args.no_submissions,
-                    skip_user_tests=args.no_user_tests).do_import()
+                    skip_user_tests=args.no_user_tests,
+                    jobs=args.jobs).do_import()
 
 
 if __name__ == "__main__":
@@ -53,7 +53,8 @@ class Importer:
 
     """
 
-    def __init__(self, path, drop, test, zero_time, user_number, loader_class):
+    def __init__(self, path, drop, test, zero_time, user_number, loader_class,
+                 jobs=4):
         self.drop = drop
         self.test = test
         self.zero_time = zero_time
@@ -61,7 +62,8 @@ class Importer:
 
         self.file_cacher = FileCacher()
 
-        self.loader = loader_class(os.path.realpath(path), self.file_cacher)
+        self.loader = loader_class(os.path.realpath(path), self.file_cacher,
+                                   jobs=jobs)
 
     def _prepare_db(self):
         logger.info("Creating database structure.")
@@ -143,6 +145,8 @@ def main():
                         help="put N random users instead of importing them")
     parser.add_argument("-L", "--loader", action="store", default=None,
                         help="use the specified loader (default: autodetect)")
+    parser.add_argument("-j", "--jobs", action="store", type=int, default=4,
+                        help="number of files to store concurrently")
     parser.add_argument("import_directory",
                         help="source directory from where import")
 
@@ -156,7 +160,8 @@ def main():
              test=args.test,
              zero_time=args.zero_time,
              user_number=args.user_number,
-             loader_class=loader_class).do_import()
+             loader_class=loader_class,
+             jobs=args.jobs).do_import()
 
 
 if __name__ == "__main__":
@@ -57,14 +57,16 @@ class Reimporter:
 
     """
 
-    def __init__(self, path, contest_id, force, loader_class, full):
+    def __init__(self, path, contest_id, force, loader_class, full,
+                 jobs=4):
         self.old_contest_id = contest_id
         self.force = force
         self.full = full
 
         self.file_cacher = FileCacher()
 
-        self.loader = loader_class(os.path.realpath(path), self.file_cacher)
+        self.loader = loader_class(os.path.realpath(path), self.file_cacher,
+                                   jobs=jobs)
 
     def _update_columns(self, old_object, new_object):
         for prp in old_object._col_props:
@@ -320,6 +322,8 @@ def main():
                         help="use the specified loader (default: autodetect)")
     parser.add_argument("-F", "--full", action="store_true",
                         help="reimport tasks even if they haven't changed")
+    parser.add_argument("-j", "--jobs", action="store", type=int, default=4,
+                        help="number of files to store concurrently")
     parser.add_argument("import_directory",
                         help="source directory from where import")
 
@@ -335,7 +339,8 @@ def main():
                contest_id=args.contest_id,
                force=args.force,
                loader_class=loader_class,
-               full=args.full).do_reimport()
+               full=args.full,
+               jobs=args.jobs).do_reimport()
 
 
 if __name__ == "__main__":
@@ -510,14 +510,23 @@ class YamlLoader(Loader):
                     (compilation_param, infile_param, outfile_param,
                      evaluation_param)
 
+        # Testcases are usually most of the files, so we store them
+        # concurrently.
+        logger.info("Storing %d testcases." % int(conf["n_input"]))
+        files = []
+        for i in xrange(int(conf["n_input"])):
+            files.append((
+                os.path.join(task_path, "input", "input%d.txt" % i),
+                "Input %d for task %s" % (i, name)))
+            files.append((
+                os.path.join(task_path, "output", "output%d.txt" % i),
+                "Output %d for task %s" % (i, name)))
+        digests = self.file_cacher.put_files(files, jobs=self.jobs)
+
         args["testcases"] = []
         for i in xrange(int(conf["n_input"])):
-            input_digest = self.file_cacher.put_file(
-                path=os.path.join(task_path, "input", "input%d.txt" % i),
-                description="Input %d for task %s" % (i, name))
-            output_digest = self.file_cacher.put_file(
-                path=os.path.join(task_path, "output", "output%d.txt" % i),
-                description="Output %d for task %s" % (i, name))
+            input_digest = digests[2 * i]
+            output_digest = digests[2 * i + 1]
             args["testcases"] += [
                 Testcase(i, False, input_digest, output_digest)]
             if args["task_type"] == "OutputOnly":
@@ -37,6 +37,9 @@ class Config(object):
         self.https_certfile = None
         self.https_keyfile = None
         self.timeout = 600  # 10 minutes (in seconds)
+        # Number of processes serving the clients (0 means that a
+        # single process does everything).
+        self.workers = 0
 
         # Authentication.
         self.realm_name = 'Scoreboard'
@@ -45,10 +48,28 @@ class Config(object):
 
         # Buffers
         self.buffer_size = 100  # Needs to be strictly positive.
+        # Events are sent to the clients in batches, at most once
+        # every batch_time seconds.
+        self.batch_time = 0.2
+        # Clients that have more than this many batches still to be
+        # written out are disconnected (they'll reconnect and resume).
+        self.max_pending_batches = 20
+
+        # Replication. If primary_address is set (as in
+        # "http://host:8890/") this server follows that one, and
+        # doesn't accept changes from anyone else.
+        self.primary_address = None
+        self.replication_buffer_size = 10000  # Changes kept in memory.
+        self.replication_timeout = 30  # Long polling (in seconds).
 
         # Logging.
         self.log_color = True
 
+        # Persistence of the stores: either 'log' (a write-ahead log
+        # with periodic snapshots) or 'directory' (one file per entity).
+        self.persistence = 'log'
+        self.log_compaction_threshold = 10000  # Records in the log.
+
         # File system.
         self.installed = sys.argv[0].startswith("/usr/") and \
             sys.argv[0] != '/usr/bin/ipython' and \
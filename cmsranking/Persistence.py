@@ -0,0 +1,297 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Programming contest management system
+# Copyright © 2011-2012 Luca Wehrstedt <luca.wehrstedt@gmail.com>
+# Copyright © 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Persistence backends for the entity stores.
+
+A backend receives the "internal" representation of the entities
+(i.e., what Entity.dump returns) and has to give it back, unchanged,
+when the ranking is restarted.
+
+"""
+
+import simplejson as json
+import os
+
+from cmsranking.Config import config
+from cmsranking.Logger import logger
+
+
+class Persistence(object):
+    """Base virtual class for the persistence backends of a Store.
+
+    """
+    def __init__(self, path):
+        """Initialize the backend.
+
+        path (str): the directory reserved to the backend.
+
+        """
+        self._path = path
+
+        try:
+            os.mkdir(self._path)
+        except OSError:
+            # it's ok: it means the directory already exists
+            pass
+
+    def load(self):
+        """Read back all the entities.
+
+        return (dict): the internal representation of each entity,
+                       indexed by key.
+
+        """
+        raise NotImplementedError("Please subclass this class.")
+
+    def put(self, key, data):
+        """Store (creating or replacing) an entity.
+
+        key (str): the key of the entity.
+        data (dict): its internal representation.
+
+        """
+        self.put_list({key: data})
+
+    def put_list(self, data_dict):
+        """Store (creating or replacing) many entities at once.
+
+        data_dict (dict): the internal representations, indexed by key.
+
+        """
+        raise NotImplementedError("Please subclass this class.")
+
+    def delete(self, key):
+        """Remove an entity.
+
+        key (str): the key of the entity.
+
+        """
+        raise NotImplementedError("Please subclass this class.")
+
+
+class DirectoryPersistence(Persistence):
+    """Store each entity in its own <key>.json file.
+
+    """
+    def load(self):
+        """See Persistence.load."""
+        result = dict()
+        for name in os.listdir(self._path):
+            # TODO check that the key is '[A-Za-z0-9_]+'
+            if name[-5:] == '.json' and name[:-5] != '':
+                with open(os.path.join(self._path, name), 'r') as rec:
+                    try:
+                        result[name[:-5]] = json.load(rec)
+                    except ValueError:
+                        logger.error("Invalid JSON", exc_info=False,
+                                     extra={'location':
+                                            os.path.join(self._path, name)})
+        return result
+
+    def put_list(self, data_dict):
+        """See Persistence.put_list."""
+        for key, data in data_dict.iteritems():
+            with open(os.path.join(self._path, key + '.json'), 'w') as rec:
+                rec.write(json.dumps(data))
+
+    def delete(self, key):
+        """See Persistence.delete."""
+        os.remove(os.path.join(self._path, key + '.json'))
+
+
+class MemoryPersistence(Persistence):
+    """Don't store anything: data is lost when the server stops.
+
+    Useful when the data comes from somewhere else on every start,
+    e.g., for the workers fed by a writer process.
+
+    """
+    def __init__(self, path=None):
+        """See Persistence.__init__ (path is ignored)."""
+        self._path = path
+
+    def load(self):
+        """See Persistence.load."""
+        return dict()
+
+    def put_list(self, data_dict):
+        """See Persistence.put_list."""
+        pass
+
+    def delete(self, key):
+        """See Persistence.delete."""
+        pass
+
+
+class LogPersistence(Persistence):
+    """Store the entities in a write-ahead log and a snapshot.
+
+    Every change is appended, as a line of JSON, to the file
+    "store.log" and synced to disk before returning. Many changes can
+    be written with a single write and sync (see put_list). When the
+    log gets longer than config.log_compaction_threshold and than the
+    previous snapshot the whole content is written to
+    "store.snapshot" (atomically, by renaming a temporary file) and the
+    log is truncated. At startup we read the snapshot and replay the
+    log on top of it.
+
+    Keys can't contain dots, hence these file names don't clash with
+    the ones of DirectoryPersistence, whose files are migrated to the
+    snapshot the first time the store is loaded.
+
+    """
+    SNAPSHOT_FILENAME = "store.snapshot"
+    LOG_FILENAME = "store.log"
+
+    def __init__(self, path, dump_all):
+        """Initialize the backend.
+
+        path (str): the directory reserved to the backend.
+        dump_all (callable): returns the internal representation of
+                             all the current entities, indexed by key;
+                             used to write the snapshots.
+
+        """
+        Persistence.__init__(self, path)
+        self._dump_all = dump_all
+        self._snapshot_path = os.path.join(self._path,
+                                           self.SNAPSHOT_FILENAME)
+        self._log_path = os.path.join(self._path, self.LOG_FILENAME)
+        self._log = None
+        # Number of records in the log, and number of entities in the
+        # snapshot.
+        self._records = 0
+        self._entities = 0
+
+    def load(self):
+        """See Persistence.load."""
+        result = dict()
+        migrate = False
+
+        if os.path.exists(self._snapshot_path):
+            with open(self._snapshot_path, 'r') as snapshot:
+                result = json.load(snapshot)
+        else:
+            result = DirectoryPersistence(self._path).load()
+            migrate = len(result) > 0
+
+        if os.path.exists(self._log_path):
+            with open(self._log_path, 'r+') as log:
+                valid_size = 0
+                for line in log:
+                    try:
+                        if not line.endswith('\n'):
+                            raise ValueError("Missing newline")
+                        action, key, data = json.loads(line)
+                    except ValueError:
+                        # A torn write at the end of the log, due to a
+                        # crash: what comes before is still good.
+                        logger.warning("Discarding incomplete record",
+                                       extra={'location': self._log_path})
+                        break
+                    if action == 'put':
+                        result[key] = data
+                    else:
+                        result.pop(key, None)
+                    valid_size += len(line)
+                    self._records += 1
+                log.truncate(valid_size)
+
+        self._entities = len(result)
+        self._log = open(self._log_path, 'a')
+
+        if migrate:
+            self._compact(result)
+            for key in result:
+                try:
+                    os.remove(os.path.join(self._path, key + '.json'))
+                except OSError:
+                    pass
+
+        return result
+
+    def _append(self, records):
+        """Write some records to the log and sync it to disk.
+
+        records ([list]): the records, as [action, key, data].
+
+        """
+        # We compact before writing: the Store applies a change to its
+        # entities only after it has been persisted, so the snapshot
+        # holds what the log holds so far, and the new records go to
+        # the (now empty) log.
+        if self._records >= max(config.log_compaction_threshold,
+                                self._entities):
+            self._compact(self._dump_all())
+
+        self._log.write(''.join(json.dumps(record) + '\n'
+                                for record in records))
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._records += len(records)
+
+    def _compact(self, data_dict):
+        """Replace the snapshot and the log with a new snapshot.
+
+        data_dict (dict): all the entities, indexed by key.
+
+        """
+        temp_path = self._snapshot_path + '.tmp'
+        with open(temp_path, 'w') as snapshot:
+            json.dump(data_dict, snapshot)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.rename(temp_path, self._snapshot_path)
+
+        # If we crash here we replay the old log on the new snapshot,
+        # which is harmless because the records are idempotent.
+        self._log.close()
+        self._log = open(self._log_path, 'w')
+        self._records = 0
+        self._entities = len(data_dict)
+
+    def put_list(self, data_dict):
+        """See Persistence.put_list."""
+        self._append([['put', key, data]
+                      for key, data in data_dict.iteritems()])
+
+    def delete(self, key):
+        """See Persistence.delete."""
+        self._append([['del', key, None]])
+
+
+def get_persistence(path, dump_all):
+    """Return the persistence backend chosen in the configuration.
+
+    path (str): the directory reserved to the backend.
+    dump_all (callable): see LogPersistence.__init__.
+
+    return (Persistence): a new backend.
+
+    """
+    if config.persistence == 'directory':
+        return DirectoryPersistence(path)
+    elif config.persistence == 'log':
+        return LogPersistence(path, dump_all)
+    elif config.persistence == 'memory':
+        return MemoryPersistence(path)
+    else:
+        raise ValueError("Unknown persistence backend %r" %
+                         config.persistence)
@@ -19,6 +19,10 @@
 
 import tornado.ioloop
 import tornado.web
+import tornado.httpclient
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
 
 import argparse
 import shutil
@@ -30,6 +34,8 @@ import os
 import re
 import base64
 import ssl
+import gzip
+from cStringIO import StringIO
 
 from cmsranking.Config import config
 from cmsranking.Logger import logger
@@ -43,6 +49,8 @@ import cmsranking.User as User
 import cmsranking.Submission as Submission
 import cmsranking.Subchange as Subchange
 import cmsranking.Scoring as Scoring
+from cmsranking.Persistence import MemoryPersistence
+from cmsranking.Replication import ChangeLog, Follower, STORES
 
 
 def authenticated(method):
@@ -76,6 +84,50 @@ def authenticated(method):
     return wrapper
 
 
+# In multi-process mode, the URL of the process that owns the data,
+# to which the workers forward the changes they receive.
+writer_address = None
+
+
+def forward_to_writer(handler):
+    """Forward the request of handler to the writer process and
+    send back its response.
+
+    handler (RequestHandler): an asynchronous handler.
+
+    """
+    def callback(response):
+        if response.code == 599:
+            handler.set_status(502)
+        else:
+            handler.set_status(response.code)
+            if response.body:
+                handler.write(response.body)
+        handler.finish()
+
+    request = tornado.httpclient.HTTPRequest(
+        writer_address + handler.request.uri,
+        method=handler.request.method,
+        headers={'Authorization': handler.request.headers['Authorization']},
+        body=handler.request.body if handler.request.method == 'PUT'
+            else None)
+    tornado.httpclient.AsyncHTTPClient().fetch(request, callback)
+
+
+def writable(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if writer_address is not None:
+            return tornado.web.asynchronous(forward_to_writer)(self)
+        if config.primary_address is not None:
+            # Followers get their data only from the primary.
+            logger.warning("Refusing change on a follower",
+                           extra={'location': self.request.full_url()})
+            raise tornado.web.HTTPError(403)
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
 class DataHandler(tornado.web.RequestHandler):
     def initialize(self):
         if self.request.method == 'POST':
@@ -83,6 +135,15 @@ class DataHandler(tornado.web.RequestHandler):
         else:
             self.set_status(200)
 
+    def prepare(self):
+        # ScoringService compresses the larger requests.
+        if self.request.headers.get('Content-Encoding') == 'gzip':
+            try:
+                self.request.body = gzip.GzipFile(
+                    fileobj=StringIO(self.request.body)).read()
+            except IOError:
+                raise tornado.web.HTTPError(400)
+
     def set_default_headers(self):
         self.set_header('Content-Type', 'text/plain; charset=UTF-8')
         self.set_header('Date', datetime.utcnow())
@@ -95,6 +156,86 @@ class DataHandler(tornado.web.RequestHandler):
             self.set_header('WWW-Authenticate',
                             'Basic realm="' + config.realm_name + '"')
 
+    def write_snapshot(self, snapshot):
+        """Send the content of a Snapshot.
+
+        Send it compressed, if the client accepts it, or just tell the
+        client that it's not changed, if it has the same version.
+
+        snapshot (Snapshot): what to send.
+
+        """
+        etag, data, gzipped_data = snapshot.get()
+        # The Timestamp header, from which the client will ask for the
+        # events, stays the current time: the snapshot is regenerated
+        # as soon as the data changes, so it's up to date now, even if
+        # it has been generated long ago. (The time of the generation
+        # could be older than all the events still in the buffer, and
+        # the client would be told to reload over and over.)
+        self.set_header('ETag', etag)
+        self.set_header('Vary', 'Accept-Encoding')
+        if etag in [tag.strip() for tag in
+                    self.request.headers.get('If-None-Match', '').split(',')]:
+            self.set_status(304)
+            return
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.set_header('Content-Encoding', 'gzip')
+            self.write(gzipped_data)
+        else:
+            self.write(data)
+
+
+class Snapshot(object):
+    """A cached, pre-serialized response.
+
+    The content is generated again only when it's requested after
+    being invalidated (i.e., after the data it depends on changed), so
+    it costs nothing to serve it many times. Each generation gets a new
+    version, used as ETag, and it's compressed once for all the
+    clients that accept gzip.
+
+    """
+    # Makes the ETags differ between different runs of the server.
+    _epoch = "%x" % int(time.time())
+
+    def __init__(self, generate):
+        """Create a snapshot.
+
+        generate (callable): returns the content, as a str.
+
+        """
+        self._generate = generate
+        self._version = 0
+        self._valid = False
+        self._cache = None
+
+    def invalidate(self, *args):
+        """Mark the content as outdated.
+
+        It accepts (and ignores) any argument, to be usable directly as
+        a callback of the stores.
+
+        """
+        self._valid = False
+
+    def get(self):
+        """Return the up to date content.
+
+        return (tuple): the ETag of the content, the content and the
+                        content compressed with gzip.
+
+        """
+        if not self._valid:
+            self._valid = True
+            self._version += 1
+            data = self._generate()
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as gzipped:
+                gzipped.write(data)
+            self._cache = ('"%s-%x"' % (self._epoch, self._version),
+                           data, buf.getvalue())
+        return self._cache
+
 
 def create_handler(entity_store):
     """Return a handler for the given store.
@@ -113,8 +254,14 @@ def create_handler(entity_store):
         raise ValueError("The 'entity_store' parameter "
                          "isn't a subclass of Store")
 
+    snapshot = Snapshot(lambda: entity_store.retrieve_list() + '\n')
+    entity_store.add_create_callback(snapshot.invalidate)
+    entity_store.add_update_callback(snapshot.invalidate)
+    entity_store.add_delete_callback(snapshot.invalidate)
+
     class RestHandler(DataHandler):
         @authenticated
+        @writable
         def put(self, entity_id):
             if not entity_id:
                 # merge list
@@ -148,6 +295,7 @@ def create_handler(entity_store):
                     raise tornado.web.HTTPError(400)
 
         @authenticated
+        @writable
         def delete(self, entity_id):
             if not entity_id:
                 # delete list
@@ -164,7 +312,7 @@ def create_handler(entity_store):
         def get(self, entity_id):
             if not entity_id:
                 # retrieve list
-                self.write(entity_store.retrieve_list() + '\n')
+                self.write_snapshot(snapshot)
             else:
                 # retrieve
                 try:
@@ -176,7 +324,15 @@ def create_handler(entity_store):
 
 
 class MessageProxy(object):
-    """Receive the messages from the entities store and redirect them."""
+    """Receive the messages from the entities store and redirect them.
+
+    Messages aren't sent as soon as they arrive: they're collected
+    and, at most every config.batch_time seconds, joined in a single
+    batch that is written to all clients at once. Score messages for
+    the same user and task in the same batch are coalesced, keeping
+    only the most recent one.
+
+    """
     def __init__(self):
         self.clients = list()
 
@@ -195,6 +351,13 @@ class MessageProxy(object):
         # sure to have all events that happened after that time.
         self.age = time.time()
 
+        # The messages of the next batch, as (timestamp, message,
+        # coalescing key) triples (the key is None for messages that
+        # mustn't be coalesced), and whether its sending is already
+        # scheduled.
+        self._pending = list()
+        self._scheduled = False
+
         Contest.store.add_create_callback(
             functools.partial(self.callback, "contest", "create"))
         Contest.store.add_update_callback(
@@ -239,17 +402,55 @@ class MessageProxy(object):
               'event: score\n' \
               'data: %s %s %0.2f\n' \
               '\n' % (timestamp, user, task, score)
-        self.send(msg, timestamp)
+        self.send(msg, timestamp, (user, task))
+
+    def send(self, message, timestamp, coalesce_key=None):
+        """Queue a message for the next batch.
+
+        message (str): the message, already formatted for the event
+                       stream.
+        timestamp (float): the time it has been generated (and its id).
+        coalesce_key (object): if not None, the message is dropped if
+                               a newer message with the same key is
+                               in the same batch.
+
+        """
+        self._pending.append((timestamp, message, coalesce_key))
+        if not self._scheduled:
+            self._scheduled = True
+            tornado.ioloop.IOLoop.instance().add_timeout(
+                time.time() + config.batch_time, self.send_batch)
+
+    def send_batch(self):
+        """Send the pending messages to all clients, in one write."""
+        self._scheduled = False
+
+        # Keep only the last message for each coalescing key.
+        seen = set()
+        batch = list()
+        for timestamp, message, coalesce_key in reversed(self._pending):
+            if coalesce_key is not None:
+                if coalesce_key in seen:
+                    continue
+                seen.add(coalesce_key)
+            batch.append((timestamp, message))
+        batch.reverse()
+        self._pending = list()
+
+        if not batch:
+            return
+
+        data = ''.join(message for timestamp, message in batch)
+        for client in list(self.clients):
+            client(data)
 
-    def send(self, message, timestamp):
-        for client in self.clients:
-            client(message)
-        if len(self._new_buffer) == config.buffer_size:
-            if self._old_buffer:
-                self.age = self._old_buffer[-1][0]
-            self._old_buffer = self._new_buffer
-            self._new_buffer = list()
-        self._new_buffer.append((timestamp, message))
+        for entry in batch:
+            if len(self._new_buffer) == config.buffer_size:
+                if self._old_buffer:
+                    self.age = self._old_buffer[-1][0]
+                self._old_buffer = self._new_buffer
+                self._new_buffer = list()
+            self._new_buffer.append(entry)
 
     @property
     def buffer(self):
@@ -336,6 +537,7 @@ class NotificationHandler(DataHandler):
             # cleaned yet
             return
 
+        self.pending_batches = 0
         proxy.add_callback(self.send_event)
 
         def callback():
@@ -363,12 +565,28 @@ class NotificationHandler(DataHandler):
     # every call to .finish().
 
     def send_event(self, message):
+        if self.pending_batches >= config.max_pending_batches:
+            # The client isn't reading fast enough: rather than
+            # buffering data for it without limits we close the
+            # connection. It will reconnect and either get the missed
+            # events from the buffer or be told to reload. We can't
+            # just finish the request, as that would wait for the data
+            # still queued to be written; closing the stream triggers
+            # on_connection_close, which calls .clean().
+            logger.warning("Disconnecting slow client",
+                           extra={'location': self.request.full_url()})
+            self.request.connection.stream.close()
+            return
         self.write(message)
         if self.one_shot:
             self.finish()
             self.clean()
         else:
-            self.flush()
+            self.pending_batches += 1
+            self.flush(callback=self.on_batch_written)
+
+    def on_batch_written(self):
+        self.pending_batches -= 1
 
 
 class SubListHandler(DataHandler):
@@ -381,18 +599,82 @@ class SubListHandler(DataHandler):
         self.write(json.dumps(map(lambda a: a.__dict__, result)) + '\n')
 
 
+def generate_history():
+    return json.dumps(list(Scoring.store.get_global_history())) + '\n'
+
+
+def generate_scores():
+    result = list()
+    for u_id, dic in Scoring.store._scores.iteritems():
+        for t_id, score in dic.iteritems():
+            if score.get_score() > 0.0:
+                result.append('%s %s %0.2f\n' %
+                              (u_id, t_id, score.get_score()))
+    return ''.join(result)
+
+
+# The history may change even when no score does (e.g., when a
+# subchange arrives out of order), so we listen to the stores too.
+history_snapshot = Snapshot(generate_history)
+Scoring.store.add_score_callback(history_snapshot.invalidate)
+for _store in [Submission.store, Subchange.store]:
+    _store.add_create_callback(history_snapshot.invalidate)
+    _store.add_update_callback(history_snapshot.invalidate)
+    _store.add_delete_callback(history_snapshot.invalidate)
+scores_snapshot = Snapshot(generate_scores)
+Scoring.store.add_score_callback(scores_snapshot.invalidate)
+
+
 class HistoryHandler(DataHandler):
     def get(self):
-        self.write(json.dumps(list(Scoring.store.get_global_history())) + '\n')
+        self.write_snapshot(history_snapshot)
 
 
 class ScoreHandler(DataHandler):
     def get(self):
-        for u_id, dic in Scoring.store._scores.iteritems():
-            for t_id, score in dic.iteritems():
-                if score.get_score() > 0.0:
-                    self.write('%s %s %0.2f\n' %
-                               (u_id, t_id, score.get_score()))
+        self.write_snapshot(scores_snapshot)
+
+
+changelog = ChangeLog()
+
+
+class ReplicationHandler(DataHandler):
+    """Send to a follower the changes after its offset.
+
+    If there are none, wait for them (up to config.replication_timeout
+    seconds). If they aren't available, send all the data.
+
+    """
+    @tornado.web.asynchronous
+    @authenticated
+    def get(self):
+        self.offset = self.get_argument("offset", None)
+        if changelog.get_changes(self.offset) == []:
+            changelog.add_waiter(self.send_changes)
+            self.timeout = tornado.ioloop.IOLoop.instance().add_timeout(
+                time.time() + config.replication_timeout, self.send_changes)
+        else:
+            self.timeout = None
+            self.send_changes()
+
+    def send_changes(self):
+        self.clean()
+        changes = changelog.get_changes(self.offset)
+        result = {'offset': changelog.get_offset()}
+        if changes is None:
+            result['snapshot'] = changelog.get_snapshot()
+        else:
+            result['changes'] = changes
+        self.finish(json.dumps(result))
+
+    def clean(self):
+        changelog.remove_waiter(self.send_changes)
+        if self.timeout is not None:
+            tornado.ioloop.IOLoop.instance().remove_timeout(self.timeout)
+            self.timeout = None
+
+    def on_connection_close(self):
+        self.clean()
 
 
 class ImageHandler(tornado.web.RequestHandler):
@@ -437,12 +719,78 @@ class HomeHandler(tornado.web.RequestHandler):
         self.finish()
 
 
+def get_ssl_options():
+    return {"ssl_version": ssl.PROTOCOL_SSLv23,
+            "certfile": config.https_certfile,
+            "keyfile": config.https_keyfile}
+
+
+def run_workers(application, workers):
+    """Serve the application with many processes.
+
+    One process (the writer) owns the data: it's the only one that
+    writes to disk and that runs the scoring. It listens only on the
+    loopback interface. The other processes (the workers) share the
+    public ports, and so the incoming connections: they keep a copy of
+    the data, following the writer as in primary/follower replication,
+    and serve it to the clients; they forward any change to the
+    writer.
+
+    application (Application): what to serve.
+    workers (int): the number of worker processes.
+
+    """
+    global writer_address
+
+    # All sockets have to be created before forking.
+    writer_sockets = tornado.netutil.bind_sockets(0, address="127.0.0.1")
+    writer_address = "http://127.0.0.1:%d" % \
+        writer_sockets[0].getsockname()[1]
+    http_sockets = https_sockets = []
+    if config.http_port is not None:
+        http_sockets = tornado.netutil.bind_sockets(
+            config.http_port, address=config.bind_address)
+    if config.https_port is not None:
+        https_sockets = tornado.netutil.bind_sockets(
+            config.https_port, address=config.bind_address)
+
+    task_id = tornado.process.fork_processes(workers + 1)
+
+    if task_id == 0:
+        writer_address = None
+        if config.primary_address is not None:
+            Follower(config.primary_address).start()
+        server = tornado.httpserver.HTTPServer(application)
+        server.add_sockets(writer_sockets)
+    else:
+        # The writer persists the data; we just follow it.
+        for name, store in STORES:
+            store.set_persistence(MemoryPersistence())
+        Follower(writer_address).start()
+        server = tornado.httpserver.HTTPServer(application)
+        server.add_sockets(http_sockets)
+        if https_sockets:
+            server = tornado.httpserver.HTTPServer(
+                application, ssl_options=get_ssl_options())
+            server.add_sockets(https_sockets)
+
+    try:
+        tornado.ioloop.IOLoop.instance().start()
+    except KeyboardInterrupt:
+        # Exit cleanly.
+        return
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Ranking for CMS.")
     parser.add_argument("-d", "--drop",
                         help="drop the data already stored",
                         action="store_true")
+    parser.add_argument("-w", "--workers",
+                        help="number of processes serving the clients "
+                        "(0 to do everything in a single process)",
+                        action="store", type=int, default=config.workers)
     args = parser.parse_args()
 
     if args.drop:
@@ -468,6 +816,7 @@ def main():
         (r"/history", HistoryHandler),
         (r"/scores", ScoreHandler),
         (r"/events", NotificationHandler),
+        (r"/replication", ReplicationHandler),
         (r"/logo", ImageHandler, {
             'location': os.path.join(config.lib_dir, 'logo'),
             'fallback': os.path.join(config.web_dir, 'img', 'logo.png')
@@ -486,13 +835,17 @@ def main():
         (r"/", HomeHandler)
         ])
     # application.add_transform(tornado.web.ChunkedTransferEncoding)
+    if args.workers > 0:
+        run_workers(application, args.workers)
+        return
+
+    if config.primary_address is not None:
+        Follower(config.primary_address).start()
     if config.http_port is not None:
         application.listen(config.http_port, address=config.bind_address)
     if config.https_port is not None:
         application.listen(config.https_port, address=config.bind_address,
-                           ssl_options={"ssl_version": ssl.PROTOCOL_SSLv23,
-                                        "certfile": config.https_certfile,
-                                        "keyfile": config.https_keyfile})
+                           ssl_options=get_ssl_options())
 
     try:
         tornado.ioloop.IOLoop.instance().start()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Programming contest management system
+# Copyright © 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Replication of the data of a RankingWebServer (the primary) to
+other ones (the followers).
+
+The primary numbers all the changes to its stores and keeps the most
+recent ones in memory. A follower asks for the changes after the last
+one it applied (its offset) and applies them to its own stores, which
+notify its clients as usual. If the changes it needs are not
+available anymore (or if the primary restarted) it gets a full copy
+of the data instead.
+
+"""
+
+import simplejson as json
+import functools
+import time
+import urllib
+from collections import deque
+
+import tornado.ioloop
+import tornado.httpclient
+
+from cmsranking.Config import config
+from cmsranking.Logger import logger
+
+import cmsranking.Contest as Contest
+import cmsranking.Task as Task
+import cmsranking.Team as Team
+import cmsranking.User as User
+import cmsranking.Submission as Submission
+import cmsranking.Subchange as Subchange
+
+
+# The replicated stores, in an order such that each entity only
+# depends on entities that come before it.
+STORES = [("contests", Contest.store),
+          ("tasks", Task.store),
+          ("teams", Team.store),
+          ("users", User.store),
+          ("submissions", Submission.store),
+          ("subchanges", Subchange.store)]
+
+
+class ChangeLog(object):
+    """Record the changes to the stores, for the followers.
+
+    Each change is a list [seq, store name, key, data], where data is
+    the new value of the entity (in the format of the HTTP interface)
+    or None if it has been deleted. Offsets are strings "epoch:seq",
+    where the epoch identifies this run of the server.
+
+    """
+    def __init__(self):
+        self.epoch = "%x" % int(time.time() * 1000)
+        self._seq = 0
+        self._changes = deque(maxlen=config.replication_buffer_size)
+        self._waiters = list()
+        self._notify_scheduled = False
+
+        for name, store in STORES:
+            store.add_create_callback(
+                functools.partial(self.callback, name, store))
+            store.add_update_callback(
+                functools.partial(self.callback, name, store))
+            store.add_delete_callback(
+                functools.partial(self.callback, name, None))
+
+    def callback(self, name, store, key):
+        self._seq += 1
+        data = store._store[key].get() if store is not None else None
+        self._changes.append([self._seq, name, key, data])
+
+        # We notify the waiters on the next iteration of the loop, so
+        # that they get, at once, all the changes made by a single
+        # operation (e.g., a merge_list).
+        if self._waiters and not self._notify_scheduled:
+            self._notify_scheduled = True
+            tornado.ioloop.IOLoop.instance().add_callback(self.notify)
+
+    def notify(self):
+        self._notify_scheduled = False
+        waiters = self._waiters
+        self._waiters = list()
+        for waiter in waiters:
+            waiter()
+
+    def add_waiter(self, callback):
+        """Call callback (once) as soon as there are new changes."""
+        self._waiters.append(callback)
+
+    def remove_waiter(self, callback):
+        if callback in self._waiters:
+            self._waiters.remove(callback)
+
+    def get_offset(self):
+        return "%s:%d" % (self.epoch, self._seq)
+
+    def get_changes(self, offset):
+        """Return the changes after the given offset.
+
+        offset (str): the offset of the last change the follower
+                      applied, or None.
+
+        return (list): the changes, or None if they are not available
+                       anymore (and a snapshot is needed).
+
+        """
+        try:
+            epoch, seq = offset.split(':')
+            seq = int(seq)
+        except (AttributeError, ValueError):
+            return None
+        if epoch != self.epoch or seq > self._seq:
+            return None
+        if seq == self._seq:
+            return []
+        if not self._changes or seq + 1 < self._changes[0][0]:
+            return None
+        start = seq + 1 - self._changes[0][0]
+        return [self._changes[i] for i in xrange(start, len(self._changes))]
+
+    def get_snapshot(self):
+        """Return all the current data, in the format of merge_list.
+
+        return (list): pairs (store name, dict of entities).
+
+        """
+        return [(name, dict((key, value.get())
+                            for key, value in store._store.iteritems()))
+                for name, store in STORES]
+
+
+class Follower(object):
+    """Keep the local stores in sync with the ones of a primary.
+
+    """
+    def __init__(self, address):
+        """Initialize the follower.
+
+        address (str): the base URL of the primary, as in
+                       "http://host:8890/".
+
+        """
+        self._url = address.rstrip('/') + '/replication'
+        self._offset = None
+        self._client = tornado.httpclient.AsyncHTTPClient()
+
+    def start(self):
+        self.fetch()
+
+    def fetch(self):
+        url = self._url
+        if self._offset is not None:
+            url += '?' + urllib.urlencode({'offset': self._offset})
+        self._client.fetch(tornado.httpclient.HTTPRequest(
+            url, auth_username=config.username,
+            auth_password=config.password,
+            request_timeout=config.replication_timeout + 30),
+            self.on_response)
+
+    def on_response(self, response):
+        if response.error:
+            logger.warning("Unable to get changes from primary: %s" %
+                           response.error, extra={'location': self._url})
+            tornado.ioloop.IOLoop.instance().add_timeout(
+                time.time() + 1.0, self.fetch)
+            return
+
+        try:
+            result = json.loads(response.body)
+            if 'snapshot' in result:
+                self.apply_snapshot(result['snapshot'])
+            else:
+                self.apply_changes(result['changes'])
+            self._offset = result['offset']
+        except Exception:
+            # We'll start from scratch: better than being inconsistent.
+            logger.error("Unable to apply changes from primary",
+                         exc_info=True, extra={'location': self._url})
+            self._offset = None
+
+        self.fetch()
+
+    def apply_changes(self, changes):
+        stores = dict(STORES)
+        for seq, name, key, data in changes:
+            store = stores[name]
+            if data is None:
+                if key in store:
+                    store.delete(key)
+            elif key in store:
+                store.update(key, json.dumps(data))
+            else:
+                store.create(key, json.dumps(data))
+
+    def apply_snapshot(self, snapshot):
+        logger.info("Loading a full copy of the data from primary")
+        stores = dict(STORES)
+        snapshot = dict(snapshot)
+        # Delete what's gone, starting from the entities that depend on
+        # the others...
+        for name, store in reversed(STORES):
+            for key in list(store._store.iterkeys()):
+                if key not in snapshot[name] and key in store:
+                    store.delete(key)
+        # ... and add everything else, in the opposite order.
+        for name, store in STORES:
+            if snapshot[name]:
+                stores[name].merge_list(json.dumps(snapshot[name]))
@@ -17,6 +17,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
 import heapq
 
 from cmsranking.Logger import logger
@@ -32,28 +33,40 @@ class NumberSet:
     - inserting a value
     - removing a value
     - querying the maximum value
+    - querying the k-th smallest value
 
     It can hold the same value multiple times.
 
-    This data structure could be implemented with a binary tree, but
-    at the moment we're actually using a standard python list.
+    The values are kept in a sorted list, located with a binary
+    search: queries are O(1), insertions and removals need O(log n)
+    comparisons (plus a memmove, which is negligible for the sizes we
+    deal with).
 
     """
     def __init__(self):
         self._impl = list()
 
     def insert(self, val):
-        self._impl.append(val)
+        bisect.insort(self._impl, val)
 
     def remove(self, val):
-        self._impl.remove(val)
+        idx = bisect.bisect_left(self._impl, val)
+        if idx == len(self._impl) or self._impl[idx] != val:
+            raise ValueError("NumberSet.remove(x): x not in NumberSet")
+        del self._impl[idx]
 
     def query(self):
-        return max(self._impl + [0.0])
+        return max(self._impl[-1], 0.0) if self._impl else 0.0
+
+    def select(self, k):
+        return self._impl[k]
 
     def clear(self):
         del self._impl[:]
 
+    def __len__(self):
+        return len(self._impl)
+
 
 class Score:
     """The score of a user for a task.
@@ -74,8 +87,20 @@ class Score:
         # The submissions in their current status.
         self._submissions = dict()
 
-        # The list of changes of the submissions.
+        # The list of changes of the submissions, sorted by (time,
+        # key), and the list of these (time, key) pairs, to locate
+        # changes with a binary search.
         self._changes = list()
+        self._sort_keys = list()
+
+        # The changes, indexed by key.
+        self._subchanges = dict()
+
+        # For each change that has been applied, what is needed to
+        # revert it: the submission it changed with its previous
+        # score, token and extra, the previous last submission and the
+        # previous length of the history.
+        self._undo = list()
 
         # The set of the scores of the currently released submissions.
         self._released = NumberSet()
@@ -93,19 +118,23 @@ class Score:
         # it's the last. Compute the new score and, if it changed,
         # append it to the history.
         s_id = change.submission
-        if self._submissions[s_id].token:
-            self._released.remove(self._submissions[s_id].score)
+        submission = self._submissions[s_id]
+        self._undo.append((submission, submission.score, submission.token,
+                           submission.extra, self._last,
+                           len(self._history)))
+        if submission.token:
+            self._released.remove(submission.score)
         if change.score is not None:
-            self._submissions[s_id].score = change.score
+            submission.score = change.score
         if change.token is not None:
-            self._submissions[s_id].token = change.token
+            submission.token = change.token
         if change.extra is not None:
-            self._submissions[s_id].extra = change.extra
-        if self._submissions[s_id].token:
-            self._released.insert(self._submissions[s_id].score)
+            submission.extra = change.extra
+        if submission.token:
+            self._released.insert(submission.score)
         if change.score is not None and (self._last is None or \
-           self._submissions[s_id].time > self._last.time):
-            self._last = self._submissions[s_id]
+           submission.time > self._last.time):
+            self._last = submission
 
         score = max(self._released.query(),
                     self._last.score if self._last is not None else 0.0)
@@ -116,10 +145,39 @@ class Score:
     def get_score(self):
         return self._history[-1][1] if len(self._history) > 0 else 0.0
 
+    def _rewind(self, idx):
+        """Revert the changes from the idx-th on, most recent first.
+
+        idx (int): the number of changes that will remain applied.
+
+        """
+        while len(self._undo) > idx:
+            submission, score, token, extra, last, history_len = \
+                self._undo.pop()
+            if submission.token:
+                self._released.remove(submission.score)
+            submission.score = score
+            submission.token = token
+            submission.extra = extra
+            if submission.token:
+                self._released.insert(submission.score)
+            self._last = last
+            del self._history[history_len:]
+
+    def _replay(self, idx):
+        """Apply the changes from the idx-th on.
+
+        idx (int): the number of changes that are already applied.
+
+        """
+        for change in self._changes[idx:]:
+            self.append_change(change)
+
     def reset_history(self):
         # Delete everything except the submissions and the subchanges.
         self._last = None
         self._released.clear()
+        del self._undo[:]
         del self._history[:]
 
         # Reset the submissions at their default value.
@@ -129,51 +187,71 @@ class Score:
             sub.extra = list()
 
         # Append each change, one at a time.
-        for change in self._changes:
-            self.append_change(change)
+        self._replay(0)
+
+    def _insert_change(self, key, subchange):
+        """Insert a subchange in the sorted list of changes.
+
+        return (int): its position.
+
+        """
+        sort_key = (subchange.time, key)
+        idx = bisect.bisect_left(self._sort_keys, sort_key)
+        self._sort_keys.insert(idx, sort_key)
+        self._changes.insert(idx, subchange)
+        self._subchanges[key] = subchange
+        return idx
+
+    def _remove_change(self, key):
+        """Remove a subchange from the sorted list of changes.
+
+        return (int): the position it had.
+
+        """
+        subchange = self._subchanges.pop(key)
+        idx = bisect.bisect_left(self._sort_keys, (subchange.time, key))
+        del self._sort_keys[idx]
+        del self._changes[idx]
+        return idx
+
+    def _replay_from(self, idx, reason):
+        """Revert and apply again the changes from the idx-th on.
+
+        idx (int): the first change that is not in its place.
+        reason (str): what caused this, for logging.
+
+        """
+        if idx < len(self._undo):
+            submission = self._undo[idx][0]
+            logger.info("Replayed %d changes for user '%s' and task '%s' "
+                        "after %s" % (len(self._changes) - idx,
+                                      submission.user, submission.task,
+                                      reason))
+        self._rewind(idx)
+        self._replay(idx)
 
     def create_subchange(self, key, subchange):
         # Insert the subchange at the right position inside the
-        # (sorted) list and call the appropriate method (append_change
-        # or reset_history)
-        if len(self._changes) == 0 or \
-           subchange.time > self._changes[-1].time or \
-           (subchange.time == self._changes[-1].time and
-            subchange.key > self._changes[-1].key):
-            self._changes.append(subchange)
-            self.append_change(subchange)
-        else:
-            for idx, val in enumerate(self._changes):
-                if subchange.time < val.time or \
-                   (subchange.time == val.time and subchange.key < val.key):
-                    self._changes.insert(idx, subchange)
-                    break
-            self.reset_history()
-            logger.info("Reset history for user '" +
-                self._submissions[subchange.submission].user + "' and task '" +
-                self._submissions[subchange.submission].user +
-                "' after creating subchange '" + key + "' for submission '" +
-                subchange.submission + "'")
+        # (sorted) list, revert the changes that come after it and
+        # apply them again (usually, there are none).
+        idx = self._insert_change(key, subchange)
+        self._replay_from(idx, "creating subchange '%s'" % key)
 
     def update_subchange(self, key, subchange):
-        # Update the subchange inside the (sorted) list and,
-        # regardless of its position in that list, reset the history.
-        for i in range(len(self._changes)):
-            if self._changes[i].key == key:
-                self._changes[i] = subchange
-        self.reset_history()
-        logger.info("Reset history for user '" +
-            self._submissions[subchange.submission].user + "' and task '" +
-            self._submissions[subchange.submission].user +
-            "' after updating subchange '" + key + "' for submission '" +
-            subchange.submission + "'")
+        # Move the subchange to its new position inside the (sorted)
+        # list and replay starting from the first one of the two
+        # positions.
+        old_idx = self._remove_change(key)
+        new_idx = self._insert_change(key, subchange)
+        self._replay_from(min(old_idx, new_idx),
+                          "updating subchange '%s'" % key)
 
     def delete_subchange(self, key):
-        # Delete the subchange from the (sorted) list and reset the
-        # history.
-        self._changes = filter(lambda a: a.key != key, self._changes)
-        self.reset_history()
-        logger.info("Reset history after deleting subchange '" + key + "'")
+        # Delete the subchange from the (sorted) list and replay the
+        # ones after it.
+        if key in self._subchanges:
+            idx = self._remove_change(key)
+            self._replay_from(idx, "deleting subchange '%s'" % key)
 
     def create_submission(self, key, submission):
         # A new submission never triggers an update in the history,
@@ -226,6 +304,13 @@ class ScoringStore:
 
         self._scores = dict()
 
+        # The (user, task) pair of the Score each submission and each
+        # subchange has been given to, indexed by their key. We need
+        # them when they get deleted, as they're already gone from
+        # their stores.
+        self._submission_owners = dict()
+        self._subchange_owners = dict()
+
         self._callbacks = list()
 
         for key in Submission.store._store.iterkeys():
@@ -246,74 +331,68 @@ class ScoringStore:
         for call in self._callbacks:
             call(user, task, score)
 
+    def _call(self, user, task, method, *args):
+        """Call a method of the Score of user and task, notifying the
+        callbacks if the score changes.
+
+        user (str): the key of the user.
+        task (str): the key of the task.
+        method (str): the name of the method of Score.
+        args (list): its arguments.
+
+        """
+        scoring = self._scores[user][task]
+        old_score = scoring.get_score()
+        getattr(scoring, method)(*args)
+        new_score = scoring.get_score()
+        if old_score != new_score:
+            self.notify_callbacks(user, task, new_score)
+
     def create_submission(self, key):
         submission = Submission.store._store[key]
         if submission.user not in self._scores:
             self._scores[submission.user] = dict()
         if submission.task not in self._scores[submission.user]:
             self._scores[submission.user][submission.task] = Score()
-        old_score = self._scores[submission.user][submission.task].get_score()
-        self._scores[submission.user][submission.task].create_submission(
-            key, submission)
-        new_score = self._scores[submission.user][submission.task].get_score()
-        if old_score != new_score:
-            self.notify_callbacks(submission.user, submission.task, new_score)
+        self._submission_owners[key] = (submission.user, submission.task)
+        self._call(submission.user, submission.task,
+                   "create_submission", key, submission)
 
     def update_submission(self, key):
         submission = Submission.store._store[key]
-        old_score = self._scores[submission.user][submission.task].get_score()
-        self._scores[submission.user][submission.task].update_submission(
-            key, submission)
-        new_score = self._scores[submission.user][submission.task].get_score()
-        if old_score != new_score:
-            self.notify_callbacks(submission.user, submission.task, new_score)
+        self._submission_owners[key] = (submission.user, submission.task)
+        self._call(submission.user, submission.task,
+                   "update_submission", key, submission)
 
     def delete_submission(self, key):
-        # Since we don't know the user and the task of a deleted
-        # submission we have two solutions: either we store them on
-        # our own or we ask every Score to delete the submission
-        # (would be very expensive) Since the deletion is very
-        # unfrequent we choose the second option.
-        for u_id, user in self._scores.iteritems():
-            for t_id, task in user.iteritems():
-                old_score = task.get_score()
-                task.delete_submission(key)
-                new_score = task.get_score()
-                if old_score != new_score:
-                    self.notify_callbacks(u_id, t_id, new_score)
+        if key in self._submission_owners:
+            user, task = self._submission_owners.pop(key)
+            self._call(user, task, "delete_submission", key)
 
     def create_subchange(self, key):
         subchange = Subchange.store._store[key]
         submission = Submission.store._store[subchange.submission]
-        old_score = self._scores[submission.user][submission.task].get_score()
-        self._scores[submission.user][submission.task].create_subchange(
-            key, subchange)
-        new_score = self._scores[submission.user][submission.task].get_score()
-        if old_score != new_score:
-            self.notify_callbacks(submission.user, submission.task, new_score)
+        self._subchange_owners[key] = (submission.user, submission.task)
+        self._call(submission.user, submission.task,
+                   "create_subchange", key, subchange)
 
     def update_subchange(self, key):
         subchange = Subchange.store._store[key]
         submission = Submission.store._store[subchange.submission]
-        old_score = self._scores[submission.user][submission.task].get_score()
-        self._scores[submission.user][submission.task].update_subchange(
-            key, subchange)
-        new_score = self._scores[submission.user][submission.task].get_score()
-        if old_score != new_score:
-            self.notify_callbacks(submission.user, submission.task, new_score)
+        owner = (submission.user, submission.task)
+        if self._subchange_owners.get(key) == owner:
+            self._call(submission.user, submission.task,
+                       "update_subchange", key, subchange)
+        else:
+            # The subchange moved to a submission of another
+            # user/task.
+            self.delete_subchange(key)
+            self.create_subchange(key)
 
     def delete_subchange(self, key):
-        # I'd say we have here the same problem as above: since we
-        # don't know which submission the subchange belongs to, we
-        # don't know which Score to ask to delete it. So we ask it to
-        # all of them.
-        for u_id, user in self._scores.iteritems():
-            for t_id, task in user.iteritems():
-                old_score = task.get_score()
-                task.delete_subchange(key)
-                new_score = task.get_score()
-                if old_score != new_score:
-                    self.notify_callbacks(u_id, t_id, new_score)
+        if key in self._subchange_owners:
+            user, task = self._subchange_owners.pop(key)
+            self._call(user, task, "delete_subchange", key)
 
     def get_score(self, user, task):
         if user not in self._scores or task not in self._scores[user]:
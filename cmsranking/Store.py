@@ -25,6 +25,7 @@ from cmsranking.Config import config
 from cmsranking.Logger import logger
 
 from cmsranking.Entity import Entity, InvalidKey, InvalidData
+from cmsranking.Persistence import get_persistence
 
 
 class Store(object):
@@ -36,6 +37,10 @@ class Store(object):
     a single type (defined at init-time) and it's possible to get notified
     when something changes by providing appropriate callbacks.
 
+    Changes are saved through a persistence backend (see
+    cmsranking.Persistence) before being confirmed, and are loaded
+    back when the store is created.
+
     """
     def __init__(self, entity, dir_name, depends=None):
         """Initialize an empty EntityStore.
@@ -58,21 +63,19 @@ class Store(object):
         self._update_callbacks = list()
         self._delete_callbacks = list()
 
-        try:
-            os.mkdir(self._path)
-        except OSError:
-            # it's ok: it means the directory already exists
-            pass
+        self._persistence = get_persistence(self._path, self._dump_all)
 
         try:
-            for name in os.listdir(self._path):
-                # TODO check that the key is '[A-Za-z0-9_]+'
-                if name[-5:] == '.json' and name[:-5] != '':
-                    with open(os.path.join(self._path, name), 'r') as rec:
-                        item = self._entity()
-                        item.load(json.load(rec))
-                        item.key = name[:-5]
-                        self._store[name[:-5]] = item
+            for key, data in self._persistence.load().iteritems():
+                try:
+                    item = self._entity()
+                    item.load(data)
+                    item.key = key
+                    self._store[key] = item
+                except InvalidData, exc:
+                    logger.error(str(exc), exc_info=False,
+                                 extra={'location':
+                                        os.path.join(self._path, key)})
         except OSError:
             # the path isn't a directory or is inaccessible
             logger.error("Path is not a directory or is not accessible",
@@ -81,10 +84,27 @@ class Store(object):
             logger.error("I/O error occured", exc_info=True)
         except ValueError:
             logger.error("Invalid JSON", exc_info=False,
-                         extra={'location': os.path.join(self._path, name)})
-        except InvalidData, exc:
-            logger.error(str(exc), exc_info=False,
-                         extra={'location': os.path.join(self._path, name)})
+                         extra={'location': self._path})
+
+    def _dump_all(self):
+        """Return the internal representation of all the entities.
+
+        return (dict): the dumped entities, indexed by key.
+
+        """
+        return dict((key, value.dump())
+                    for key, value in self._store.iteritems())
+
+    def set_persistence(self, persistence):
+        """Change the persistence backend.
+
+        The data already in the store is kept, but it's not written to
+        the new backend.
+
+        persistence (Persistence): the new backend.
+
+        """
+        self._persistence = persistence
 
     def add_create_callback(self, callback):
         """Add a callback to be called when entities are created.
@@ -155,22 +175,21 @@ class Store(object):
             if not item.consistent():
                 raise InvalidData('Inconsistent data')
             item.key = key
-            self._store[key] = item
         except ValueError:
             raise InvalidData('Invalid JSON')
+        # reflect changes on the persistent storage
+        try:
+            self._persistence.put(key, item.dump())
+        except (IOError, OSError):
+            logger.error("I/O error occured while creating entity",
+                         exc_info=True)
+        self._store[key] = item
         # confirm the operation
         if confirm is not None:
             confirm()
         # notify callbacks
         for callback in self._create_callbacks:
             callback(key)
-        # reflect changes on the persistent storage
-        try:
-            with open(os.path.join(self._path, key + '.json'), 'w') as rec:
-                rec.write(json.dumps(self._store[key].dump()))
-        except IOError:
-            logger.error("I/O error occured while creating entity",
-                         exc_info=True)
 
     def update(self, key, data, confirm=None):
         """Update an entity.
@@ -198,22 +217,21 @@ class Store(object):
             if not item.consistent():
                 raise InvalidData('Inconsistent data')
             item.key = key
-            self._store[key] = item
         except ValueError:
             raise InvalidData('Invalid JSON')
+        # reflect changes on the persistent storage
+        try:
+            self._persistence.put(key, item.dump())
+        except (IOError, OSError):
+            logger.error("I/O error occured while updating entity",
+                         exc_info=True)
+        self._store[key] = item
         # confirm the operation
         if confirm is not None:
             confirm()
         # notify callbacks
         for callback in self._update_callbacks:
             callback(key)
-        # reflect changes on the persistent storage
-        try:
-            with open(os.path.join(self._path, key + '.json'), 'w') as rec:
-                rec.write(json.dumps(self._store[key].dump()))
-        except IOError:
-            logger.error("I/O error occured while updating entity",
-                         exc_info=True)
 
     def merge_list(self, data, confirm=None):
         """Merge a list of entities.
@@ -255,6 +273,14 @@ class Store(object):
             raise InvalidData('Invalid JSON')
         except AssertionError as message:
             raise InvalidData(str(message))
+        # reflect changes on the persistent storage, all at once
+        try:
+            self._persistence.put_list(
+                dict((key, value.dump())
+                     for key, value in item_dict.iteritems()))
+        except (IOError, OSError):
+            logger.error("I/O error occured while merging entity lists",
+                         exc_info=True)
         # confirm the operation
         if confirm is not None:
             confirm()
@@ -270,13 +296,6 @@ class Store(object):
             else:
                 for callback in self._update_callbacks:
                     callback(key)
-            # reflect changes on the persistent storage
-            try:
-                with open(os.path.join(self._path, key + '.json'), 'w') as rec:
-                    rec.write(json.dumps(value.dump()))
-            except IOError:
-                logger.error("I/O error occured while merging entity lists",
-                             exc_info=True)
 
     def delete(self, key, confirm=None):
         """Delete an entity.
@@ -294,6 +313,11 @@ class Store(object):
         """
         self._verify_key(key, must_be_present=True)
 
+        # reflect changes on the persistent storage
+        try:
+            self._persistence.delete(key)
+        except (IOError, OSError):
+            logger.error("Unable to delete entity", exc_info=True)
         # confirm the operation
         if confirm is not None:
             confirm()
@@ -307,11 +331,6 @@ class Store(object):
         # notify callbacks
         for callback in self._delete_callbacks:
             callback(key)
-        # reflect changes on the persistent storage
-        try:
-            os.remove(os.path.join(self._path, key + '.json'))
-        except OSError:
-            logger.error("Unable to delete entity", exc_info=True)
 
     def delete_list(self, confirm=None):
         """Delete all entities.
@@ -75,9 +75,11 @@ class Submission(Entity):
     def get(self):
         result = self.__dict__.copy()
         del result["key"]
-        del result["score"]
-        del result["token"]
-        del result["extra"]
+        # These are set by the scoring callbacks, which may not have
+        # run yet.
+        result.pop("score", None)
+        result.pop("token", None)
+        result.pop("extra", None)
         return result
 
     def load(self, data):
@@ -89,9 +91,11 @@ class Submission(Entity):
     def dump(self):
         result = self.__dict__.copy()
         del result["key"]
-        del result["score"]
-        del result["token"]
-        del result["extra"]
+        # These are set by the scoring callbacks, which may not have
+        # run yet.
+        result.pop("score", None)
+        result.pop("token", None)
+        result.pop("extra", None)
         return result
 
     def consistent(self):
@@ -21,7 +21,9 @@
 
 import sys
 import os
+import threading
 
+from cms import config
 from cmscontrib.YamlLoader import YamlLoader
 from cms.db.FileCacher import FileCacher
 from cms.grading.Job import EvaluationJob, Testcase
@@ -33,16 +35,145 @@ import simplejson as json
 task = None
 file_cacher = None
 
+# Where we keep the files of the tasks between runs.
+CACHE_DIR = os.path.join(config.cache_dir, "cmstaskenv")
+
+# The isolate boxes are 0 to ISOLATE_NUM_BOXES - 1 (it must match
+# CONFIG_ISOLATE_NUM_BOXES in isolate/autoconf.h). The services use
+# the boxes from 1 upwards (shard + 1) and the console users the box
+# 0, so when evaluating in parallel worker k uses the box
+# ISOLATE_NUM_BOXES - 1 - k, and there are at most MAX_JOBS workers.
+ISOLATE_NUM_BOXES = 100
+MAX_JOBS = ISOLATE_NUM_BOXES // 2
+
 
 def usage():
-    print """%s base_dir executable [assume]"
+    print """%s base_dir executable [assume [jobs]]"
 base_dir:   directory of the task
 executable: solution to test (relative to the task's directory)
 assume:     if it's y, answer yes to every question
             if it's n, answer no to every question
+jobs:       number of testcases to evaluate at the same time
 """ % sys.argv[0]
 
 
+class TaskFileCacher(FileCacher):
+    """A FileCacher storing the files in a persistent directory, which
+    also remembers the digest of each file it is given, together with
+    its size and modification time. Loading again a task thus only
+    reads and stores the files that changed since the last time.
+
+    """
+    def __init__(self, path):
+        """Initialization.
+
+        path (string): the directory for the files and the digests.
+
+        """
+        FileCacher.__init__(self, path=os.path.join(path, "objects"))
+        self.digests_path = os.path.join(path, "digests.json")
+        self.digests_lock = threading.Lock()
+        try:
+            with open(self.digests_path) as digests_file:
+                self.digests = json.load(digests_file)
+        except (IOError, ValueError):
+            self.digests = {}
+
+    def _hash_file(self, path):
+        """See FileCacher._hash_file."""
+        # Our own temporary files are always new.
+        if path.startswith(self.tmp_dir):
+            return FileCacher._hash_file(self, path)
+
+        key = os.path.realpath(path)
+        stat = os.stat(key)
+        with self.digests_lock:
+            entry = self.digests.get(key)
+        if entry is not None and \
+                entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+            return entry[2]
+
+        digest = FileCacher._hash_file(self, path)
+        with self.digests_lock:
+            self.digests[key] = [stat.st_mtime, stat.st_size, digest]
+        return digest
+
+    def save_digests(self):
+        """Write the known digests to disk."""
+        temp_path = self.digests_path + ".%d.tmp" % os.getpid()
+        with self.digests_lock:
+            with open(temp_path, "w") as digests_file:
+                json.dump(self.digests, digests_file)
+        os.rename(temp_path, self.digests_path)
+
+
+def evaluate_testcases(job, testcases, jobs=1):
+    """Evaluate the testcases of a job, possibly in parallel.
+
+    job (EvaluationJob): the job to evaluate.
+    testcases ([int]): the testcases to evaluate.
+    jobs (int): how many testcases to evaluate at the same time, each
+                in its own isolate box (at most MAX_JOBS).
+
+    yield (int): the testcases, in the given order, as soon as their
+                 evaluation (and the one of the previous ones) is in
+                 job.evaluations. Closing the generator stops the
+                 evaluation of the others.
+
+    """
+    jobs = min(jobs, MAX_JOBS, len(testcases))
+    if jobs <= 1:
+        tasktype = get_task_type(job, file_cacher)
+        for i in testcases:
+            tasktype.evaluate_testcase(i)
+            yield i
+        return
+
+    condition = threading.Condition()
+    state = {"next": 0, "stop": False, "error": None}
+    done = set()
+
+    def worker(box_id):
+        tasktype = get_task_type(job, file_cacher)
+        tasktype.box_id = box_id
+        while True:
+            with condition:
+                if state["stop"] or state["next"] >= len(testcases):
+                    return
+                i = testcases[state["next"]]
+                state["next"] += 1
+            try:
+                tasktype.evaluate_testcase(i)
+            except Exception as error:
+                with condition:
+                    state["error"] = error
+                    condition.notify_all()
+                return
+            with condition:
+                done.add(i)
+                condition.notify_all()
+
+    threads = [threading.Thread(target=worker,
+                                args=(ISOLATE_NUM_BOXES - 1 - k,))
+               for k in xrange(jobs)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for i in testcases:
+            with condition:
+                while i not in done and state["error"] is None:
+                    condition.wait(1.0)
+                if state["error"] is not None:
+                    raise state["error"]
+            yield i
+    finally:
+        with condition:
+            state["stop"] = True
+        for thread in threads:
+            thread.join()
+
+
 def mem_human(mem):
     if mem > 2 ** 30:
         return "%4.3gG" % (float(mem) / (2 ** 30))
@@ -53,20 +184,16 @@ def mem_human(mem):
     return "%4d" % mem
 
 
-def test_testcases(base_dir, soluzione, assume=None):
+def test_testcases(base_dir, soluzione, assume=None, jobs=1):
     global task, file_cacher
 
-    # Use a FileCacher with a NullBackend in order to avoid to fill
-    # the database with junk
+    # Use a FileCacher with a persistent file system storage, in order
+    # to avoid to fill the database with junk and to copy again the
+    # files that haven't changed since the last run
     if file_cacher is None:
-        file_cacher = FileCacher(null=True)
+        file_cacher = TaskFileCacher(CACHE_DIR)
 
     # Load the task
-    # TODO - This implies copying a lot of data to the FileCacher,
-    # which is annoying if you have to do it continuously; it would be
-    # better to use a persistent cache (although local, possibly
-    # filesystem-based instead of database-based) and somehow detect
-    # when the task has already been loaded
     if task is None:
         loader = YamlLoader(
             os.path.realpath(os.path.join(base_dir, "..")),
@@ -74,6 +201,7 @@ def test_testcases(base_dir, soluzione, assume=None):
         # Normally we should import the contest before, but YamlLoader
         # accepts get_task() even without previous get_contest() calls
         task = loader.get_task(os.path.split(os.path.realpath(base_dir))[1])
+        file_cacher.save_digests()
 
     # Prepare the EvaluationJob
     dataset = task.active_dataset
@@ -90,7 +218,8 @@ def test_testcases(base_dir, soluzione, assume=None):
                        for t in dataset.testcases),
         time_limit=dataset.time_limit,
         memory_limit=dataset.memory_limit)
-    tasktype = get_task_type(job, file_cacher)
+    testcases = job.testcases.keys()
+    evaluated = evaluate_testcases(job, testcases, jobs)
 
     ask_again = True
     last_status = "ok"
@@ -99,7 +228,7 @@ def test_testcases(base_dir, soluzione, assume=None):
     info = []
     points = []
     comments = []
-    for i in job.testcases.keys():
+    for i in testcases:
         print i,
         sys.stdout.flush()
 
@@ -113,7 +242,7 @@ def test_testcases(base_dir, soluzione, assume=None):
 
         # Evaluate testcase
         last_status = status
-        tasktype.evaluate_testcase(i)
+        evaluated.next()
         # print job.evaluations[i]
         status = job.evaluations[i]["plus"]["exit_status"]
         info.append("Time: %5.3f   Wall: %5.3f   Memory: %s" %
@@ -135,8 +264,10 @@ def test_testcases(base_dir, soluzione, assume=None):
                 tmp = raw_input().lower()
             if tmp in ['y', 'yes']:
                 stop = True
+                evaluated.close()
             else:
                 ask_again = False
+    evaluated.close()
 
     # Result pretty printing
     print
@@ -152,10 +283,11 @@ def clean_test_env():
     """Clean the testing environment, mostly to reclaim disk space.
 
     """
-    # We're done: since we have no way to reuse this cache, we destroy
-    # it to free space. See the TODO above.
+    # We're done: the files stay in the persistent storage, so we
+    # destroy the local copies to free space.
     global file_cacher, task
     if file_cacher is not None:
+        file_cacher.save_digests()
         file_cacher.destroy_cache()
         file_cacher = None
         task = None
@@ -167,4 +299,11 @@ if __name__ == "__main__":
         assume = None
     else:
         assume = sys.argv[3]
-    test_testcases(sys.argv[1], sys.argv[2], assume)
+    if len(sys.argv) <= 4:
+        jobs = 1
+    else:
+        jobs = int(sys.argv[4])
+        if jobs > MAX_JOBS:
+            print "Using %d jobs, the maximum." % MAX_JOBS
+            jobs = MAX_JOBS
+    test_testcases(sys.argv[1], sys.argv[2], assume, jobs)
@@ -26,9 +26,14 @@ import sys
 import subprocess
 import copy
 import functools
+import hashlib
 import shutil
 import tempfile
+import threading
 import yaml
+from Queue import Queue
+
+import simplejson as json
 
 from cms.grading import get_compilation_command
 from cmstaskenv.Test import test_testcases, clean_test_env
@@ -56,6 +61,8 @@ GRAD_BASENAME = 'grader'
 INPUT_DIRNAME = 'input'
 OUTPUT_DIRNAME = 'output'
 RESULT_DIRNAME = 'result'
+STATE_FILENAME = '.cmsMake.json'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'cmsMake')
 
 DATA_DIRS = [os.path.join('.', 'cmstaskenv', 'data'),
              os.path.join('/', 'usr', 'local', 'share', 'cms', 'cmsMake')]
@@ -90,6 +97,75 @@ def basename2(string, suffixes):
     return (string[:-len(suffixes[idx])], string[-len(suffixes[idx]):])
 
 
+def hash_file(path):
+    """Return the SHA-1 (in hex) of the content of a file.
+
+    """
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        while True:
+            data = fin.read(1024 * 1024)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def hash_strings(*strings):
+    """Return the SHA-1 (in hex) of a sequence of strings.
+
+    """
+    hasher = hashlib.sha1()
+    for string in strings:
+        hasher.update("%d:%s" % (len(string), string))
+    return hasher.hexdigest()
+
+
+class FileCache:
+    """A persistent cache of the files produced by the actions, indexed
+    by the hash of everything the action depends on. It is shared by
+    all the tasks (and all the copies of the same task).
+
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, key, n):
+        return os.path.join(self.path, key[:2], "%s.%d" % (key, n))
+
+    def fetch(self, key, base_dir, outputs):
+        """Copy the cached files of key to the outputs, if available.
+
+        return (bool): whether the outputs were found.
+
+        """
+        paths = [self._path(key, n) for n in xrange(len(outputs))]
+        if not all(os.path.exists(path) for path in paths):
+            return False
+        for path, output in zip(paths, outputs):
+            try:
+                os.makedirs(os.path.dirname(os.path.join(base_dir, output)))
+            except OSError:
+                pass
+            shutil.copyfile(path, os.path.join(base_dir, output))
+        return True
+
+    def store(self, key, base_dir, outputs):
+        """Save a copy of the outputs produced by key.
+
+        """
+        try:
+            os.makedirs(os.path.join(self.path, key[:2]))
+        except OSError:
+            pass
+        for n, output in enumerate(outputs):
+            # Copy and rename, so that concurrent runs never see
+            # incomplete files.
+            temp_path = self._path(key, n) + ".%d.tmp" % os.getpid()
+            shutil.copyfile(os.path.join(base_dir, output), temp_path)
+            os.rename(temp_path, self._path(key, n))
+
+
 def call(base_dir, args, stdin=None, stdout=None, stderr=None, env=None):
     print >> sys.stderr, "> Executing command %s in dir %s" % \
         (" ".join(args), base_dir)
@@ -152,7 +228,10 @@ def noop():
     pass
 
 
-def build_sols_list(base_dir, task_type, in_out_files, yaml_conf):
+TEST_LOCK = threading.Lock()
+
+
+def build_sols_list(base_dir, task_type, in_out_files, yaml_conf, jobs=1):
     if yaml_conf.get('only_gen', False):
         return []
 
@@ -225,11 +304,15 @@ def build_sols_list(base_dir, task_type, in_out_files, yaml_conf):
                 shutil.rmtree(tempdir)
 
         def test_src(exe, assume=None):
-            print "Testing solution %s" % (exe)
-            test_testcases(
-                base_dir,
-                exe,
-                assume=assume)
+            # Tests may ask questions and share global state, so they
+            # run one at a time even when making in parallel.
+            with TEST_LOCK:
+                print "Testing solution %s" % (exe)
+                test_testcases(
+                    base_dir,
+                    exe,
+                    assume=assume,
+                    jobs=jobs)
 
         actions.append(
             (srcs,
@@ -364,10 +447,8 @@ def build_gen_list(base_dir, task_type):
 
     sol_exe = os.path.join(SOL_DIRNAME, SOL_FILENAME)
 
-    # Count non-trivial lines in GEN
-    testcase_num = 0
-    for line in iter_file(os.path.join(base_dir, gen_GEN)):
-        testcase_num += 1
+    gen_lines = list(iter_file(os.path.join(base_dir, gen_GEN)))
+    testcase_num = len(gen_lines)
 
     def compile_src(src, exe, lang, assume=None):
         if lang in ['cpp', 'c', 'pas']:
@@ -378,31 +459,35 @@ def build_gen_list(base_dir, task_type):
         else:
             raise Exception("Wrong generator/validator language!")
 
-    # Question: why, differently from outputs, inputs have to be
-    # created all together instead of selectively over those that have
-    # been changed since last execution? This is a waste of time,
-    # usually generating inputs is a pretty long thing. Answer:
-    # because cmsMake architecture, which is based on file timestamps,
-    # doesn't make us able to understand which lines of gen/GEN have
-    # been changed. Douch! We'll have to thing better this thing for
-    # the new format we're developing.
-    def make_input(assume=None):
-        n = 0
+    # Each input depends only on its line of gen/GEN and on the
+    # generator and validator, and each output on its input and on the
+    # solution: they are keyed by the hash of these things, so that
+    # editing a line regenerates only that input (and its output).
+    def input_key(line):
+        return hash_strings("input", line,
+                            hash_file(os.path.join(base_dir, gen_exe)),
+                            hash_file(os.path.join(base_dir, validator_exe)))
+
+    def output_key(n):
+        return hash_strings("output",
+                            hash_file(os.path.join(input_dir,
+                                                   'input%d.txt' % (n))),
+                            hash_file(os.path.join(base_dir, sol_exe)))
+
+    def make_input(n, line, assume=None):
         try:
             os.makedirs(input_dir)
         except OSError:
             pass
-        for line in iter_file(os.path.join(base_dir, gen_GEN)):
-            print >> sys.stderr, "Generating input # %d" % (n)
-            with open(os.path.join(input_dir,
-                                   'input%d.txt' % (n)), 'w') as fout:
-                call(base_dir,
-                     [gen_exe] + line.split(),
-                     stdout=fout)
+        print >> sys.stderr, "Generating input # %d" % (n)
+        with open(os.path.join(input_dir,
+                               'input%d.txt' % (n)), 'w') as fout:
             call(base_dir,
-                 [validator_exe, os.path.join(input_dir,
-                                              'input%d.txt' % (n))])
-            n += 1
+                 [gen_exe] + line.split(),
+                 stdout=fout)
+        call(base_dir,
+             [validator_exe, os.path.join(input_dir,
+                                          'input%d.txt' % (n))])
 
     def make_output(n, assume=None):
         try:
@@ -425,19 +510,20 @@ def build_gen_list(base_dir, task_type):
                     functools.partial(compile_src, validator_src,
                                       validator_exe, validator_lang),
                     "compile the validator"))
-    actions.append(([gen_GEN, gen_exe, validator_exe],
-                    map(lambda x: os.path.join(INPUT_DIRNAME,
-                                               'input%d.txt' % (x)),
-                        range(0, testcase_num)),
-                    make_input,
-                    "input generation"))
+    for n, line in enumerate(gen_lines):
+        actions.append(([gen_exe, validator_exe],
+                        [os.path.join(INPUT_DIRNAME, 'input%d.txt' % (n))],
+                        functools.partial(make_input, n, line),
+                        "input generation",
+                        functools.partial(input_key, line)))
 
     for n in xrange(testcase_num):
         actions.append(([os.path.join(INPUT_DIRNAME, 'input%d.txt' % (n)),
                          sol_exe],
                         [os.path.join(OUTPUT_DIRNAME, 'output%d.txt' % (n))],
                         functools.partial(make_output, n),
-                        "output generation"))
+                        "output generation",
+                        functools.partial(output_key, n)))
     in_out_files = [os.path.join(INPUT_DIRNAME, 'input%d.txt' % (n))
                     for n in xrange(testcase_num)] + \
                    [os.path.join(OUTPUT_DIRNAME, 'output%d.txt' % (n))
@@ -445,7 +531,7 @@ def build_gen_list(base_dir, task_type):
     return actions, in_out_files
 
 
-def build_action_list(base_dir, task_type, yaml_conf):
+def build_action_list(base_dir, task_type, yaml_conf, jobs=1):
     """Build a list of actions that cmsMake is able to do here. Each
     action is described by a tuple (infiles, outfiles, callable,
     description) where:
@@ -463,11 +549,22 @@ def build_action_list(base_dir, task_type, yaml_conf):
     4) description is a human-readable description of what this
     action does.
 
+    jobs is the number of testcases the tests of the solutions
+    evaluate at the same time.
+
+    Optionally, a fifth element key is a callable returning a hash of
+    everything the action depends on (to be called once the infiles
+    have been made). When present, the action is skipped if the
+    outfiles were made with the same key (instead of looking at
+    timestamps), and the outfiles are saved in, and possibly taken
+    from, the persistent cache.
+
     """
     actions = []
     gen_actions, in_out_files = build_gen_list(base_dir, task_type)
     actions += gen_actions
-    actions += build_sols_list(base_dir, task_type, in_out_files, yaml_conf)
+    actions += build_sols_list(base_dir, task_type, in_out_files, yaml_conf,
+                               jobs=jobs)
     actions += build_checker_list(base_dir, task_type)
     #actions += build_text_list(base_dir, task_type)
     return actions
@@ -494,6 +591,10 @@ def clean(base_dir, generated_list):
         shutil.rmtree(os.path.join(base_dir, RESULT_DIRNAME))
     except OSError:
         pass
+    try:
+        os.remove(os.path.join(base_dir, STATE_FILENAME))
+    except OSError:
+        pass
 
     # Delete backup files
     os.system("find %s -name '*.pyc' -delete" % (base_dir))
@@ -504,94 +605,199 @@ def build_execution_tree(actions):
     """Given a set of actions as described in the docstring of
     build_action_list(), builds an execution tree and the list of all
     the buildable files. The execution tree is a dictionary that maps
-    each builable or source file to the tuple (infiles, callable),
-    where infiles and callable are as in the docstring of
-    build_action_list().
+    each builable or source file to the tuple (infiles, callable, key,
+    outfiles), where infiles, callable, key and outfiles are as in the
+    docstring of build_action_list() (key being None when missing).
 
     """
     exec_tree = {}
     generated_list = []
     src_list = set()
     for action in actions:
+        key = action[4] if len(action) > 4 else None
         for exe in action[1]:
             if exe in exec_tree:
                 raise Exception("Target %s not unique" % (exe))
-            exec_tree[exe] = (action[0], action[2])
+            exec_tree[exe] = (action[0], action[2], key, action[1])
             generated_list.append(exe)
         for src in action[0]:
             src_list.add(src)
     for src in src_list:
         if src not in exec_tree:
-            exec_tree[src] = ([], noop)
+            exec_tree[src] = ([], noop, None, [src])
     return exec_tree, generated_list
 
 
-def execute_target(base_dir, exec_tree, target,
-                   already_executed=None, stack=None,
+def load_state(base_dir):
+    """Return the keys with which the targets were last made.
+
+    """
+    try:
+        with open(os.path.join(base_dir, STATE_FILENAME)) as fin:
+            return json.load(fin)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_state(base_dir, state):
+    with open(os.path.join(base_dir, STATE_FILENAME), 'w') as fout:
+        json.dump(state, fout, indent=4, sort_keys=True)
+
+
+def sort_targets(exec_tree, targets):
+    """Return the targets and all their dependencies, in an order
+    such that each target comes after its dependencies.
+
+    """
+    result = []
+    visited = set()
+    stack = set()
+
+    def visit(target):
+        # If this target is already in the stack, we have a circular
+        # dependency
+        if target in stack:
+            raise Exception("Circular dependency detected")
+        if target in visited:
+            return
+        stack.add(target)
+        for dep in exec_tree[target][0]:
+            visit(dep)
+        stack.remove(target)
+        visited.add(target)
+        result.append(target)
+
+    for target in targets:
+        visit(target)
+    return result
+
+
+def execute_target(base_dir, exec_tree, target, state, cache=None,
                    debug=False, assume=None):
-    # Initialization
-    if debug:
-        print ">> Target %s is requested" % (target)
-    if already_executed is None:
-        already_executed = set()
-    if stack is None:
-        stack = set()
-
-    # Get target information
-    deps = exec_tree[target][0]
-    action = exec_tree[target][1]
-
-    # If this target is already in the stack, we have a circular
-    # dependency
-    if target in stack:
-        raise Exception("Circular dependency detected")
-
-    # If the target was already made in another subtree, we have
-    # nothing to do
-    if target in already_executed:
-        if debug:
-            print ">> Target %s has already been built, ignoring..." % (target)
-        return
+    """Make a target (whose dependencies are assumed to be already
+    made), if it is not new enough.
 
-    # Otherwise, do a step of the DFS to make dependencies
-    if debug:
-        print ">> Building dependencies for target %s" % (target)
-    already_executed.add(target)
-    stack.add(target)
-    for dep in deps:
-        execute_target(base_dir, exec_tree, dep,
-                       already_executed, stack, assume=assume)
-    stack.remove(target)
-    if debug:
-        print ">> Dependencies built for target %s" % (target)
+    state (dict): the keys of the targets, updated if needed.
+    cache (FileCache): the cache to use, or None.
 
-    # Check if the action really needs to be done (i.e., there is one
-    # dependency more recent than the generated file)
-    dep_times = max([0] + map(lambda dep: os.stat(
-        os.path.join(base_dir, dep)).st_mtime, deps))
-    try:
-        gen_time = os.stat(os.path.join(base_dir, target)).st_mtime
-    except OSError:
-        gen_time = 0
-    if gen_time >= dep_times:
-        if debug:
-            print ">> Target %s is already new enough, not building" % (target)
+    """
+    deps, action, key_fn, outputs = exec_tree[target]
+    if action is noop:
         return
 
+    if key_fn is not None:
+        # Check if the action really needs to be done (i.e., it has
+        # not been made with these very same dependencies)
+        key = key_fn()
+        if all(state.get(output) == key and
+               os.path.exists(os.path.join(base_dir, output))
+               for output in outputs):
+            if debug:
+                print ">> Target %s is up to date, not building" % (target)
+            return
+        if cache is not None and cache.fetch(key, base_dir, outputs):
+            print >> sys.stderr, "Target %s taken from cache" % (target)
+            for output in outputs:
+                state[output] = key
+            return
+
+    else:
+        # Check if the action really needs to be done (i.e., there is
+        # one dependency more recent than the generated file)
+        dep_times = max([0] + map(lambda dep: os.stat(
+            os.path.join(base_dir, dep)).st_mtime, deps))
+        try:
+            gen_time = os.stat(os.path.join(base_dir, target)).st_mtime
+        except OSError:
+            gen_time = 0
+        if gen_time >= dep_times:
+            if debug:
+                print ">> Target %s is already new enough, not building" % \
+                    (target)
+            return
+
     # At last: actually make the so long desired action :-)
     if debug:
         print ">> Acutally building target %s" % (target)
+    for output in outputs:
+        state.pop(output, None)
     action(assume=assume)
+    if key_fn is not None:
+        for output in outputs:
+            state[output] = key
+        if cache is not None:
+            cache.store(key, base_dir, outputs)
     if debug:
         print ">> Target %s finished to build" % (target)
 
 
 def execute_multiple_targets(base_dir, exec_tree, targets,
-                             debug=False, assume=None):
-    already_executed = set()
-    for target in targets:
-        execute_target(base_dir, exec_tree, target,
-                       already_executed, debug=debug, assume=assume)
+                             debug=False, assume=None, jobs=1,
+                             cache=None):
+    """Make the targets and their dependencies, running up to jobs
+    actions at the same time.
+
+    """
+    order = sort_targets(exec_tree, targets)
+    state = load_state(base_dir)
+
+    # Targets made by the same action are made together, by the first
+    # one that becomes ready.
+    waiting = dict((target, set(exec_tree[target][0])) for target in order)
+    needed_by = dict((target, []) for target in order)
+    for target in order:
+        for dep in exec_tree[target][0]:
+            needed_by[dep].append(target)
+    started = set()
+    running = [0]
+    failed = []
+    results = Queue()
+
+    def worker(target):
+        try:
+            execute_target(base_dir, exec_tree, target, state, cache=cache,
+                           debug=debug, assume=assume)
+        except BaseException as error:
+            results.put((target, error))
+        else:
+            results.put((target, None))
+
+    def start_ready():
+        for target in order:
+            if target not in started and not waiting[target] \
+                    and running[0] < jobs:
+                for output in exec_tree[target][3]:
+                    started.add(output)
+                started.add(target)
+                running[0] += 1
+                if jobs == 1:
+                    worker(target)
+                else:
+                    thread = threading.Thread(target=worker, args=(target,))
+                    thread.daemon = True
+                    thread.start()
+
+    try:
+        start_ready()
+        while running[0] > 0:
+            target, error = results.get()
+            running[0] -= 1
+            if error is not None:
+                failed.append((target, error))
+            else:
+                for output in set(exec_tree[target][3] + [target]):
+                    for other in needed_by.get(output, []):
+                        waiting[other].discard(output)
+            if not failed:
+                start_ready()
+    finally:
+        save_state(base_dir, state)
+
+    if failed:
+        target, error = failed[0]
+        if isinstance(error, SystemExit):
+            raise error
+        raise Exception("Cannot make target %s: %r" % (target, error))
 
 
 def main():
@@ -620,6 +826,20 @@ def main():
     parser.add_argument("-d", "--debug",
                         help="enable debug messages",
                         dest="debug", action="store_true", default=False)
+    parser.add_argument("-j", "--jobs",
+                        help="number of actions (and of testcases, when "
+                        "testing a solution) to run at the same time "
+                        "(default 1)",
+                        dest="jobs", action="store", type=int, default=1)
+    parser.add_argument("--cache-dir",
+                        help="directory of the cache of generated inputs "
+                        "and outputs (default %s)" % DEFAULT_CACHE_DIR,
+                        dest="cache_dir", action="store",
+                        default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--no-cache",
+                        help="don't use the cache of generated inputs "
+                        "and outputs",
+                        dest="cache_dir", action="store_const", const=None)
     parser.add_argument("targets", metavar="target", nargs="*",
                         help="target to build", type=str)
     options = parser.parse_args()
@@ -631,10 +851,13 @@ def main():
         base_dir = os.path.abspath(base_dir)
 
     assume = options.assume
+    cache = FileCache(options.cache_dir) \
+        if options.cache_dir is not None else None
 
     task_type = detect_task_type(base_dir)
     yaml_conf = parse_task_yaml(base_dir)
-    actions = build_action_list(base_dir, task_type, yaml_conf)
+    actions = build_action_list(base_dir, task_type, yaml_conf,
+                                jobs=options.jobs)
     exec_tree, generated_list = build_execution_tree(actions)
 
     if [len(options.targets) > 0, options.list, options.clean,
@@ -658,7 +881,8 @@ def main():
         try:
             execute_multiple_targets(base_dir, exec_tree,
                                      generated_list, debug=options.debug,
-                                     assume=assume)
+                                     assume=assume, jobs=options.jobs,
+                                     cache=cache)
 
         # After all work, possibly clean the left-overs of testing
         finally:
@@ -668,7 +892,8 @@ def main():
         try:
             execute_multiple_targets(base_dir, exec_tree,
                                      options.targets, debug=options.debug,
-                                     assume=assume)
+                                     assume=assume, jobs=options.jobs,
+                                     cache=cache)
 
         # After all work, possibly clean the left-overs of testing
         finally:
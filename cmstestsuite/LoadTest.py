@@ -0,0 +1,600 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Programming contest management system
+# Copyright © 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Load generator and benchmark for CWS, AWS and RWS.
+
+Unlike StressTest, which simulates users that wait for each answer
+before doing something else, the traffic here is open loop: requests
+of each type arrive at a given rate (as a Poisson process), whether
+or not the previous ones have been served. Latencies are measured
+from the time each request was supposed to start, so a server that
+falls behind gets the blame for the queueing it causes. Requests are
+executed by many threads in many processes, using the same request
+classes of StressTest.
+
+A scenario is a JSON file like the following (rates are in requests
+per second, over the whole run):
+
+    {
+        "duration": 60,
+        "processes": 4,
+        "threads": 32,
+        "cws_url": "http://localhost:8888/",
+        "aws_url": "http://localhost:8889/",
+        "rws_url": "http://localhost:8890/",
+        "rws_auth": "usern4me:passw0rd",
+        "submissions_path": "./submissions/",
+        "requests": {
+            "task": 20.0,
+            "statement": 5.0,
+            "submit": 1.0,
+            "aws_submission": 0.5,
+            "ranking_change": 50.0
+        },
+        "ranking_events": 200,
+        "ranking_users": 100
+    }
+
+"ranking_events" is the number of event streams opened on RWS (as
+spectators of the scoreboard do); the latency of each event received
+is recorded too. "ranking_change" requests push random score changes
+to RWS, as ScoringService does, for a contest of "ranking_users" users
+created on RWS before the run; with them, RWS can be tested alone
+(run it with a different number of workers, RankingWebServer -w N, to
+compare how many connections each core can serve). The contest id is
+needed only by the requests to CWS and AWS.
+
+The results (counts, errors and latency histograms for each request
+type) are printed and can be saved as JSON; two such files can then
+be compared, to catch regressions between runs.
+
+"""
+
+import os
+import sys
+import time
+import random
+import base64
+import argparse
+import socket
+import threading
+import urllib2
+import urlparse
+import multiprocessing
+from Queue import Queue
+
+import simplejson as json
+import mechanize
+
+from cms.db.SQLAlchemyAll import SessionGen, Submission, User
+
+from cmstestsuite.StressTest import harvest_contest_data
+from cmstestsuite.web.CWSRequests import LoginRequest, TaskRequest, \
+     TaskStatementRequest, SubmitRandomRequest
+from cmstestsuite.web.AWSRequests import AWSSubmissionViewRequest
+
+
+class Histogram:
+    """A latency histogram with bounded relative error.
+
+    Values are recorded in microseconds: the ones below 128 exactly,
+    the others in buckets as wide as 1/64 of their lower bound, so
+    that every percentile is within ~1.5% of the true value whatever
+    the range of the data, using at most 64 buckets per power of two.
+
+    """
+    SIGNIFICANT_BITS = 7
+
+    def __init__(self, buckets=None):
+        # Count of values in each bucket, indexed by "exponent:mantissa".
+        self.buckets = dict(buckets) if buckets is not None else dict()
+
+    def record(self, seconds):
+        value = max(0, int(seconds * 1000000))
+        exponent = max(0, value.bit_length() - Histogram.SIGNIFICANT_BITS)
+        key = "%d:%d" % (exponent, value >> exponent)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def merge(self, other):
+        for key, count in other.buckets.iteritems():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+    @staticmethod
+    def _value(key):
+        """Return the value (in seconds) representing a bucket."""
+        exponent, mantissa = [int(x) for x in key.split(":")]
+        return ((mantissa << exponent) + (1 << exponent) / 2) / 1000000.0
+
+    def count(self):
+        return sum(self.buckets.itervalues())
+
+    def percentile(self, percent):
+        """Return the value below which percent% of values fall.
+
+        percent (float): between 0 and 100.
+
+        return (float): the value, in seconds, or None if empty.
+
+        """
+        total = self.count()
+        if total == 0:
+            return None
+        threshold = total * percent / 100.0
+        seen = 0
+        for value, count in sorted((Histogram._value(key), count)
+                                   for key, count
+                                   in self.buckets.iteritems()):
+            seen += count
+            if seen >= threshold:
+                return value
+        return value
+
+
+class Stats:
+    """Counts, errors and latencies for each type of request."""
+
+    def __init__(self, data=None):
+        self.types = dict()
+        if data is not None:
+            for name, entry in data.iteritems():
+                self.types[name] = {
+                    "count": entry["count"],
+                    "errors": entry["errors"],
+                    "histogram": Histogram(entry["histogram"])}
+
+    def _get(self, name):
+        if name not in self.types:
+            self.types[name] = {"count": 0, "errors": 0,
+                                "histogram": Histogram()}
+        return self.types[name]
+
+    def record(self, name, latency, error=False):
+        entry = self._get(name)
+        entry["count"] += 1
+        if error:
+            entry["errors"] += 1
+        else:
+            entry["histogram"].record(latency)
+
+    def merge(self, other):
+        for name, entry in other.types.iteritems():
+            mine = self._get(name)
+            mine["count"] += entry["count"]
+            mine["errors"] += entry["errors"]
+            mine["histogram"].merge(entry["histogram"])
+
+    def to_dict(self):
+        return dict((name, {"count": entry["count"],
+                            "errors": entry["errors"],
+                            "histogram": entry["histogram"].buckets})
+                    for name, entry in self.types.iteritems())
+
+    def summary(self, duration):
+        """Return the main figures for each type of request.
+
+        duration (float): the length of the run, in seconds.
+
+        return (dict): for each type, count, errors, rate and some
+                       percentiles of the latency.
+
+        """
+        result = dict()
+        for name, entry in self.types.iteritems():
+            histogram = entry["histogram"]
+            result[name] = {"count": entry["count"],
+                            "errors": entry["errors"],
+                            "rate": entry["count"] / duration}
+            for percent in [50, 90, 99, 99.9, 100]:
+                result[name]["p%s" % percent] = \
+                    histogram.percentile(percent)
+        return result
+
+
+class BrowserPool:
+    """Logged-in browsers, one per user, to be used by a thread at a
+    time.
+
+    """
+
+    def __init__(self, users, base_url):
+        self.base_url = base_url
+        self.free = Queue()
+        for username, data in users.iteritems():
+            self.free.put((username, data["password"], None))
+
+        self.size = len(users)
+
+    def get(self):
+        """Return a free user, as (username, password, browser); the
+        browser is None if it still has to log in (see login).
+
+        """
+        return self.free.get()
+
+    def login(self, username, password):
+        """Return a new browser, logged in as the given user."""
+        browser = mechanize.Browser()
+        request = LoginRequest(browser, username, password,
+                               base_url=self.base_url)
+        request.execute()
+        if request.outcome != request.OUTCOME_SUCCESS:
+            raise ValueError("Cannot log in as %s." % username)
+        return browser
+
+    def put(self, item):
+        self.free.put(item)
+
+
+class LoadGenerator:
+    """The traffic generated by one process."""
+
+    # The types of request sent to CWS, as one of the users.
+    CWS_REQUESTS = ["task", "statement", "submit"]
+
+    def __init__(self, scenario, users, tasks, submission_ids, share):
+        """Prepare the generator.
+
+        scenario (dict): the scenario (see the module docstring).
+        users (dict): the users this process may log in as.
+        tasks ([(int, str)]): the tasks of the contest.
+        submission_ids ([int]): the submissions that AWS can show.
+        share (float): the fraction of the traffic of this process.
+
+        """
+        self.scenario = scenario
+        self.tasks = tasks
+        self.submission_ids = submission_ids
+        self.share = share
+        self.stats = Stats()
+        self.stats_lock = threading.Lock()
+        self.work = Queue()
+        self.stop_time = None
+        self.cws_pool = BrowserPool(users, scenario.get("cws_url"))
+        self.aws_browsers = Queue()
+        self.ranking_changes = 0
+
+    def make_request(self, name, browser):
+        """Return the request object for a request type."""
+        task = random.choice(self.tasks)
+        if name == "task":
+            return TaskRequest(browser, task[0],
+                               base_url=self.scenario["cws_url"])
+        elif name == "statement":
+            return TaskStatementRequest(browser, task[0],
+                                        base_url=self.scenario["cws_url"])
+        elif name == "submit":
+            return SubmitRandomRequest(
+                browser, task, base_url=self.scenario["cws_url"],
+                submissions_path=self.scenario["submissions_path"])
+        elif name == "aws_submission":
+            return AWSSubmissionViewRequest(
+                browser, random.choice(self.submission_ids),
+                base_url=self.scenario["aws_url"])
+        else:
+            raise ValueError("Unknown request type %s." % name)
+
+    def push_ranking_change(self):
+        """Send a random score change to RWS."""
+        with self.stats_lock:
+            self.ranking_changes += 1
+            counter = self.ranking_changes
+        user = random.randrange(self.scenario.get("ranking_users", 100))
+        # The changes with the same time are sorted by key.
+        put_ranking(self.scenario,
+                    "subchanges/loadtest%d_%09d" % (os.getpid(), counter),
+                    {"submission": "loadtest%d" % user,
+                     "time": int(time.time()),
+                     "score": float(random.randrange(101))})
+
+    def execute(self, name, scheduled):
+        if name == "ranking_change":
+            try:
+                self.push_ranking_change()
+                error = False
+            except Exception:
+                error = True
+            with self.stats_lock:
+                self.stats.record(name, time.time() - scheduled, error)
+            return
+
+        if name == "aws_submission":
+            try:
+                browser = self.aws_browsers.get_nowait()
+            except Exception:
+                browser = mechanize.Browser()
+            username, password = None, None
+        else:
+            username, password, browser = self.cws_pool.get()
+        try:
+            if browser is None:
+                browser = self.cws_pool.login(username, password)
+            request = self.make_request(name, browser)
+            request.prepare()
+            request.execute()
+            error = request.outcome != request.OUTCOME_SUCCESS
+        except Exception:
+            error = True
+            if username is not None:
+                # Log in again at the next request of the user.
+                browser = None
+        finally:
+            if username is None:
+                self.aws_browsers.put(browser)
+            else:
+                self.cws_pool.put((username, password, browser))
+        with self.stats_lock:
+            self.stats.record(name, time.time() - scheduled, error)
+
+    def worker(self):
+        while True:
+            name, scheduled = self.work.get()
+            if name is None:
+                return
+            self.execute(name, scheduled)
+
+    def schedule(self, name, rate):
+        """Put requests of a type in the work queue, at the right
+        times, until the end of the run.
+
+        """
+        scheduled = time.time()
+        while True:
+            scheduled += random.expovariate(rate)
+            if scheduled >= self.stop_time:
+                return
+            time.sleep(max(0.0, scheduled - time.time()))
+            self.work.put((name, scheduled))
+
+    def listen_events(self):
+        """Keep an event stream of RWS open, recording how late each
+        event arrives.
+
+        """
+        url = urlparse.urlsplit(self.scenario["rws_url"])
+        try:
+            # We speak HTTP/1.0, so that the stream isn't chunked, and
+            # read it from the socket, as urllib2 would wait for whole
+            # blocks of data, delaying the events.
+            sock = socket.create_connection(
+                (url.hostname, url.port or 80), timeout=10)
+            sock.sendall("GET %s/events?last_event_id=%0.6f HTTP/1.0\r\n"
+                         "Host: %s\r\n\r\n" %
+                         (url.path.rstrip("/"), time.time(), url.netloc))
+            stream = sock.makefile("rb")
+            if " 200 " not in stream.readline():
+                raise ValueError("Cannot open the event stream.")
+            while time.time() < self.stop_time:
+                line = stream.readline()
+                if not line:
+                    break
+                if line.startswith("id: "):
+                    with self.stats_lock:
+                        self.stats.record(
+                            "ranking_event", time.time() - float(line[4:]))
+        except Exception:
+            with self.stats_lock:
+                self.stats.record("ranking_event", 0.0, error=True)
+
+    def run(self):
+        self.stop_time = time.time() + self.scenario["duration"]
+
+        threads = []
+        for i in xrange(self.scenario.get("threads", 16)):
+            threads.append(threading.Thread(target=self.worker))
+        for name, rate in self.scenario.get("requests", {}).iteritems():
+            if name in LoadGenerator.CWS_REQUESTS and \
+                    self.cws_pool.size == 0:
+                # No users to send them as.
+                continue
+            if rate * self.share > 0:
+                threads.append(threading.Thread(
+                    target=self.schedule, args=(name, rate * self.share)))
+        listeners = []
+        for i in xrange(int(self.scenario.get("ranking_events", 0) *
+                            self.share)):
+            listeners.append(threading.Thread(target=self.listen_events))
+
+        for thread in threads + listeners:
+            thread.daemon = True
+            thread.start()
+
+        # Wait for the schedulers, then stop the workers once they
+        # have done what has been scheduled.
+        time.sleep(self.scenario["duration"])
+        for i in xrange(self.scenario.get("threads", 16)):
+            self.work.put((None, None))
+        for thread in threads:
+            thread.join()
+        return self.stats
+
+
+def put_ranking(scenario, path, data):
+    """Send (PUT) an entity, or a list of them, to RWS.
+
+    scenario (dict): the scenario, with the URL and the credentials
+                     of RWS.
+    path (string): the path of the entity, e.g. "users/".
+    data (dict): the entity or the list.
+
+    """
+    request = urllib2.Request(
+        scenario["rws_url"].rstrip("/") + "/" + path, json.dumps(data),
+        {"Authorization": "Basic " + base64.b64encode(
+            scenario.get("rws_auth", "usern4me:passw0rd")),
+         "Content-Type": "application/json"})
+    request.get_method = lambda: "PUT"
+    urllib2.urlopen(request, timeout=10).close()
+
+
+def setup_ranking(scenario):
+    """Create on RWS the contest, the task, the users and a
+    submission for each of them, that the score changes refer to.
+
+    """
+    users = scenario.get("ranking_users", 100)
+    put_ranking(scenario, "contests/loadtest",
+                {"name": "Load test", "begin": 0,
+                 "end": 2000000000, "score_precision": 0})
+    put_ranking(scenario, "tasks/loadtest",
+                {"name": "Load test", "short_name": "loadtest",
+                 "contest": "loadtest", "max_score": 100.0,
+                 "score_precision": 0, "extra_headers": [], "order": 0})
+    put_ranking(scenario, "users/",
+                dict(("loadtest%d" % i, {"f_name": "Load",
+                                         "l_name": "%d" % i,
+                                         "team": None})
+                     for i in xrange(users)))
+    put_ranking(scenario, "submissions/",
+                dict(("loadtest%d" % i, {"user": "loadtest%d" % i,
+                                         "task": "loadtest", "time": 0})
+                     for i in xrange(users)))
+
+
+def run_process(scenario, users, tasks, submission_ids, share, results):
+    generator = LoadGenerator(scenario, users, tasks, submission_ids, share)
+    results.put(generator.run().to_dict())
+
+
+def print_summary(summary):
+    print >> sys.stderr, "%-16s %8s %7s %8s %8s %8s %8s %8s %8s" % \
+        ("TYPE", "COUNT", "ERRORS", "RATE", "P50", "P90", "P99",
+         "P99.9", "MAX")
+    for name in sorted(summary):
+        entry = summary[name]
+        print >> sys.stderr, "%-16s %8d %7d %8.2f %s" % \
+            (name, entry["count"], entry["errors"], entry["rate"],
+             " ".join("%8.3f" % entry[key]
+                      if entry[key] is not None else "%8s" % "-"
+                      for key in ["p50", "p90", "p99", "p99.9", "p100"]))
+
+
+def run(args):
+    with open(args.scenario) as scenario_file:
+        scenario = json.load(scenario_file)
+
+    users, tasks, submission_ids = {}, [], []
+    if args.contest_id is not None:
+        users, tasks = harvest_contest_data(args.contest_id)
+        with SessionGen(commit=False) as session:
+            submission_ids = [submission_id for submission_id, in
+                              session.query(Submission.id).join(User)
+                              .filter(User.contest_id == args.contest_id)
+                              .all()]
+    elif any(name != "ranking_change" and rate > 0 for name, rate
+             in scenario.get("requests", {}).iteritems()):
+        print >> sys.stderr, "The contest id is needed for the requests " \
+            "to CWS and AWS."
+        return 1
+
+    if scenario.get("requests", {}).get("ranking_change", 0) > 0:
+        setup_ranking(scenario)
+
+    processes = scenario.get("processes", multiprocessing.cpu_count())
+    usernames = sorted(users)
+    random.shuffle(usernames)
+    results = multiprocessing.Queue()
+    workers = []
+    for i in xrange(processes):
+        process_users = dict((username, users[username])
+                             for username in usernames[i::processes])
+        workers.append(multiprocessing.Process(
+            target=run_process,
+            args=(scenario, process_users, tasks, submission_ids,
+                  1.0 / processes, results)))
+    for worker in workers:
+        worker.start()
+
+    stats = Stats()
+    for worker in workers:
+        stats.merge(Stats(results.get()))
+    for worker in workers:
+        worker.join()
+
+    result = {"scenario": scenario,
+              "time": time.time(),
+              "stats": stats.to_dict(),
+              "summary": stats.summary(scenario["duration"])}
+    print_summary(result["summary"])
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(result, output_file, indent=4)
+    return 0
+
+
+def compare(args):
+    """Compare the latencies of two runs.
+
+    return (int): 1 if some percentile got worse by more than the
+                  threshold, 0 otherwise.
+
+    """
+    with open(args.old) as old_file:
+        old = json.load(old_file)["summary"]
+    with open(args.new) as new_file:
+        new = json.load(new_file)["summary"]
+
+    regressions = 0
+    print >> sys.stderr, "%-16s %-6s %8s %8s %8s" % \
+        ("TYPE", "", "OLD", "NEW", "CHANGE")
+    for name in sorted(set(old) & set(new)):
+        for key in ["p50", "p90", "p99", "rate"]:
+            if old[name][key] is None or new[name][key] is None:
+                continue
+            change = (new[name][key] - old[name][key]) / \
+                max(old[name][key], 1e-6) * 100
+            worse = change < -args.threshold if key == "rate" \
+                else change > args.threshold
+            if worse:
+                regressions += 1
+            print >> sys.stderr, "%-16s %-6s %8.3f %8.3f %+7.1f%%%s" % \
+                (name, key, old[name][key], new[name][key], change,
+                 " REGRESSION" if worse else "")
+    return 1 if regressions > 0 else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load generator and benchmark for CMS.")
+    subparsers = parser.add_subparsers()
+
+    run_parser = subparsers.add_parser("run", help="run a scenario")
+    run_parser.add_argument("scenario", help="the scenario file")
+    run_parser.add_argument("-c", "--contest-id", type=int,
+                            help="the contest to use (needed by the "
+                            "requests to CWS and AWS)")
+    run_parser.add_argument("-o", "--output",
+                            help="where to save the results, as JSON")
+    run_parser.set_defaults(function=run)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="compare the results of two runs")
+    compare_parser.add_argument("old", help="the results of the first run")
+    compare_parser.add_argument("new", help="the results of the second run")
+    compare_parser.add_argument("-t", "--threshold", type=float,
+                                default=10.0,
+                                help="change (in %%) to consider a "
+                                "regression")
+    compare_parser.set_defaults(function=compare)
+
+    args = parser.parse_args()
+    return args.function(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
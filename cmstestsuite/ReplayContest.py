@@ -23,6 +23,14 @@ ReplayContest takes as input a contest exported with ContestExported
 CWS for all submissions and tokens asked by the contestants, at the
 right timing. The time can be increased in order to stress-test CMS.
 
+With --benchmark, it also follows each submission through the judging
+pipeline (by polling the database and, optionally, RWS) and records
+how long it took to be stored, compiled, evaluated, scored and shown
+in the ranking. The results are saved as JSON, with a summary of
+throughput and latencies over time (the "curve"), which helps sizing
+the number of workers: replay the same contest at increasing speeds
+and see when latencies start to grow.
+
 TODO:
 - currently only works with tasks with one file per submission (this
   is a limitation of SubmitRequest).
@@ -40,12 +48,16 @@ import simplejson as json
 import sys
 import tempfile
 import time
+import urllib2
 
 from argparse import ArgumentParser
 from mechanize import Browser
 from threading import Thread, RLock
 
 from cms import config, logger
+from cms.db.SQLAlchemyAll import SessionGen, Contest, Submission, \
+     SubmissionResult, Task, User
+from cms.service.ScoringService import encode_id
 from cmscontrib.ContestImporter import ContestImporter
 from cmstestsuite.web.CWSRequests import \
      LoginRequest, SubmitRequest, TokenRequest
@@ -76,17 +88,249 @@ def step(request):
     request.execute()
 
 
+class PipelineMonitor:
+    """Follow the submissions through the judging pipeline.
+
+    The replayer tells us when it sends a submission; we poll the
+    database to see when it is stored and when its result (for the
+    active dataset) gets compiled, evaluated and scored, and RWS to see
+    when its score is shown in the ranking. Latencies are thus
+    measured with the precision of the polling interval.
+
+    """
+
+    # The stages of a submission, in order, after it is sent to CWS.
+    STAGES = ["stored", "compiled", "evaluated", "scored", "ranked"]
+
+    def __init__(self, contest_name, rws_address=None, interval=0.5,
+                 window=60.0):
+        """Create the monitor.
+
+        contest_name (string): the name of the replayed contest.
+        rws_address (string): http address of RWS, or None not to
+                              check the ranking.
+        interval (float): seconds between two polls.
+        window (float): seconds of each interval of the curve.
+
+        """
+        self.contest_name = contest_name
+        self.rws_address = rws_address
+        self.interval = interval
+        self.window = window
+
+        self.contest_id = None
+        self.last_id = None
+        self.start = None
+        self.speeds = []
+
+        # Times at which submissions have been sent, still to be
+        # matched to the stored ones, indexed by (username, task).
+        self.sent = {}
+        self.lock = RLock()
+        # Submission records, and the ones that are not complete yet,
+        # indexed by id.
+        self.records = {}
+        self.pending = {}
+
+    def begin(self, speed):
+        """Start polling (call once the contest is ready).
+
+        speed (float): the initial speed multiplier.
+
+        """
+        with SessionGen(commit=False) as session:
+            contest = session.query(Contest)\
+                .filter(Contest.name == self.contest_name)\
+                .order_by(Contest.id.desc()).first()
+            self.contest_id = contest.id
+            # We ignore what has been submitted before the replay.
+            last = session.query(Submission.id)\
+                .order_by(Submission.id.desc()).first()
+            self.last_id = last[0] if last is not None else 0
+        self.start = time.time()
+        self.speed_changed(speed)
+
+        thread = Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def speed_changed(self, speed):
+        self.speeds.append([time.time() - self.start, speed])
+
+    def submitting(self, username, task_name):
+        """Record that a submission is being sent to CWS."""
+        with self.lock:
+            self.sent.setdefault((username, task_name), []).append(
+                time.time())
+
+    def submit_failed(self, username, task_name):
+        """Forget the last submission sent, as CWS refused it."""
+        with self.lock:
+            self.sent[(username, task_name)].pop()
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as error:
+                logger.warning("Error while polling the pipeline: %r." %
+                               error)
+            time.sleep(self.interval)
+
+    def poll(self):
+        """Look for new submissions and for progress of the old ones."""
+        with SessionGen(commit=False) as session:
+            now = time.time()
+            for submission in session.query(Submission).join(User)\
+                    .filter(User.contest_id == self.contest_id)\
+                    .filter(Submission.id > self.last_id)\
+                    .order_by(Submission.id).all():
+                key = (submission.user.username, submission.task.name)
+                with self.lock:
+                    if not self.sent.get(key):
+                        # Not sent by us (submitting() is called
+                        # before sending): we don't track it.
+                        self.last_id = submission.id
+                        continue
+                    sent = self.sent[key].pop(0)
+                record = {"id": submission.id,
+                          "user": key[0],
+                          "task": key[1],
+                          "sent": sent - self.start,
+                          "stored": now - self.start}
+                self.records[submission.id] = record
+                self.pending[submission.id] = record
+                self.last_id = submission.id
+
+            if self.pending:
+                now = time.time()
+                for result in session.query(SubmissionResult)\
+                        .join(Task, Task.active_dataset_id ==
+                              SubmissionResult.dataset_id)\
+                        .filter(SubmissionResult.submission_id.in_(
+                            self.pending.keys())).all():
+                    record = self.pending[result.submission_id]
+                    for stage, done in [("compiled", result.compiled()),
+                                        ("evaluated", result.evaluated()),
+                                        ("scored", result.scored())]:
+                        if done and stage not in record:
+                            record[stage] = now - self.start
+
+        if self.rws_address is not None:
+            scored = [pending for pending in self.pending.itervalues()
+                      if "scored" in pending]
+            if scored:
+                # A submission is ranked when the subchange with its
+                # score is in RWS (which applies it to the scores as
+                # soon as it stores it), not just the submission.
+                now = time.time()
+                subchanges = json.load(urllib2.urlopen(
+                    self.rws_address.rstrip("/") + "/subchanges/"))
+                ranked = set(subchange["submission"]
+                             for subchange in subchanges.itervalues()
+                             if subchange.get("score") is not None)
+                for record in scored:
+                    if encode_id(record["id"]) in ranked:
+                        record["ranked"] = now - self.start
+
+        last_stage = "scored" if self.rws_address is None else "ranked"
+        for submission_id, record in self.pending.items():
+            if last_stage in record:
+                del self.pending[submission_id]
+
+    def wait(self, timeout):
+        """Wait for the pending submissions to complete.
+
+        timeout (float): maximum seconds to wait.
+
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if not self.pending and \
+                        not any(self.sent.itervalues()):
+                    return
+            time.sleep(self.interval)
+        logger.warning("%d submissions did not complete." %
+                       len(self.pending))
+
+    def curve(self):
+        """Compute throughput and latencies over time.
+
+        return ([dict]): for each window, the submissions sent and
+                         scored per second, and percentiles of the
+                         latencies (from sending) of the submissions
+                         sent during it.
+
+        """
+        records = self.records.values()
+        if not records:
+            return []
+        end = max(max(record[stage] for stage in PipelineMonitor.STAGES
+                      if stage in record) for record in records)
+        result = []
+        for index in xrange(int(end // self.window) + 1):
+            begin = index * self.window
+            sent = [record for record in records
+                    if begin <= record["sent"] < begin + self.window]
+            scored = [record for record in records
+                      if begin <= record.get("scored", -1) <
+                      begin + self.window]
+            point = {"begin": begin,
+                     "sent_rate": len(sent) / self.window,
+                     "scored_rate": len(scored) / self.window}
+            for stage in PipelineMonitor.STAGES:
+                latencies = sorted(record[stage] - record["sent"]
+                                   for record in sent if stage in record)
+                if latencies:
+                    point[stage] = {
+                        "p50": latencies[len(latencies) // 2],
+                        "p90": latencies[len(latencies) * 9 // 10],
+                        "max": latencies[-1]}
+            result.append(point)
+        return result
+
+    def save(self, path):
+        """Write the results to a file, and a summary to the log.
+
+        path (string): where to write the results, as JSON.
+
+        """
+        curve = self.curve()
+        with open(path, "w") as fout:
+            json.dump({"speeds": self.speeds,
+                       "window": self.window,
+                       "submissions": sorted(self.records.values(),
+                                             key=lambda x: x["id"]),
+                       "curve": curve}, fout, indent=4)
+
+        stage = "scored" if self.rws_address is None else "ranked"
+        logger.info("Latencies from sending to %s:" % stage)
+        logger.info("%-8s %8s %8s %8s %8s %8s" % (
+            "Window", "Sent/s", "Scored/s", "p50", "p90", "max"))
+        for point in curve:
+            latency = point.get(stage, {})
+            logger.info("%s %8.2f %8.2f %s" % (
+                to_time(point["begin"]), point["sent_rate"],
+                point["scored_rate"],
+                " ".join("%8.1f" % latency[key] if key in latency
+                         else "%8s" % "-"
+                         for key in ["p50", "p90", "max"])))
+
+
 class ContestReplayer:
 
     def __init__(self, import_source, cws_address, no_import=False,
-                 start_from=0):
+                 start_from=0, speed=1, monitor=None, benchmark_path=None):
         self.import_source = import_source
         self.cws_address = cws_address
         self.no_import = no_import
         self.start_from = start_from
+        self.monitor = monitor
+        self.benchmark_path = benchmark_path
 
         self.start = None
-        self.speed = 1
+        self.speed = speed
         self.speed_lock = RLock()
         self.events = []
 
@@ -117,6 +361,9 @@ class ContestReplayer:
                                "contest.json")) as fin:
             self.compute_events(json.load(fin))
 
+        if self.monitor is not None:
+            self.monitor.begin(self.speed)
+
         thread = Thread(target=self.replay)
         thread.daemon = True
         thread.start()
@@ -129,14 +376,19 @@ class ContestReplayer:
                                   "(time %s, multiplier %s):\n" % (
                 to_time((time.time() - self.start) * self.speed), self.speed))
             if new_speed == "q":
-                return 0
+                break
             elif new_speed != "":
                 try:
-                    new_speed = int(new_speed)
+                    new_speed = float(new_speed)
                 except ValueError:
                     logger.warning("Speed multiplier could not be parsed.")
                 else:
                     self.recompute_start(new_speed)
+
+        if self.monitor is not None:
+            logger.info("Waiting for the last submissions to complete...")
+            self.monitor.wait(timeout=600)
+            self.monitor.save(self.benchmark_path)
         return 0
 
     def compute_events(self, contest):
@@ -182,6 +434,8 @@ class ContestReplayer:
                     + (time.time() - self.start) * (new_speed - self.speed) \
                     * 1.0 / new_speed
                 self.speed = new_speed
+                if self.monitor is not None:
+                    self.monitor.speed_changed(new_speed)
 
     def submit(self, timestamp, username, password, t_id, t_short,
                files, language):
@@ -222,10 +476,16 @@ class ContestReplayer:
         browser.set_handle_robots(False)
         step(LoginRequest(browser, username, password,
                           base_url=self.cws_address))
-        step(SubmitRequest(browser,
-                           (int(t_id), t_short),
-                           filename=filename,
-                           base_url=self.cws_address))
+        request = SubmitRequest(browser,
+                                (int(t_id), t_short),
+                                filename=filename,
+                                base_url=self.cws_address)
+        if self.monitor is not None:
+            self.monitor.submitting(username, t_short)
+        step(request)
+        if self.monitor is not None and \
+                request.outcome != request.OUTCOME_SUCCESS:
+            self.monitor.submit_failed(username, t_short)
         shutil.rmtree(temp_dir)
 
     def token(self, timestamp, username, password, t_id, t_short,
@@ -262,7 +522,7 @@ class ContestReplayer:
                 while index < len(self.events) \
                         and float(self.events[index][0]) < self.start_from:
                     index += 1
-                self.start = time.time() - self.start_from
+                self.start = time.time() - self.start_from / self.speed
             else:
                 self.start = time.time()
 
@@ -310,6 +570,17 @@ def main():
                         help="assume the contest is already in the database")
     parser.add_argument("-r", "--resume", type=str,
                         help="start from (%%H:%%M:%%S)")
+    parser.add_argument("-s", "--speed", type=float, default=1,
+                        help="initial speed multiplier")
+    parser.add_argument("-b", "--benchmark", type=str,
+                        help="follow the submissions through the pipeline "
+                        "and save the results to this (JSON) file")
+    parser.add_argument("-w", "--rws-address", type=str,
+                        help="http address of RWS, to measure when the "
+                        "submissions are shown (with --benchmark)")
+    parser.add_argument("--window", type=float, default=60.0,
+                        help="seconds of each interval of the throughput "
+                        "and latency curve (with --benchmark)")
     args = parser.parse_args()
     start_from = None
     if args.resume is not None:
@@ -327,11 +598,22 @@ def main():
                         "before using ReplayContest.")
         return 1
 
+    monitor = None
+    if args.benchmark is not None:
+        with open(os.path.join(args.import_source, "contest.json")) as fin:
+            contest_name = json.load(fin)["name"]
+        monitor = PipelineMonitor(contest_name,
+                                  rws_address=args.rws_address,
+                                  window=args.window)
+
     ContestReplayer(
         import_source=args.import_source,
         no_import=args.no_import,
         start_from=start_from,
-        cws_address=args.cws_address
+        cws_address=args.cws_address,
+        speed=args.speed,
+        monitor=monitor,
+        benchmark_path=args.benchmark
         ).run()
 
     return 0
@@ -98,9 +98,11 @@ def load_test_list_from_file(filename):
 
 def get_all_tests():
     tests = []
-    for path, _, names in os.walk(os.path.join("cmstestsuite", "cms")):
-        for name in names:
-            tests.append((path, name))
+    for package in ["cms", "cmsranking"]:
+        for path, _, names in os.walk(os.path.join("cmstestsuite",
+                                                   package)):
+            for name in names:
+                tests.append((path, name))
     return tests
 
 
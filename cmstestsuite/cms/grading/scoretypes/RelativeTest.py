@@ -0,0 +1,96 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Programming contest management system
+# Copyright © 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Relative score type.
+
+"""
+
+import unittest
+
+from cms.grading.scoretypes.Relative import Relative
+
+
+def make_evaluations(outcomes):
+    return dict((idx, {"outcome": outcome, "text": "",
+                       "time": None, "memory": None})
+                for idx, outcome in enumerate(outcomes))
+
+
+class TestRelative(unittest.TestCase):
+
+    def setUp(self):
+        self.score_type = Relative([10.0, [None, 1.0]],
+                                   {0: True, 1: False})
+
+    def add(self, submission_id, timestamp, username, outcomes,
+            tokened=False):
+        return self.score_type.add_submission(
+            submission_id, timestamp, username, True,
+            make_evaluations(outcomes), tokened)
+
+    def test_first_submission(self):
+        self.assertEquals(self.add(1, 1, "a", [2.0, 0.5]), set())
+        self.assertAlmostEquals(self.score_type.pool[1]["score"], 15.0)
+        self.assertAlmostEquals(self.score_type.pool[1]["public_score"],
+                                10.0)
+        self.assertAlmostEquals(self.score_type.scores["a"], 15.0)
+
+    def test_better_submission_changes_others(self):
+        self.add(1, 1, "a", [2.0, 0.5])
+        changed = self.add(2, 2, "b", [4.0, 0.5])
+        self.assertEquals(changed, set([1]))
+        self.assertAlmostEquals(self.score_type.pool[1]["score"], 10.0)
+        self.assertAlmostEquals(self.score_type.scores["a"], 10.0)
+        self.assertAlmostEquals(self.score_type.scores["b"], 15.0)
+
+    def test_last_submission_replaces_previous(self):
+        self.add(1, 1, "a", [4.0, 0.0])
+        self.add(2, 2, "b", [2.0, 0.0])
+        # The new last submission of a is worse, so the best outcome
+        # on the first testcase is now the one of b.
+        changed = self.add(3, 3, "a", [1.0, 0.0])
+        self.assertEquals(changed, set([1, 2]))
+        self.assertAlmostEquals(self.score_type.scores["a"], 5.0)
+        self.assertAlmostEquals(self.score_type.scores["b"], 10.0)
+
+    def test_token_keeps_contributing(self):
+        self.add(1, 1, "a", [4.0, 0.0], tokened=True)
+        self.add(2, 2, "b", [2.0, 0.0])
+        changed = self.add(3, 3, "a", [1.0, 0.0])
+        self.assertEquals(changed, set())
+        self.assertAlmostEquals(self.score_type.scores["a"], 10.0)
+        self.assertAlmostEquals(self.score_type.scores["b"], 5.0)
+
+    def test_add_token(self):
+        self.add(1, 1, "a", [4.0, 0.0])
+        self.add(2, 2, "a", [1.0, 0.0])
+        self.add(3, 3, "b", [2.0, 0.0])
+        self.assertAlmostEquals(self.score_type.scores["b"], 10.0)
+        # Submission 1 doesn't contribute to the best outcomes yet.
+        self.assertAlmostEquals(self.score_type.pool[1]["score"], 20.0)
+        changed = self.score_type.add_token(1)
+        # The tokened submission's own score changes, too.
+        self.assertEquals(changed, set([1, 2, 3]))
+        self.assertAlmostEquals(self.score_type.pool[1]["score"], 10.0)
+        self.assertAlmostEquals(self.score_type.scores["a"], 10.0)
+        self.assertAlmostEquals(self.score_type.scores["b"], 5.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Programming contest management system
+# Copyright © 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the persistence backends of the ranking.
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import simplejson as json
+
+from cmsranking.Config import config
+from cmsranking.Persistence import LogPersistence
+
+
+class TestLogPersistence(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.threshold = config.log_compaction_threshold
+        # What the store would hold, used for the snapshots.
+        self.data = dict()
+        self.open()
+
+    def tearDown(self):
+        config.log_compaction_threshold = self.threshold
+        shutil.rmtree(self.path)
+
+    def open(self):
+        """Open the backend (again), as after a restart.
+
+        return (dict): what it loaded.
+
+        """
+        self.persistence = LogPersistence(self.path,
+                                          lambda: dict(self.data))
+        self.data = self.persistence.load()
+        return self.data
+
+    def put(self, key, data):
+        self.persistence.put(key, data)
+        self.data[key] = data
+
+    def put_list(self, data_dict):
+        self.persistence.put_list(data_dict)
+        self.data.update(data_dict)
+
+    def delete(self, key):
+        self.persistence.delete(key)
+        del self.data[key]
+
+    def log_lines(self):
+        with open(os.path.join(self.path, LogPersistence.LOG_FILENAME)) \
+                as log:
+            return log.readlines()
+
+    def test_empty(self):
+        self.assertEquals(self.data, {})
+
+    def test_put_and_replay(self):
+        self.put("a", {"x": 1})
+        self.put("b", {"x": 2})
+        self.put("a", {"x": 3})
+        self.assertEquals(self.open(), {"a": {"x": 3}, "b": {"x": 2}})
+
+    def test_put_list_is_a_single_write(self):
+        self.put_list({"a": {"x": 1}, "b": {"x": 2}})
+        self.assertEquals(len(self.log_lines()), 2)
+        self.assertEquals(self.open(), {"a": {"x": 1}, "b": {"x": 2}})
+
+    def test_delete_and_replay(self):
+        self.put_list({"a": {"x": 1}, "b": {"x": 2}})
+        self.delete("a")
+        self.assertEquals(self.open(), {"b": {"x": 2}})
+
+    def test_torn_record_is_discarded(self):
+        self.put("a", {"x": 1})
+        self.put("b", {"x": 2})
+        lines = self.log_lines()
+        with open(os.path.join(self.path, LogPersistence.LOG_FILENAME),
+                  "w") as log:
+            log.write(lines[0] + lines[1][:5])
+        self.assertEquals(self.open(), {"a": {"x": 1}})
+        # The backend can still be written after the recovery.
+        self.put("c", {"x": 3})
+        self.assertEquals(self.open(), {"a": {"x": 1}, "c": {"x": 3}})
+
+    def test_compaction(self):
+        config.log_compaction_threshold = 3
+        self.open()
+        for i in xrange(3):
+            self.put("k%d" % i, {"x": i})
+        self.assertEquals(len(self.log_lines()), 3)
+        # The log is full: this write compacts it first.
+        self.put("k3", {"x": 3})
+        self.assertEquals(len(self.log_lines()), 1)
+        with open(os.path.join(self.path, LogPersistence.SNAPSHOT_FILENAME)) \
+                as snapshot:
+            self.assertEquals(json.load(snapshot),
+                              dict(("k%d" % i, {"x": i}) for i in xrange(3)))
+        self.delete("k0")
+        self.assertEquals(self.open(),
+                          dict(("k%d" % i, {"x": i}) for i in xrange(1, 4)))
+
+    def test_migration_from_directory(self):
+        with open(os.path.join(self.path, "a.json"), "w") as rec:
+            rec.write(json.dumps({"x": 1}))
+        self.assertEquals(self.open(), {"a": {"x": 1}})
+        self.assertFalse(os.path.exists(os.path.join(self.path, "a.json")))
+        self.assertEquals(self.open(), {"a": {"x": 1}})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Programming contest management system
+# Copyright © 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the replication of the ranking: the changes recorded by
+the primary, applied by a follower.
+
+"""
+
+import atexit
+import shutil
+import tempfile
+import unittest
+
+import simplejson as json
+
+from cmsranking.Config import config
+
+# The stores are created on import, in config.lib_dir.
+config.lib_dir = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, config.lib_dir)
+
+from cmsranking.Persistence import MemoryPersistence
+from cmsranking.Replication import STORES, ChangeLog, Follower
+
+
+class TestReplication(unittest.TestCase):
+
+    def setUp(self):
+        for name, store in reversed(STORES):
+            store.set_persistence(MemoryPersistence())
+            store.delete_list()
+        self.stores = dict(STORES)
+        self.changelog = ChangeLog()
+        self.follower = Follower("http://localhost:8890/")
+
+    def create(self, name, key, data):
+        self.stores[name].create(key, json.dumps(data))
+
+    def create_all(self):
+        self.create("contests", "c",
+                    {"name": "Contest", "begin": 0, "end": 2000000000,
+                     "score_precision": 0})
+        self.create("tasks", "t",
+                    {"name": "Task", "short_name": "t", "contest": "c",
+                     "max_score": 100.0, "score_precision": 0,
+                     "extra_headers": [], "order": 0})
+        self.create("users", "u",
+                    {"f_name": "First", "l_name": "Last", "team": None})
+        self.create("submissions", "s",
+                    {"user": "u", "task": "t", "time": 10})
+
+    def contents(self):
+        return dict((name, json.loads(store.retrieve_list()))
+                    for name, store in STORES)
+
+    def test_changes_after_offset(self):
+        offset = self.changelog.get_offset()
+        self.assertEquals(self.changelog.get_changes(offset), [])
+        self.create_all()
+        changes = self.changelog.get_changes(offset)
+        self.assertEquals([(name, key) for seq, name, key, data in changes],
+                          [("contests", "c"), ("tasks", "t"),
+                           ("users", "u"), ("submissions", "s")])
+        self.assertEquals(
+            self.changelog.get_changes(self.changelog.get_offset()), [])
+
+        offset = self.changelog.get_offset()
+        self.stores["users"].delete("u")
+        # Deleting the user deletes its submission first.
+        self.assertEquals(
+            [(name, key, data) for seq, name, key, data
+             in self.changelog.get_changes(offset)],
+            [("submissions", "s", None), ("users", "u", None)])
+
+    def test_invalid_offsets(self):
+        self.create_all()
+        seq = int(self.changelog.get_offset().split(':')[1])
+        self.assertEquals(self.changelog.get_changes(None), None)
+        self.assertEquals(self.changelog.get_changes("nonsense"), None)
+        self.assertEquals(self.changelog.get_changes("0:0"), None)
+        self.assertEquals(self.changelog.get_changes(
+            "%s:%d" % (self.changelog.epoch, seq + 1)), None)
+
+    def test_buffer_overflow_needs_snapshot(self):
+        buffer_size = config.replication_buffer_size
+        config.replication_buffer_size = 2
+        try:
+            self.changelog = ChangeLog()
+        finally:
+            config.replication_buffer_size = buffer_size
+        offset = self.changelog.get_offset()
+        self.create_all()
+        self.assertEquals(self.changelog.get_changes(offset), None)
+
+    def test_apply_changes(self):
+        offset = self.changelog.get_offset()
+        self.create_all()
+        expected = self.contents()
+        changes = self.changelog.get_changes(offset)
+        for name, store in reversed(STORES):
+            store.delete_list()
+        self.follower.apply_changes(changes)
+        self.assertEquals(self.contents(), expected)
+
+    def test_apply_snapshot(self):
+        self.create_all()
+        snapshot = json.loads(json.dumps(self.changelog.get_snapshot()))
+        expected = self.contents()
+        self.stores["submissions"].delete("s")
+        self.create("submissions", "s2",
+                    {"user": "u", "task": "t", "time": 20})
+        self.follower.apply_snapshot(snapshot)
+        self.assertEquals(self.contents(), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Programming contest management system
+# Copyright © 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the entity stores of the ranking, with the (default)
+log persistence.
+
+"""
+
+import atexit
+import shutil
+import tempfile
+import unittest
+
+import simplejson as json
+
+from cmsranking.Config import config
+
+# The stores are created on import, in config.lib_dir.
+config.lib_dir = tempfile.mkdtemp()
+config.persistence = 'log'
+atexit.register(shutil.rmtree, config.lib_dir)
+
+import cmsranking.Contest as Contest
+import cmsranking.Task as Task
+import cmsranking.User as User
+import cmsranking.Submission as Submission
+import cmsranking.Subchange as Subchange
+from cmsranking.Store import Store
+# Registers the callbacks that score the submissions.
+import cmsranking.Scoring as Scoring
+
+
+class TestStore(unittest.TestCase):
+
+    def setUp(self):
+        for module in [Subchange, Submission, User, Task, Contest]:
+            module.store.delete_list()
+        Contest.store.create("c", json.dumps(
+            {"name": "Contest", "begin": 0, "end": 2000000000,
+             "score_precision": 0}))
+        Task.store.create("t", json.dumps(
+            {"name": "Task", "short_name": "t", "contest": "c",
+             "max_score": 100.0, "score_precision": 0,
+             "extra_headers": [], "order": 0}))
+        User.store.create("u", json.dumps(
+            {"f_name": "First", "l_name": "Last", "team": None}))
+
+    def reopen(self, module, name):
+        """Return a new store loading the data of the given one, as
+        after a restart.
+
+        """
+        return Store(getattr(module, module.__name__.split('.')[-1]),
+                     name)
+
+    def test_create_submission_and_replay(self):
+        Submission.store.create("s1", json.dumps(
+            {"user": "u", "task": "t", "time": 10}))
+        self.assertEquals(Scoring.store.get_score("u", "t"), 0.0)
+        store = self.reopen(Submission, "submissions")
+        self.assertEquals(json.loads(store.retrieve("s1")),
+                          {"user": "u", "task": "t", "time": 10})
+
+    def test_update_submission_and_replay(self):
+        Submission.store.create("s1", json.dumps(
+            {"user": "u", "task": "t", "time": 10}))
+        Submission.store.update("s1", json.dumps(
+            {"user": "u", "task": "t", "time": 20}))
+        store = self.reopen(Submission, "submissions")
+        self.assertEquals(json.loads(store.retrieve("s1"))["time"], 20)
+
+    def test_merge_submissions_and_replay(self):
+        Submission.store.create("s1", json.dumps(
+            {"user": "u", "task": "t", "time": 10}))
+        Submission.store.merge_list(json.dumps(
+            {"s1": {"user": "u", "task": "t", "time": 15},
+             "s2": {"user": "u", "task": "t", "time": 20}}))
+        store = self.reopen(Submission, "submissions")
+        self.assertEquals(sorted(json.loads(store.retrieve_list())),
+                          ["s1", "s2"])
+        self.assertEquals(json.loads(store.retrieve("s1"))["time"], 15)
+
+    def test_delete_cascades_and_replays(self):
+        Submission.store.create("s1", json.dumps(
+            {"user": "u", "task": "t", "time": 10}))
+        Subchange.store.create("c1", json.dumps(
+            {"submission": "s1", "time": 11, "score": 50.0}))
+        self.assertEquals(Scoring.store.get_score("u", "t"), 50.0)
+        User.store.delete("u")
+        self.assertFalse("s1" in Submission.store)
+        self.assertFalse("c1" in Subchange.store)
+        self.assertFalse("s1" in self.reopen(Submission, "submissions"))
+        self.assertFalse("c1" in self.reopen(Subchange, "subchanges"))
+
+
+if __name__ == "__main__":
+    unittest.main()